@@ -0,0 +1,152 @@
+"""CPU cost per turn: streamed + drained vs. non-streaming `complete()`.
+
+Runs a local OpenAI-compatible stub in a separate process (so its CPU is not
+counted) and times the client side of one game turn three ways:
+
+    cumulative  legacy {"text": <whole response so far>} stream
+    delta       delta stream drained with collect_stream()
+    complete    non-streaming openai_api_complete()
+
+Usage (from the repo root):
+    python benchmarks/bench_complete.py --turns 200 --tokens 400
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+
+def _stub_handler(num_tokens):
+    words = [f"word{i} " for i in range(num_tokens)]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            usage = {"prompt_tokens": 32, "completion_tokens": num_tokens, "total_tokens": 32 + num_tokens}
+            if body.get("stream"):
+                chunks = [
+                    {"id": "b", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": w}, "finish_reason": None}]}
+                    for w in words
+                ]
+                chunks.append({"id": "b", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                               "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                chunks.append({"id": "b", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                               "choices": [], "usage": usage})
+                out = "".join(f"data: {json.dumps(c)}\n\n" for c in chunks) + "data: [DONE]\n\n"
+                content_type = "text/event-stream"
+            else:
+                out = json.dumps({
+                    "id": "b", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+                content_type = "application/json"
+            out = out.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+    return Handler
+
+
+def _serve(port, num_tokens):
+    ThreadingHTTPServer(("127.0.0.1", port), _stub_handler(num_tokens)).serve_forever()
+
+
+def _free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=400, help="response length in chunks")
+    args = parser.parse_args()
+
+    port = _free_port()
+    server = multiprocessing.Process(target=_serve, args=(port, args.tokens), daemon=True)
+    server.start()
+    api_base = f"http://127.0.0.1:{port}/v1"
+
+    from src.fschat.api_provider_game import (
+        collect_stream,
+        openai_api_complete,
+        openai_api_delta_iter,
+        openai_api_stream_iter,
+    )
+
+    messages = [
+        {"role": "system", "content": "You are playing a guessing game."},
+        {"role": "user", "content": "Ask your next question."},
+    ]
+
+    def cumulative_turn():
+        output = ""
+        for data in openai_api_stream_iter("gpt-4o", messages, 0.7, 1.0, 1024, api_base=api_base, api_key="bench"):
+            assert data["error_code"] == 0
+            output = data["text"].strip()
+        return output
+
+    def delta_turn():
+        text, _ = collect_stream(
+            openai_api_delta_iter("gpt-4o", messages, 0.7, 1.0, 1024, api_base=api_base, api_key="bench")
+        )
+        return text.strip()
+
+    def complete_turn():
+        return openai_api_complete(
+            "gpt-4o", messages, 0.7, 1.0, 1024, api_base=api_base, api_key="bench"
+        ).text.strip()
+
+    # wait for the stub and warm up the pooled client
+    for _ in range(50):
+        try:
+            complete_turn()
+            break
+        except Exception:
+            time.sleep(0.1)
+
+    results = {}
+    for name, turn in [("cumulative", cumulative_turn), ("delta", delta_turn), ("complete", complete_turn)]:
+        expected = None
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        for _ in range(args.turns):
+            output = turn()
+            expected = expected or output
+            assert output == expected
+        cpu = (time.process_time() - cpu_start) / args.turns * 1000
+        wall = (time.perf_counter() - wall_start) / args.turns * 1000
+        results[name] = cpu
+        print(f"{name:>10}: {cpu:7.3f} ms CPU/turn  {wall:7.3f} ms wall/turn")
+
+    base = results["cumulative"]
+    for name in ("delta", "complete"):
+        print(f"{name:>10}: {base - results[name]:7.3f} ms CPU saved per turn vs cumulative "
+              f"({(1 - results[name] / base) * 100:.0f}%)")
+
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""CPU cost of decoding an OpenAI-style SSE stream: shared decoder vs. per-line parsing.
+
+Builds the body of a streamed chat completion in memory, cuts it into
+network-sized reads and turns it into delta records two ways:
+
+    per-line  the parsing the nvidia/sambanova iterators used to do:
+              iter_lines(), decode("utf-8") and json.loads(line[6:]) per line
+    shared    src/fschat/sse.py: byte chunks split in place, msgspec decoding
+              into the few fields the records need
+
+Usage (from the repo root):
+    python benchmarks/bench_sse.py --turns 500 --tokens 400 --read-size 1024
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+
+def sse_body(num_tokens):
+    """Body of a streamed chat completion with `num_tokens` content chunks, as the providers send it."""
+    header = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1730000000,
+              "model": "Meta-Llama-3.1-70B-Instruct", "system_fingerprint": "fp_bench"}
+    chunks = [
+        {**header, "choices": [{"index": 0, "delta": {"role": "assistant", "content": f"word{i} "},
+                                "logprobs": None, "finish_reason": None}]}
+        for i in range(num_tokens)
+    ]
+    chunks.append({**header, "choices": [{"index": 0, "delta": {}, "logprobs": None, "finish_reason": "stop"}]})
+    chunks.append({**header, "choices": [], "usage": {"prompt_tokens": 512, "completion_tokens": num_tokens,
+                                                      "total_tokens": 512 + num_tokens}})
+    return ("".join(f"data: {json.dumps(c)}\n\n" for c in chunks) + "data: [DONE]\n\n").encode()
+
+
+def reads(body, read_size):
+    return [body[i:i + read_size] for i in range(0, len(body), read_size)]
+
+
+def legacy_iter_lines(byte_chunks):
+    """`requests.Response.iter_lines()` over the same reads."""
+    pending = None
+    for chunk in byte_chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def legacy_delta_iter(byte_chunks):
+    """The per-line parsing the raw-HTTP iterators used before `sse.py`."""
+    from src.fschat.api_provider_game import completion_record, openai_usage_record
+
+    finish_reason = None
+    usage = None
+    for line in legacy_iter_lines(byte_chunks):
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if line.endswith("[DONE]"):
+            break
+        chunk = json.loads(line[6:])
+        if chunk.get("usage"):
+            usage = openai_usage_record(chunk["usage"])
+        if chunk.get("choices"):
+            choice = chunk["choices"][0]
+            content = choice.get("delta", {}).get("content")
+            if content:
+                yield {"delta": content, "error_code": 0}
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+    yield completion_record(finish_reason, usage)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--tokens", type=int, default=400, help="response length in chunks")
+    parser.add_argument("--read-size", type=int, default=1024, help="bytes per network read")
+    args = parser.parse_args()
+
+    from src.fschat.api_provider_game import _sse_chat_delta_iter, collect_stream
+
+    body_reads = reads(sse_body(args.tokens), args.read_size)
+    expected = collect_stream(legacy_delta_iter(body_reads))
+    assert collect_stream(_sse_chat_delta_iter(body_reads)) == expected
+
+    results = {}
+    for name, delta_iter in [("per-line", legacy_delta_iter), ("shared", _sse_chat_delta_iter)]:
+        start = time.process_time()
+        for _ in range(args.turns):
+            collect_stream(delta_iter(body_reads))
+        cpu = (time.process_time() - start) / args.turns * 1000
+        tracemalloc.start()
+        collect_stream(delta_iter(body_reads))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = cpu
+        print(f"{name:>9}: {cpu:7.3f} ms CPU/turn  {cpu / args.tokens * 1000:6.2f} us/chunk  "
+              f"{peak / 1024:7.1f} KiB peak")
+
+    print(f"   shared: {results['per-line'] / results['shared']:.1f}x faster than per-line")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Exercise the region prober against local stub regions.
+
+Starts three OpenAI-compatible stub servers on localhost, one per "region",
+each answering `HEAD` after its round trip and the first event of a streamed
+completion after its time to first token. It then runs probe rounds of
+`src/fschat/region_router.py` through four phases and checks where traffic
+is routed:
+
+    converge  the fastest region takes over after `switch_after` rounds
+    jitter    a region only slightly faster does not take traffic
+    degrade   the current region slows down; a clearly faster one takes over
+    outage    the current region goes down; traffic fails over immediately
+
+Usage (from the repo root):
+    python benchmarks/region_stub.py --switch-after 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+
+def _stub_handler(latency):
+    """`latency` is `{"rtt": seconds, "ttft": seconds}`, read on every request."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            time.sleep(latency["rtt"])
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            time.sleep(latency["ttft"])
+            chunk = {"id": "r", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": "pong"}, "finish_reason": "length"}]}
+            out = f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+    return Handler
+
+
+def start_region(rtt, ttft):
+    latency = {"rtt": rtt, "ttft": ttft}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _stub_handler(latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, latency, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--switch-after", type=int, default=3)
+    parser.add_argument("--switch-margin", type=float, default=0.2)
+    parser.add_argument("--unhealthy-after", type=int, default=2)
+    args = parser.parse_args()
+
+    from src.fschat.region_router import region_router
+
+    regions = {
+        "us-east": start_region(0.005, 0.15),
+        "us-west": start_region(0.005, 0.05),
+        "eu-west": start_region(0.005, 0.10),
+    }
+    entry = {
+        "model_name": "stub-model",
+        "api_type": "openai",
+        "api_key": "stub",
+        "regions": {name: api_base for name, (_, _, api_base) in regions.items()},
+        "region_routing": {
+            "probe_timeout_seconds": 2.0,
+            "ttft_probe": True,
+            "switch_margin": args.switch_margin,
+            "switch_after": args.switch_after,
+            "unhealthy_after": args.unhealthy_after,
+        },
+    }
+    routed_to = {api_base: name for name, api_base in entry["regions"].items()}
+
+    async def rounds(phase, count):
+        for i in range(count):
+            await region_router.probe(entry)
+            stats = region_router.stats()["stub-model"]
+            ttfts = "  ".join(
+                f"{name}={state['ttft'] * 1000:5.0f}ms" if state["healthy"] and state["ttft"] is not None
+                else f"{name}=  down"
+                for name, state in stats["regions"].items()
+            )
+            print(f"{phase:>8} {i + 1:2d}: {ttfts}  -> {routed_to[region_router.route(entry)['api_base']]}")
+
+    def current():
+        return routed_to[region_router.route(entry)["api_base"]]
+
+    assert current() == "us-east", "the first listed region serves before any probe"
+
+    await rounds("converge", args.switch_after)
+    assert current() == "us-west"
+
+    regions["eu-west"][1]["ttft"] = 0.045
+    await rounds("jitter", 2 * args.switch_after)
+    assert current() == "us-west", "a region within the switch margin must not take over"
+
+    regions["us-west"][1]["ttft"] = 0.4
+    await rounds("degrade", 3 * args.switch_after)
+    assert current() == "eu-west"
+
+    server = regions["eu-west"][0]
+    server.shutdown()
+    server.server_close()
+    await rounds("outage", args.unhealthy_after)
+    assert current() != "eu-west", "an unhealthy region is left without waiting"
+
+    print(f"ok: {region_router.stats()['stub-model']['switches']} switches")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
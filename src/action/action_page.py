@@ -1,14 +1,16 @@
 # src/action/npc_page.py
 
-from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Optional
 import uuid
 import json
 import os
 
 from src.action.action import Action
-from src.fschat.api_provider_game import get_api_provider_stream_iter
-from src.database import get_db, ActionSession  # Import ActionSession
+from src.fschat.api_provider_async import get_api_provider_async_delta_iter
+from src.fschat.disconnect import cancel_on_disconnect
+from src.database import get_db, find_session, add_session_usage, add_turn_models, ActionSession  # Import ActionSession
 from sqlalchemy.orm import Session
 from src.fschat.conversation_game import Conversation
 
@@ -20,7 +22,8 @@ with open(ACTION_PROMPT_FILE, 'r') as f:
     NPC_PROMPTS = json.load(f)
 
 @router.post("/start")
-def npc_start(
+async def npc_start(
+    request: Request,
     username: Optional[str] = Query(default="anonymous", description="Specify the username"),
     db: Session = Depends(get_db)  # Added database dependency
 ):
@@ -39,24 +42,29 @@ def npc_start(
     initial_message = f"Hello, {npc_data['name']}!"
     action.update_user_conversation(action.conversation, initial_message)
 
-    npc_response, actions = action.generation_response(
-        get_api_provider_stream_iter,
+    npc_response, actions = await cancel_on_disconnect(request, action.async_generation_response(
+        get_api_provider_async_delta_iter,
         action.conversation,
-    )
+    ))
 
     print(npc_response)
     print(actions)
 
-    # Save session to the database
-    new_session = ActionSession(
-        session_id=session_id,
-        username=username,
-        model=action.model_name,
-        history=action.conversation.messages,
-        system_prompt=action.system_prompt
-    )
-    db.add(new_session)
-    db.commit()
+    def save_session():
+        # Save session to the database
+        new_session = ActionSession(
+            session_id=session_id,
+            username=username,
+            model=action.model_name,
+            history=action.conversation.messages,
+            system_prompt=action.system_prompt
+        )
+        add_session_usage(db, new_session, action.pending_usage)
+        add_turn_models(new_session, action.pending_turns)
+        db.add(new_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
 
     return {
         "message": f"Conversation with {npc_data['name']} started.",
@@ -74,7 +82,8 @@ class actionChatRequest(BaseModel):
     user_input: str
 
 @router.post("/chat")
-def npc_chat(
+async def npc_chat(
+    request: Request,
     request_data: actionChatRequest,
     db: Session = Depends(get_db)
 ):
@@ -85,7 +94,7 @@ def npc_chat(
     user_text = request_data.user_input
 
     # Retrieve the session from the database
-    npc_session = db.query(ActionSession).filter_by(session_id=session_id).first()
+    npc_session = await run_in_threadpool(find_session, db, ActionSession, session_id=session_id)
     if not npc_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -100,6 +109,7 @@ def npc_chat(
         conversation=conversation,
         system_prompt=npc_session.system_prompt
     )
+    action.session_id = session_id
 
     if not user_text:
         raise HTTPException(status_code=400, detail="No user input provided.")
@@ -108,15 +118,20 @@ def npc_chat(
     action.update_user_conversation(action.conversation, user_text)
 
     # Generate NPC response
-    npc_response, actions = action.generation_response(
-        get_api_provider_stream_iter,
+    npc_response, actions = await cancel_on_disconnect(request, action.async_generation_response(
+        get_api_provider_async_delta_iter,
         action.conversation,
-    )
+    ))
+
+    def save_session():
+        # Update session history in the database
+        npc_session.history = action.conversation.messages
+        add_session_usage(db, npc_session, action.pending_usage)
+        add_turn_models(npc_session, action.pending_turns)
+        db.add(npc_session)
+        db.commit()
 
-    # Update session history in the database
-    npc_session.history = action.conversation.messages
-    db.add(npc_session)
-    db.commit()
+    await run_in_threadpool(save_session)
 
     return {
         "npc_response": npc_response,
@@ -3,7 +3,15 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent))  # Add the project root to the path
 # sys.path.append('/home/ubuntu/game_arena_engine')
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+from src.fschat.call_scheduler import CallShed
+from src.fschat.disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected
+from src.fschat.provider_metrics import provider_metrics
+from src.fschat.region_router import region_router
+from src.fschat.warmup import warmup
+from src.database import add_abandoned_usage
 from src.games.akinator.akinator_page import router as akinator_router
 from src.games.taboo.taboo_page import router as taboo_router
 from src.games.bluffing.bluffing_page import router as bluffing_router
@@ -12,6 +20,7 @@ from src.npc.npc_page import router as npc_router  # Include the NPC router
 from src.users.user import router as user_router
 from src.action.action_page import router as action_router
 from src.games.base_page import router as base_router
+from src.monitor.monitor_page import router as monitor_router
 
 app = FastAPI(title="Game Arena", debug=True)
 
@@ -24,6 +33,50 @@ app.include_router(story_scenario_router, prefix="/scenario")
 app.include_router(npc_router, prefix="")  # No prefix, or you can set '/npc'
 app.include_router(user_router, prefix="")
 app.include_router(base_router, prefix="")
+app.include_router(monitor_router, prefix="/monitor")
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    # nobody is listening; the turn was cancelled and nothing was saved but what it spent
+    if exc.billing:
+        await run_in_threadpool(add_abandoned_usage, exc.billing)
+    return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+
+@app.exception_handler(CallShed)
+async def call_shed_handler(request: Request, exc: CallShed):
+    # low-priority work (hints, suggestions, NPC chat) gave way to game turns
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Too busy for {exc.call_class} requests right now, try again shortly."},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+
+@app.on_event("startup")
+async def start_warmup():
+    # in the background: the worker takes requests while the providers warm up
+    warmup.start()
+    region_router.start()
+
+
+@app.get("/health")
+def health():
+    """
+    503 while the provider warm-up is still running, 200 once it is done.
+    """
+    report = warmup.report()
+    return JSONResponse(status_code=200 if warmup.ready else 503, content=report)
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Provider latency and throughput histograms, in the Prometheus text format.
+    """
+    return Response(content=provider_metrics.render(), media_type="text/plain; version=0.0.4")
+
 
 @app.get("/")
 def main():
@@ -1,5 +1,7 @@
+import datetime
 import json
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Enum, JSON, PickleType
+from sqlalchemy import create_engine, inspect, text, Column, Integer, Float, String, Date, DateTime, Boolean, Enum, JSON, PickleType
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
@@ -42,6 +44,14 @@ class GameSession(Base):
     game_stat_change = Column(JSON)  # Added game_stat_change field
     total_game_time = Column(Integer) # Added spent time for a game session
     escape_ai_room_id = Column(String(), index=True) # Added the whole escape ai room game id 
+    # provider token usage and cost of every call made for this session
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    cached_input_tokens = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+    # model that served each turn, e.g. [{"type": "question", "model": "gpt-4o-2024-11-20"}]
+    # plus "fallback_from" when a fallback model took over (see fschat.fallback)
+    turn_models = Column(MutableList.as_mutable(JSON), default=[])
 
     def to_dict(self):
         return {
@@ -62,7 +72,12 @@ class GameSession(Base):
             "system_prompt": self.system_prompt,
             "game_stat_change": self.game_stat_change,
             "total_game_time": self.total_game_time,
-            "escape_ai_room_id": self.escape_ai_room_id
+            "escape_ai_room_id": self.escape_ai_room_id,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "cost_usd": self.cost_usd,
+            "turn_models": self.turn_models or [],
         }
 
 class UserStars(Base):
@@ -95,6 +110,14 @@ class NPCSession(Base):
     history = Column(MutableList.as_mutable(JSON), default=[])
     system_prompt = Column(String)
     timestamp = Column(DateTime, default=func.now())
+    # provider token usage and cost of every call made for this session
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    cached_input_tokens = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+    # model that served each turn, e.g. [{"type": "question", "model": "gpt-4o-2024-11-20"}]
+    # plus "fallback_from" when a fallback model took over (see fschat.fallback)
+    turn_models = Column(MutableList.as_mutable(JSON), default=[])
 
     def to_dict(self):
         return {
@@ -105,6 +128,11 @@ class NPCSession(Base):
             "history": self.history,
             "system_prompt": self.system_prompt,
             "timestamp": self.timestamp.isoformat(),
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "cost_usd": self.cost_usd,
+            "turn_models": self.turn_models or [],
         }
     
 # Added ActionSession table
@@ -118,6 +146,14 @@ class ActionSession(Base):
     history = Column(MutableList.as_mutable(JSON), default=[])
     system_prompt = Column(String)
     timestamp = Column(DateTime, default=func.now())
+    # provider token usage and cost of every call made for this session
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    cached_input_tokens = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+    # model that served each turn, e.g. [{"type": "question", "model": "gpt-4o-2024-11-20"}]
+    # plus "fallback_from" when a fallback model took over (see fschat.fallback)
+    turn_models = Column(MutableList.as_mutable(JSON), default=[])
 
     def to_dict(self):
         return {
@@ -127,14 +163,129 @@ class ActionSession(Base):
             "history": self.history,
             "system_prompt": self.system_prompt,
             "timestamp": self.timestamp.isoformat(),
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "cost_usd": self.cost_usd,
+            "turn_models": self.turn_models or [],
         }
 
 
+# Added ModelUsageDaily table: token usage and cost rolled up per model and day
+class ModelUsageDaily(Base):
+    __tablename__ = "model_usage_daily"
+
+    day = Column(Date, primary_key=True)
+    model = Column(String, primary_key=True)
+    calls = Column(Integer, default=0)
+    estimated_calls = Column(Integer, default=0)  # provider reported no usage; tokens estimated
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    cached_input_tokens = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+
+    def to_dict(self):
+        return {
+            "day": self.day.isoformat(),
+            "model": self.model,
+            "calls": self.calls,
+            "estimated_calls": self.estimated_calls,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "cost_usd": self.cost_usd,
+        }
+
+
+USAGE_COUNTERS = ("input_tokens", "output_tokens", "cached_input_tokens", "cost_usd")
+
+
+def add_session_usage(db, session_row, usages):
+    """Add the usage entries of `usages` (see `usage_accounting.call_usage`) to the
+    session row (if there is one yet) and the per-model daily rollup. Empties
+    `usages`; commit is left to the caller.
+    """
+    day = datetime.date.today()
+    for usage in usages:
+        if usage is None:
+            continue
+        usage = dict(usage, cost_usd=usage["cost_usd"] or 0.0)
+        if session_row is not None:
+            for name in USAGE_COUNTERS:
+                setattr(session_row, name, (getattr(session_row, name) or 0) + usage[name])
+        counts = {name: usage[name] for name in USAGE_COUNTERS}
+        counts["calls"] = 1
+        counts["estimated_calls"] = int(usage["estimated"])
+        # one upsert, so concurrent workers add up instead of overwriting each other
+        stmt = insert(ModelUsageDaily).values(day=day, model=usage["model"], **counts)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["day", "model"],
+            set_={name: getattr(ModelUsageDaily, name) + stmt.excluded[name] for name in counts},
+        ))
+    usages.clear()
+
+
+def add_turn_models(session_row, turns):
+    """Append the `turn_models` entries of `turns` (see `fallback.turn_record`) to the
+    session row. Empties `turns`; commit is left to the caller.
+    """
+    if turns:
+        session_row.turn_models = list(session_row.turn_models or []) + turns
+    turns.clear()
+
+
+def find_session(db, session_class, **filters):
+    """First `session_class` row matching `filters`, or None. The async routes run it
+    (and every other query) through `run_in_threadpool`, off the event loop.
+    """
+    return db.query(session_class).filter_by(**filters).first()
+
+
+def add_abandoned_usage(billing):
+    """Bill the calls of a turn whose client disconnected (see `disconnect.ClientDisconnected`).
+
+    `billing` is `[(session table, session id or None, usages), ...]`; a turn that
+    started a session never got to store its row, so its usage only goes to the rollup.
+    """
+    session_classes = {cls.__tablename__: cls for cls in (GameSession, NPCSession, ActionSession)}
+    db = SessionLocal()
+    try:
+        for table, session_id, usages in billing:
+            session_row = None
+            if session_id is not None:
+                session_row = find_session(db, session_classes[table], session_id=session_id)
+            add_session_usage(db, session_row, usages)
+        db.commit()
+    finally:
+        db.close()
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+def add_missing_columns():
+    """create_all() does not touch existing tables; add the columns introduced since."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                # JSON defaults ([] etc.) have no DDL literal; those rows read back as NULL
+                if column.default is not None and column.default.is_scalar and not isinstance(column.default.arg, (list, dict)):
+                    ddl += f" DEFAULT {column.default.arg!r}"
+                conn.execute(text(ddl))
+
+
 # Create the database tables if they don't exist
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+Base.metadata.create_all(bind=engine)
+add_missing_columns()
\ No newline at end of file
@@ -0,0 +1,1444 @@
+"""Call API providers asynchronously.
+
+Every `*_api_delta_iter` in `api_provider_game.py` has an async counterpart here
+that yields the same delta records, so the game routes can `await` an LLM turn on
+the event loop instead of pinning a threadpool thread for the whole stream.
+`get_api_provider_async_stream_iter` keeps the cumulative-text protocol.
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+import time
+from typing import Optional
+
+from fastchat.utils import build_logger
+from src.fschat.client_pool import (
+    RAW_HTTP_TIMEOUT,
+    client_pool,
+    get_anthropic_client,
+    get_cohere_client,
+    get_mistral_client,
+    get_openai_client,
+)
+from src.fschat.api_provider_game import (
+    CompletionResult,
+    NON_STREAMING_API_TYPES,
+    OPENAI_COMPATIBLE_APIS,
+    RetryPolicy,
+    anthropic_completion_result,
+    anthropic_usage_record,
+    bard_api_delta_iter,
+    chat_completion_json_result,
+    chat_completion_result,
+    cohere_completion_record,
+    completion_record,
+    decided_by,
+    gemini_chat_session,
+    gemini_completion_record,
+    gemini_completion_result,
+    openai_assistant_api_delta_iter,
+    openai_usage_record,
+    sambanova_api_request,
+    split_anthropic_system_prompt,
+    stop_params,
+)
+from src.fschat.cassette import async_record_result, async_recorded_stream_iter, replay_async_delta_iter
+from src.fschat.disconnect import note_output
+from src.fschat.hedging import hedged_delta_iter
+from src.fschat.key_balancer import async_balanced_call, async_balanced_stream_iter, is_balanced
+from src.fschat.mock_provider import mock_api_async_delta_iter
+from src.fschat.model_health import model_health, track_async_stream_iter
+from src.fschat.provider_metrics import record_complete, timed_async_stream_iter
+from src.fschat.rate_limiter import (
+    async_deadline_stream_iter,
+    async_rate_limited_call,
+    async_rate_limited_stream_iter,
+    start_deadline,
+)
+from src.fschat.region_router import has_regions, region_router
+from src.fschat.sse import SSE_DONE, aiter_json_lines, aiter_sse_data, decode_chat_chunk
+
+
+logger = build_logger("web_server", "web_server.log")
+
+
+async def async_cumulative_stream_iter(delta_iter):
+    """Adapt an async delta stream to the legacy cumulative-text protocol."""
+    text = ""
+    async for data in delta_iter:
+        if data["error_code"] != 0:
+            yield data
+            continue
+        if data.get("final"):
+            continue
+        if data.get("reset"):
+            text = ""
+        text += data["delta"]
+        yield {"text": text, "error_code": 0}
+
+
+def async_cumulative(delta_iter_fn):
+    @functools.wraps(delta_iter_fn)
+    def stream_iter_fn(*args, **kwargs):
+        return async_cumulative_stream_iter(delta_iter_fn(*args, **kwargs))
+
+    return stream_iter_fn
+
+
+async def async_collect_stream(stream_iter, watchers=()):
+    """Async `collect_stream`: drain a stream of either protocol into `(text, final)`.
+
+    Also accepts the awaitable returned by `async_complete()`.
+    """
+    if inspect.isawaitable(stream_iter):
+        stream_iter = await stream_iter
+    if isinstance(stream_iter, CompletionResult):
+        note_output(stream_iter.text)
+        return stream_iter.text, stream_iter.to_record()
+    parts = []
+    final = None
+    async for data in stream_iter:
+        assert data["error_code"] == 0
+        if "delta" not in data:
+            parts = [data["text"]]
+        elif data.get("final"):
+            final = data
+            continue
+        else:
+            if data.get("reset"):
+                parts = []
+            parts.append(data["delta"])
+            note_output(data["delta"])
+        watcher = decided_by(watchers, "".join(parts)) if watchers else None
+        if watcher is not None:
+            await stream_iter.aclose()
+            logger.info(f"stream watcher {watcher} decided the turn; stopped the stream early")
+            final = completion_record("early_stop")
+            break
+    return "".join(parts), final
+
+
+async def async_retry_delta_iter(stream_iter_fn, policy, model_name=None):
+    """Async `retry_delta_iter`."""
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        emitted = False
+        stream_iter = async_deadline_stream_iter(policy.latest_start(started), stream_iter_fn())
+        try:
+            async for data in stream_iter:
+                if data["error_code"] != 0:
+                    error = data
+                    break
+                if data.get("final"):
+                    data = {**data, "attempts": attempt}
+                emitted = True
+                yield data
+            else:
+                return
+        except Exception as e:
+            error = e
+        finally:
+            await stream_iter.aclose()
+        delay = policy.next_delay(attempt, error, started)
+        if delay is None:
+            if isinstance(error, Exception):
+                raise error
+            yield error
+            return
+        logger.warning(f"{model_name}: attempt {attempt} failed ({error}), retrying in {delay:.2f}s")
+        if emitted:
+            yield {"delta": "", "error_code": 0, "reset": True}
+        await asyncio.sleep(delay)
+
+
+async def async_call_with_retry(fn, policy, model_name=None):
+    """Async `call_with_retry`: await `fn()` with the retry policy applied."""
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            with start_deadline(policy.latest_start(started)):
+                result = await fn()
+        except Exception as e:
+            delay = policy.next_delay(attempt, e, started)
+            if delay is None:
+                raise
+            logger.warning(f"{model_name}: attempt {attempt} failed ({e}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        result.attempts = attempt
+        return result
+
+
+def get_api_provider_async_stream_iter(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+):
+    return async_cumulative_stream_iter(
+        get_api_provider_async_delta_iter(
+            conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state
+        )
+    )
+
+
+def get_api_provider_async_delta_iter(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+):
+    def attempt():
+        if model_api_dict.get("hedging"):
+            return hedged_delta_iter(
+                provider_async_delta_iter,
+                conv,
+                model_name,
+                model_api_dict,
+                temperature,
+                top_p,
+                max_new_tokens,
+                state,
+            )
+        return provider_async_delta_iter(
+            conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state
+        )
+
+    return async_retry_delta_iter(
+        attempt, RetryPolicy.for_endpoint(model_api_dict), model_name=model_name
+    )
+
+
+def provider_async_delta_iter(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+):
+    """Dispatch one request to the provider of `model_api_dict`, without hedging or retries."""
+    if has_regions(model_api_dict):
+        # every attempt goes to the region the prober currently prefers
+        return provider_async_delta_iter(
+            conv, model_name, region_router.route(model_api_dict), temperature, top_p, max_new_tokens, state
+        )
+    if is_balanced(model_api_dict):
+        # pick one of the entry's keys/bases for this attempt
+        return async_balanced_stream_iter(
+            model_api_dict,
+            lambda member_api_dict: provider_async_delta_iter(
+                conv, model_name, member_api_dict, temperature, top_p, max_new_tokens, state
+            ),
+        )
+    if model_api_dict["api_type"] == "openai":
+        prompt = conv.to_openai_api_messages(model_name=model_api_dict["model_name"])
+        stream_iter = openai_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "openai_assistant":
+        # the assistants API is thread/run based and rarely used; keep the sync
+        # implementation and only move it off the event loop
+        last_prompt = conv.messages[-2][1]
+        stream_iter = iterate_in_threadpool(
+            openai_assistant_api_delta_iter(
+                state,
+                last_prompt,
+                assistant_id=model_api_dict["assistant_id"],
+                api_key=model_api_dict["api_key"],
+            )
+        )
+    elif model_api_dict["api_type"] == "anthropic":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = anthropic_api_async_delta_iter(
+            model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"],
+        )
+    elif model_api_dict["api_type"] == "anthropic_message":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = anthropic_message_api_async_delta_iter(
+            model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens,
+            stop=model_api_dict.get("stop"), api_key=model_api_dict.get("api_key"),
+        )
+    elif model_api_dict["api_type"] == "gemini":
+        prompt = conv.to_gemini_api_messages()
+        stream_iter = gemini_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "bard":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = iterate_in_threadpool(
+            bard_api_delta_iter(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                api_key=model_api_dict["api_key"],
+            )
+        )
+    elif model_api_dict["api_type"] == "mistral":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = mistral_api_async_delta_iter(
+            model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "nvidia":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = nvidia_api_async_delta_iter(
+            model_name,
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            model_api_dict["api_base"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "ai2":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = ai2_api_async_delta_iter(
+            model_name,
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict["api_base"],
+            api_key=model_api_dict["api_key"],
+        )
+    elif model_api_dict["api_type"] == "cohere":
+        messages = conv.to_openai_api_messages()
+        stream_iter = cohere_api_async_delta_iter(
+            client_name=model_api_dict.get("client_name", "FastChat"),
+            model_id=model_api_dict["model_name"],
+            messages=messages,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+            api_base=model_api_dict["api_base"],
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "vertex":
+        prompt = conv.to_vertex_api_messages()
+        stream_iter = vertex_api_async_delta_iter(
+            model_name, prompt, temperature, top_p, max_new_tokens, stop=model_api_dict.get("stop")
+        )
+    elif model_api_dict["api_type"] == "replicate":
+        prompt = conv.to_replicate_api_messages()
+        propmt_template = "{prompt}"
+
+        stream_iter = replicate_api_async_delta_iter(
+            model_name=model_api_dict["model_name"],
+            prompt_template=propmt_template,
+            prompt=prompt,
+            temperature=temperature,
+            top_p=top_p,
+            min_tokens=0,
+            presence_penalty=1.15,
+            api_key=model_api_dict["api_key"],
+        )
+    elif model_api_dict["api_type"] == "sambanova":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = sambanova_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "xai":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = xai_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "dashscope":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = dashscope_qwen_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "yi":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = yi_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "deepseek":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = deepseek_api_async_delta_iter(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
+            api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "mock":
+        prompt = conv.to_openai_api_messages()
+        stream_iter = mock_api_async_delta_iter(
+            prompt, max_new_tokens, model_api_dict.get("mock"), stop=model_api_dict.get("stop")
+        )
+    elif model_api_dict["api_type"] == "replay":
+        stream_iter = replay_async_delta_iter(conv, model_api_dict, temperature, top_p, max_new_tokens)
+    else:
+        raise NotImplementedError()
+    stream_iter = async_recorded_stream_iter(conv, model_api_dict, temperature, top_p, max_new_tokens, stream_iter)
+
+    # queue behind the rate limiter before the breaker and the metrics start timing the request
+    stream_iter = timed_async_stream_iter(model_name, model_api_dict, stream_iter)
+    return async_rate_limited_stream_iter(
+        model_api_dict, conv, max_new_tokens, track_async_stream_iter(model_name, stream_iter)
+    )
+
+
+async def async_complete(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state=None,
+):
+    """Async counterpart of `api_provider_game.complete`."""
+    start = time.perf_counter()
+    if model_api_dict["api_type"] in NON_STREAMING_API_TYPES:
+        result = await async_call_with_retry(
+            lambda: async_balanced_call(
+                region_router.route(model_api_dict),
+                lambda member_api_dict: async_rate_limited_call(
+                    member_api_dict,
+                    conv,
+                    max_new_tokens,
+                    lambda: provider_async_complete(
+                        conv, model_name, member_api_dict, temperature, top_p, max_new_tokens
+                    ),
+                ),
+            ),
+            RetryPolicy.for_endpoint(model_api_dict),
+            model_name=model_name,
+        )
+    else:
+        text, final = await async_collect_stream(
+            get_api_provider_async_delta_iter(
+                conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state
+            )
+        )
+        final = final or completion_record()
+        result = CompletionResult(
+            text, final["finish_reason"], final["usage"], attempts=final.get("attempts", 1)
+        )
+    result.latency = time.perf_counter() - start
+    return result
+
+
+async def provider_async_complete(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens):
+    """One non-streaming request, reported to the model's circuit breaker."""
+    api_type = model_api_dict["api_type"]
+    start = time.perf_counter()
+    stop = model_api_dict.get("stop")
+    try:
+        if api_type == "openai":
+            prompt = conv.to_openai_api_messages(model_name=model_api_dict["model_name"])
+            result = await openai_api_async_complete(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_base=model_api_dict.get("api_base"),
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type in OPENAI_COMPATIBLE_APIS:
+            prompt = conv.to_openai_api_messages()
+            result = await openai_compatible_api_async_complete(
+                api_type,
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_base=model_api_dict.get("api_base"),
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type == "anthropic_message":
+            prompt = conv.to_openai_api_messages()
+            result = await anthropic_message_api_async_complete(
+                model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens, stop=stop,
+                api_key=model_api_dict.get("api_key"),
+            )
+        elif api_type == "gemini":
+            prompt = conv.to_gemini_api_messages()
+            result = await gemini_api_async_complete(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type == "mistral":
+            prompt = conv.to_openai_api_messages()
+            result = await mistral_api_async_complete(
+                model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type == "sambanova":
+            prompt = conv.to_openai_api_messages()
+            result = await sambanova_api_async_complete(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        else:
+            raise NotImplementedError()
+    except Exception as e:
+        model_health.record_failure(model_name, e)
+        record_complete(model_name, model_api_dict, start, error=e)
+        raise
+    model_health.record_success(model_name)
+    record_complete(model_name, model_api_dict, start, result)
+    await async_record_result(
+        conv, model_api_dict, temperature, top_p, max_new_tokens, result, time.perf_counter() - start
+    )
+    return result
+
+
+async def iterate_in_threadpool(iterator):
+    """Drive a blocking stream iterator from a worker thread, one item at a time."""
+    sentinel = object()
+    while True:
+        data = await asyncio.to_thread(next, iterator, sentinel)
+        if data is sentinel:
+            break
+        yield data
+
+
+async def _openai_chat_async_delta_iter(
+    client, model_name, messages, temperature, max_new_tokens, include_usage=True, stop=None
+):
+    extra_params = {"stream_options": {"include_usage": True}} if include_usage else {}
+    # max_new_tokens is None for o1/o3 reasoning models, which reject max_tokens
+    if max_new_tokens is not None:
+        res = await client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_new_tokens,
+            stream=True,
+            **extra_params,
+            **stop_params(stop),
+        )
+    else:
+        res = await client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            **extra_params,
+        )
+    finish_reason = None
+    usage = None
+    try:
+        async for chunk in res:
+            # with stream_options.include_usage the last chunk has usage and no choices
+            if getattr(chunk, "usage", None) is not None:
+                usage = openai_usage_record(chunk.usage)
+            if len(chunk.choices) > 0:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield {"delta": content, "error_code": 0}
+                if chunk.choices[0].finish_reason is not None:
+                    finish_reason = chunk.choices[0].finish_reason
+    finally:
+        # a consumer that stops early must also stop the generation upstream
+        await res.close()
+    yield completion_record(finish_reason, usage)
+
+
+async def async_raise_for_stream_status(response):
+    """Raise `httpx.HTTPStatusError` for an error answer to a streamed request."""
+    if response.is_error:
+        await response.aread()
+        response.raise_for_status()
+
+
+async def _sse_chat_async_delta_iter(byte_chunks):
+    """Delta records from the raw byte chunks of an OpenAI-style SSE body."""
+    finish_reason = None
+    usage = None
+    async for data in aiter_sse_data(byte_chunks):
+        if data == SSE_DONE:
+            break
+        chunk = decode_chat_chunk(data)
+        if chunk.error is not None:
+            yield {"text": f"**API REQUEST ERROR** Reason: {chunk.error}.", "error_code": 1}
+            return
+        if chunk.usage:
+            usage = openai_usage_record(chunk.usage)
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.delta is not None and choice.delta.content:
+                yield {"delta": choice.delta.content, "error_code": 0}
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    yield completion_record(finish_reason, usage)
+
+
+async def openai_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    if api_key is None:
+        api_key = os.environ["OPENAI_API_KEY"]
+
+    if "azure" in model_name:
+        client = get_openai_client(
+            "azure_openai", api_base or "https://api.openai.com/v1", api_key, is_async=True, azure=True
+        )
+    else:
+        client = get_openai_client(
+            "openai", api_base or "https://api.openai.com/v1", api_key, is_async=True
+        )
+
+    if model_name == "gpt-4-turbo":
+        model_name = "gpt-4-1106-preview"
+
+    # Make requests
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    if "o1" in model_name or "o3" in model_name:
+        # reasoning models reject stop sequences as well as max_tokens
+        max_new_tokens = stop = None
+    else:
+        gen_params["max_new_tokens"] = max_new_tokens
+    logger.info(f"==== request ====\n{gen_params}")
+
+    # the pinned azure api version predates stream_options
+    async for data in _openai_chat_async_delta_iter(
+        client, model_name, messages, temperature, max_new_tokens,
+        include_usage="azure" not in model_name, stop=stop,
+    ):
+        yield data
+
+
+async def anthropic_api_async_delta_iter(model_name, prompt, temperature, top_p, max_new_tokens, api_key=None):
+    import anthropic
+
+    if api_key is None:
+        api_key = os.environ["ANTHROPIC_API_KEY"]
+    c = get_anthropic_client(api_key, is_async=True)
+
+    # Make requests
+    gen_params = {
+        "model": model_name,
+        "prompt": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    res = await c.completions.create(
+        prompt=prompt,
+        stop_sequences=[anthropic.HUMAN_PROMPT],
+        max_tokens_to_sample=max_new_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        model=model_name,
+        stream=True,
+    )
+    finish_reason = None
+    async for chunk in res:
+        if chunk.completion:
+            yield {"delta": chunk.completion, "error_code": 0}
+        finish_reason = chunk.stop_reason or finish_reason
+    yield completion_record(finish_reason)
+
+
+async def anthropic_message_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    vertex_ai=False,
+    stop=None,
+    api_key=None,
+):
+    if vertex_ai:
+        client = get_anthropic_client(None, is_async=True, vertex_ai=True)
+    else:
+        # the key of the entry (or of the balanced member serving this call)
+        client = get_anthropic_client(api_key or os.environ["ANTHROPIC_API_KEY"], is_async=True)
+
+    text_messages = []
+    for message in messages:
+        if type(message["content"]) == str:  # text-only model
+            text_messages.append(message)
+        # vision model not supported
+
+    # Make requests for logging
+    gen_params = {
+        "model": model_name,
+        "prompt": text_messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    system_prompt, messages = split_anthropic_system_prompt(messages)
+
+    async with client.messages.stream(
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_new_tokens,
+        messages=messages,
+        model=model_name,
+        system=system_prompt,
+        **stop_params(stop, "stop_sequences"),
+    ) as stream:
+        async for chunk in stream.text_stream:
+            yield {"delta": chunk, "error_code": 0}
+        message = await stream.get_final_message()
+    yield completion_record(
+        message.stop_reason,
+        anthropic_usage_record(message.usage),
+    )
+
+
+async def gemini_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_key=None,
+    use_stream=True,
+    stop=None,
+):
+    convo = gemini_chat_session(
+        model_name, messages, temperature, top_p, max_new_tokens, api_key=api_key, stop=stop
+    )
+
+    if use_stream:
+        response = await convo.send_message_async(messages[-1]["content"], stream=True)
+        chunk = None
+        try:
+            async for chunk in response:
+                yield {"delta": chunk.candidates[0].content.parts[0].text, "error_code": 0}
+        except Exception as e:
+            logger.error(f"==== error ====\n{e}")
+            reason = chunk.candidates if chunk is not None else e
+            yield {
+                "text": f"**API REQUEST ERROR** Reason: {reason}.",
+                "error_code": 1,
+            }
+            return
+        yield gemini_completion_record(chunk)
+    else:
+        try:
+            response = await convo.send_message_async(messages[-1]["content"], stream=False)
+            text = response.candidates[0].content.parts[0].text
+        except Exception as e:
+            logger.error(f"==== error ====\n{e}")
+            yield {
+                "text": f"**API REQUEST ERROR** Reason: {e}.",
+                "error_code": 1,
+            }
+            return
+        pos = 0
+        while pos < len(text):
+            # simulate token streaming
+            yield {"delta": text[pos:pos + 3], "error_code": 0}
+            pos += 3
+            await asyncio.sleep(0.001)
+        yield gemini_completion_record(response)
+
+
+async def ai2_api_async_delta_iter(
+    model_name,
+    model_id,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_key=None,
+    api_base=None,
+):
+    # get keys and needed values
+    ai2_key = api_key or os.environ.get("AI2_API_KEY")
+    api_base = api_base or "https://inferd.allen.ai/api/v1/infer"
+
+    # Make requests
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    # AI2 uses vLLM, which requires that `top_p` be 1.0 for greedy sampling:
+    # https://github.com/vllm-project/vllm/blob/v0.1.7/vllm/sampling_params.py#L156-L157
+    if temperature == 0.0 and top_p < 1.0:
+        raise ValueError("top_p must be 1 when temperature is 0.0")
+
+    client = client_pool.get_http_client("ai2", api_base, is_async=True)
+    async with client.stream(
+        "POST",
+        api_base,
+        timeout=RAW_HTTP_TIMEOUT,
+        headers={"Authorization": f"Bearer {ai2_key}"},
+        json={
+            "model_id": model_id,
+            # This input format is specific to the Tulu2 model. Other models
+            # may require different input formats. See the model's schema
+            # documentation on InferD for more information.
+            "input": {
+                "messages": messages,
+                "opts": {
+                    "max_tokens": max_new_tokens,
+                    "temperature": temperature,
+                    "top_p": top_p,
+                    "logprobs": 1,  # increase for more choices
+                },
+            },
+        },
+    ) as res:
+        if res.status_code != 200:
+            await res.aread()
+            logger.error(f"unexpected response ({res.status_code}): {res.text}")
+            raise ValueError("unexpected response from InferD", res)
+
+        async for part in aiter_json_lines(res.aiter_bytes()):
+            if "result" in part and "output" in part["result"]:
+                delta = "".join(part["result"]["output"]["text"])
+            else:
+                logger.error(f"unexpected part: {part}")
+                raise ValueError("empty result in InferD response")
+
+            yield {"delta": delta, "error_code": 0}
+    yield completion_record()
+
+
+async def mistral_api_async_delta_iter(
+    model_name, messages, temperature, top_p, max_new_tokens, prefix=False, api_key=None, stop=None
+):
+    if api_key is None:
+        api_key = os.environ["MISTRAL_API_KEY"]
+
+    client = get_mistral_client(api_key, is_async=True)
+
+    # Make requests
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    messages[-1]["prefix"] = True
+
+    res = await client.chat.stream_async(
+        model=model_name,
+        temperature=temperature,
+        messages=messages,
+        max_tokens=max_new_tokens,
+        top_p=top_p,
+        **stop_params(stop),
+    )
+
+    finish_reason = None
+    usage = None
+    async for chunk in res:
+        if chunk.data.choices[0].delta.content is not None:
+            yield {"delta": chunk.data.choices[0].delta.content, "error_code": 0}
+        finish_reason = chunk.data.choices[0].finish_reason or finish_reason
+        if chunk.data.usage is not None:
+            usage = openai_usage_record(chunk.data.usage)
+    yield completion_record(finish_reason, usage)
+
+
+async def nvidia_api_async_delta_iter(model_name, messages, temp, top_p, max_tokens, api_base, stop=None):
+    assert model_name in ["llama2-70b-steerlm-chat", "yi-34b-chat"]
+
+    api_key = os.environ["NVIDIA_API_KEY"]
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "accept": "text/event-stream",
+        "content-type": "application/json",
+    }
+    # nvidia api does not accept 0 temperature
+    if temp == 0.0:
+        temp = 0.0001
+
+    payload = {
+        "messages": messages,
+        "temperature": temp,
+        "top_p": top_p,
+        "max_tokens": max_tokens,
+        "seed": 42,
+        "stream": True,
+        **stop_params(stop),
+    }
+    logger.info(f"==== request ====\n{payload}")
+
+    client = client_pool.get_http_client("nvidia", api_base, is_async=True)
+    async with client.stream("POST", api_base, headers=headers, json=payload, timeout=RAW_HTTP_TIMEOUT) as response:
+        await async_raise_for_stream_status(response)
+        async for data in _sse_chat_async_delta_iter(response.aiter_bytes()):
+            yield data
+
+
+async def cohere_api_async_delta_iter(
+    client_name: str,
+    model_id: str,
+    messages: list,
+    temperature: Optional[
+        float
+    ] = None,  # The SDK or API handles None for all parameters following
+    top_p: Optional[float] = None,
+    max_new_tokens: Optional[int] = None,
+    api_key: Optional[str] = None,  # default is env var CO_API_KEY
+    api_base: Optional[str] = None,
+    stop: Optional[list] = None,
+):
+    import cohere
+
+    OPENAI_TO_COHERE_ROLE_MAP = {
+        "user": "User",
+        "assistant": "Chatbot",
+        "system": "System",
+    }
+
+    client = get_cohere_client(client_name, api_key, api_base, is_async=True)
+
+    # prepare and log requests
+    chat_history = [
+        dict(
+            role=OPENAI_TO_COHERE_ROLE_MAP[message["role"]], message=message["content"]
+        )
+        for message in messages[:-1]
+    ]
+    actual_prompt = messages[-1]["content"]
+
+    gen_params = {
+        "model": model_id,
+        "messages": messages,
+        "chat_history": chat_history,
+        "prompt": actual_prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    # make request and stream response
+    res = client.chat_stream(
+        message=actual_prompt,
+        chat_history=chat_history,
+        model=model_id,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        p=top_p,
+        **stop_params(stop, "stop_sequences"),
+    )
+    try:
+        final = completion_record()
+        async for streaming_item in res:
+            if streaming_item.event_type == "text-generation":
+                yield {"delta": streaming_item.text, "error_code": 0}
+            elif streaming_item.event_type == "stream-end":
+                final = cohere_completion_record(streaming_item)
+        yield final
+    except cohere.core.ApiError as e:
+        logger.error(f"==== error from cohere api: {e} ====")
+        yield {
+            "text": f"**API REQUEST ERROR** Reason: {e}",
+            "error_code": 1,
+        }
+
+
+async def vertex_api_async_delta_iter(model_name, messages, temperature, top_p, max_new_tokens, stop=None):
+    import vertexai
+    from vertexai import generative_models
+    from vertexai.generative_models import (
+        GenerationConfig,
+        GenerativeModel,
+    )
+
+    project_id = os.environ.get("GCP_PROJECT_ID", None)
+    location = os.environ.get("GCP_LOCATION", None)
+    vertexai.init(project=project_id, location=location)
+
+    text_messages = []
+    for message in messages:
+        if type(message) == str:
+            text_messages.append(message)
+
+    gen_params = {
+        "model": model_name,
+        "prompt": text_messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    safety_settings = [
+        generative_models.SafetySetting(
+            category=category,
+            threshold=generative_models.HarmBlockThreshold.BLOCK_NONE,
+        )
+        for category in (
+            generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+            generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+            generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        )
+    ]
+    generator = await GenerativeModel(model_name).generate_content_async(
+        messages,
+        stream=True,
+        generation_config=GenerationConfig(
+            top_p=top_p, max_output_tokens=max_new_tokens, temperature=temperature,
+            **stop_params(stop, "stop_sequences"),
+        ),
+        safety_settings=safety_settings,
+    )
+
+    chunk = None
+    async for chunk in generator:
+        # NOTE(chris): This may be a vertex api error, below is HOTFIX: https://github.com/googleapis/python-aiplatform/issues/3129
+        yield {"delta": chunk.candidates[0].content.parts[0]._raw_part.text, "error_code": 0}
+    yield gemini_completion_record(chunk)
+
+
+async def replicate_api_async_delta_iter(
+    model_name,
+    prompt_template,
+    prompt,
+    temperature=0.6,
+    top_p=0.9,
+    min_tokens=0,
+    presence_penalty=1.15,
+    api_key=None,
+):
+    import replicate
+
+    api_key = api_key or os.environ["REPLICATE_API_TOKEN"]
+
+    # Make requests
+    gen_params = {
+        "top_p": 0.9,
+        "prompt": prompt,
+        "min_tokens": min_tokens,
+        "temperature": 0.6,
+        "prompt_template": prompt_template,
+        "presence_penalty": presence_penalty
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    async for event in await replicate.async_stream(
+        model_name,
+        input=gen_params
+    ):
+        yield {"delta": str(event), "error_code": 0}
+    yield completion_record()
+
+
+async def sambanova_api_async_delta_iter(model_name, messages, temp, top_p, max_tokens, api_key=None, stop=None):
+    url, headers, payload = sambanova_api_request(
+        model_name, messages, temp, top_p, max_tokens, api_key=api_key, stop=stop
+    )
+    client = client_pool.get_http_client("sambanova", url, is_async=True)
+    async with client.stream("POST", url, headers=headers, json=payload, timeout=RAW_HTTP_TIMEOUT) as response:
+        await async_raise_for_stream_status(response)
+        async for data in _sse_chat_async_delta_iter(response.aiter_bytes()):
+            yield data
+
+
+async def _openai_compatible_async_delta_iter(
+    api_type,
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base,
+    api_key,
+    stop=None,
+):
+    client = get_openai_client(api_type, api_base, api_key, is_async=True)
+
+    # Make requests
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    # not every compatible endpoint accepts stream_options
+    async for data in _openai_chat_async_delta_iter(
+        client, model_name, messages, temperature, max_new_tokens,
+        include_usage=api_type != "yi", stop=stop,
+    ):
+        yield data
+
+
+def xai_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    return _openai_compatible_async_delta_iter(
+        "xai",
+        model_name,
+        messages,
+        temperature,
+        top_p,
+        max_new_tokens,
+        api_base=api_base or "https://api.x.ai/v1",
+        api_key=api_key or os.environ["XAI_API_KEY"],
+        stop=stop,
+    )
+
+
+def dashscope_qwen_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    return _openai_compatible_async_delta_iter(
+        "dashscope",
+        model_name,
+        messages,
+        temperature,
+        top_p,
+        max_new_tokens,
+        api_base=api_base or "https://dashscope-intl.aliyuncs.com/compatible-mode/v1",
+        api_key=api_key or os.environ["DASHSCOPE_API_KEY"],
+        stop=stop,
+    )
+
+
+def yi_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    return _openai_compatible_async_delta_iter(
+        "yi",
+        model_name,
+        messages,
+        temperature,
+        top_p,
+        max_new_tokens,
+        api_base=api_base or "https://api.lingyiwanwu.com/v1",
+        api_key=api_key or os.environ["YI_API_KEY"],
+        stop=stop,
+    )
+
+
+def deepseek_api_async_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    return _openai_compatible_async_delta_iter(
+        "deepseek",
+        model_name,
+        messages,
+        temperature,
+        top_p,
+        max_new_tokens,
+        api_base=api_base or "https://api.deepseek.com",
+        api_key=api_key or os.environ["DEEPSEEK_API_KEY"],
+        stop=stop,
+    )
+
+
+
+# ------------------------- non-streaming completions ------------------------- #
+
+async def openai_api_async_complete(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    if api_key is None:
+        api_key = os.environ["OPENAI_API_KEY"]
+
+    if "azure" in model_name:
+        client = get_openai_client(
+            "azure_openai", api_base or "https://api.openai.com/v1", api_key, is_async=True, azure=True
+        )
+    else:
+        client = get_openai_client(
+            "openai", api_base or "https://api.openai.com/v1", api_key, is_async=True
+        )
+
+    if model_name == "gpt-4-turbo":
+        model_name = "gpt-4-1106-preview"
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    reasoning_model = "o1" in model_name or "o3" in model_name
+    if not reasoning_model:
+        gen_params["max_new_tokens"] = max_new_tokens
+    logger.info(f"==== request ====\n{gen_params}")
+
+    if not reasoning_model:
+        res = await client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_new_tokens,
+            **stop_params(stop),
+        )
+    else:
+        res = await client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+        )
+    return chat_completion_result(res)
+
+
+async def openai_compatible_api_async_complete(
+    api_type,
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    default_api_base, api_key_env = OPENAI_COMPATIBLE_APIS[api_type]
+    client = get_openai_client(
+        api_type, api_base or default_api_base, api_key or os.environ[api_key_env], is_async=True
+    )
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    res = await client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        **stop_params(stop),
+    )
+    return chat_completion_result(res)
+
+
+async def anthropic_message_api_async_complete(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    vertex_ai=False,
+    stop=None,
+    api_key=None,
+):
+    if vertex_ai:
+        client = get_anthropic_client(None, is_async=True, vertex_ai=True)
+    else:
+        # the key of the entry (or of the balanced member serving this call)
+        client = get_anthropic_client(api_key or os.environ["ANTHROPIC_API_KEY"], is_async=True)
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    system_prompt, messages = split_anthropic_system_prompt(messages)
+    message = await client.messages.create(
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_new_tokens,
+        messages=messages,
+        model=model_name,
+        system=system_prompt,
+        **stop_params(stop, "stop_sequences"),
+    )
+    return anthropic_completion_result(message)
+
+
+async def gemini_api_async_complete(model_name, messages, temperature, top_p, max_new_tokens, api_key=None, stop=None):
+    convo = gemini_chat_session(
+        model_name, messages, temperature, top_p, max_new_tokens, api_key=api_key, stop=stop
+    )
+    response = await convo.send_message_async(messages[-1]["content"], stream=False)
+    return gemini_completion_result(response)
+
+
+async def mistral_api_async_complete(model_name, messages, temperature, top_p, max_new_tokens, api_key=None, stop=None):
+    if api_key is None:
+        api_key = os.environ["MISTRAL_API_KEY"]
+
+    client = get_mistral_client(api_key, is_async=True)
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    messages[-1]["prefix"] = True
+
+    res = await client.chat.complete_async(
+        model=model_name,
+        temperature=temperature,
+        messages=messages,
+        max_tokens=max_new_tokens,
+        top_p=top_p,
+        **stop_params(stop),
+    )
+    return chat_completion_result(res)
+
+
+async def sambanova_api_async_complete(model_name, messages, temp, top_p, max_tokens, api_key=None, stop=None):
+    url, headers, payload = sambanova_api_request(
+        model_name, messages, temp, top_p, max_tokens, api_key=api_key, stream=False, stop=stop
+    )
+    client = client_pool.get_http_client("sambanova", url, is_async=True)
+    response = await client.post(url, headers=headers, json=payload, timeout=RAW_HTTP_TIMEOUT)
+    response.raise_for_status()
+    return chat_completion_json_result(response.json())
+
+
+# legacy cumulative-text iterators: every record carries the whole response so far
+openai_api_async_stream_iter = async_cumulative(openai_api_async_delta_iter)
+anthropic_api_async_stream_iter = async_cumulative(anthropic_api_async_delta_iter)
+anthropic_message_api_async_stream_iter = async_cumulative(anthropic_message_api_async_delta_iter)
+gemini_api_async_stream_iter = async_cumulative(gemini_api_async_delta_iter)
+ai2_api_async_stream_iter = async_cumulative(ai2_api_async_delta_iter)
+mistral_api_async_stream_iter = async_cumulative(mistral_api_async_delta_iter)
+nvidia_api_async_stream_iter = async_cumulative(nvidia_api_async_delta_iter)
+cohere_api_async_stream_iter = async_cumulative(cohere_api_async_delta_iter)
+vertex_api_async_stream_iter = async_cumulative(vertex_api_async_delta_iter)
+replicate_api_async_stream_iter = async_cumulative(replicate_api_async_delta_iter)
+sambanova_api_async_stream_iter = async_cumulative(sambanova_api_async_delta_iter)
+xai_api_async_stream_iter = async_cumulative(xai_api_async_delta_iter)
+dashscope_qwen_api_async_stream_iter = async_cumulative(dashscope_qwen_api_async_delta_iter)
+yi_api_async_stream_iter = async_cumulative(yi_api_async_delta_iter)
+deepseek_api_async_stream_iter = async_cumulative(deepseek_api_async_delta_iter)
@@ -1,18 +1,379 @@
-"""Call API providers."""
+"""Call API providers.
 
+Providers yield delta records: `{"delta": <new text>, "error_code": 0}` per chunk,
+then one closing record from `completion_record()` carrying the finish reason and
+token usage. Errors are `{"text": <reason>, "error_code": 1}`, as before.
+
+The dispatchers retry transient provider errors within a per-turn deadline (see
+`RetryPolicy`); the closing record says how many `attempts` the turn took.
+
+The legacy cumulative protocol (`{"text": <whole response so far>}`) is still
+available through `get_api_provider_stream_iter` and the `*_api_stream_iter`
+names at the bottom of this module.
+"""
+
+import dataclasses
+import functools
 import json
 import os
 import random
 from typing import Optional
 import time
 
+import httpx
 import requests
 
 from fastchat.utils import build_logger
+from src.fschat.client_pool import (
+    RAW_HTTP_TIMEOUT,
+    client_pool,
+    get_anthropic_client,
+    get_cohere_client,
+    get_mistral_client,
+    get_openai_client,
+    gemini_model_cache,
+)
+from src.fschat.cassette import record_result, recorded_stream_iter, replay_delta_iter
+from src.fschat.key_balancer import balanced_call, balanced_stream_iter, is_balanced, provider_error_status
+from src.fschat.model_health import model_health, track_stream_iter
+from src.fschat.provider_metrics import record_complete, timed_stream_iter
+from src.fschat.rate_limiter import (
+    deadline_stream_iter,
+    rate_limited_call,
+    rate_limited_stream_iter,
+    start_deadline,
+)
+from src.fschat.region_router import has_regions, region_router
+from src.fschat.sse import SSE_DONE, decode_chat_chunk, iter_json_lines, iter_sse_data
 
 
 logger = build_logger("web_server", "web_server.log")
 
+
+def usage_record(
+    input_tokens=None,
+    output_tokens=None,
+    cached_input_tokens=None,
+    cache_creation_input_tokens=None,
+):
+    """Token usage of one call.
+
+    `input_tokens` counts every prompt token; `cached_input_tokens` of them were
+    read from the provider's prompt cache and `cache_creation_input_tokens` were
+    written to it (Anthropic only).
+    """
+    if input_tokens is None and output_tokens is None:
+        return None
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "cache_creation_input_tokens": cache_creation_input_tokens,
+    }
+
+
+def openai_usage_record(usage):
+    """usage_record from an OpenAI-style `usage`, SDK object or JSON dict."""
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    details = usage.get("prompt_tokens_details") or {}
+    # deepseek reports its context cache hits outside prompt_tokens_details
+    cached = details.get("cached_tokens", usage.get("prompt_cache_hit_tokens"))
+    return usage_record(usage.get("prompt_tokens"), usage.get("completion_tokens"), cached)
+
+
+def anthropic_usage_record(usage):
+    """usage_record from an Anthropic `usage`, whose input_tokens exclude cache reads and writes."""
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return usage_record(
+        usage.input_tokens + cache_read + cache_creation,
+        usage.output_tokens,
+        cache_read,
+        cache_creation,
+    )
+
+
+def completion_record(finish_reason=None, usage=None):
+    """Closing record of a delta stream."""
+    return {
+        "delta": "",
+        "error_code": 0,
+        "final": True,
+        "finish_reason": finish_reason,
+        "usage": usage,
+    }
+
+
+def stop_params(stop, name="stop"):
+    """Request kwargs for the stop sequences of a generation profile, if any."""
+    return {name: list(stop)} if stop else {}
+
+
+@dataclasses.dataclass
+class CompletionResult:
+    """Final text of a completion, as returned by `complete()`."""
+
+    text: str
+    finish_reason: Optional[str] = None
+    usage: Optional[dict] = None
+    latency: Optional[float] = None
+    attempts: int = 1
+    cached: bool = False
+    # served to a caller that joined an identical call in flight (see `singleflight`)
+    coalesced: bool = False
+
+    def to_record(self):
+        record = completion_record(self.finish_reason, self.usage)
+        record["latency"] = self.latency
+        record["attempts"] = self.attempts
+        record["cached"] = self.cached
+        record["coalesced"] = self.coalesced
+        return record
+
+
+def cumulative_stream_iter(delta_iter):
+    """Adapt a delta stream to the legacy cumulative-text protocol."""
+    text = ""
+    for data in delta_iter:
+        if data["error_code"] != 0:
+            yield data
+            continue
+        if data.get("final"):
+            continue
+        if data.get("reset"):
+            text = ""
+        text += data["delta"]
+        yield {"text": text, "error_code": 0}
+
+
+def delta_stream_iter(stream_iter):
+    """Adapt a cumulative-text stream to the delta protocol."""
+    prev = ""
+    for data in stream_iter:
+        if data["error_code"] != 0:
+            yield data
+            continue
+        text = data["text"]
+        if text.startswith(prev):
+            yield {"delta": text[len(prev):], "error_code": 0}
+        else:
+            # the provider rewrote text it already sent (e.g. citation links)
+            yield {"delta": text, "error_code": 0, "reset": True}
+        prev = text
+    yield completion_record()
+
+
+def cumulative(delta_iter_fn):
+    @functools.wraps(delta_iter_fn)
+    def stream_iter_fn(*args, **kwargs):
+        return cumulative_stream_iter(delta_iter_fn(*args, **kwargs))
+
+    return stream_iter_fn
+
+
+def decided_by(watchers, text):
+    """Name of the first stream watcher that considers `text` decisive, if any."""
+    for watcher in watchers:
+        if watcher(text):
+            return getattr(watcher, "__name__", repr(watcher))
+    return None
+
+
+def collect_stream(stream_iter, watchers=()):
+    """Drain a stream of either protocol, or unpack a `complete()` result.
+
+    Returns `(text, final)` where `final` is the closing completion record, or
+    None for cumulative streams.
+
+    `watchers` are callables on the text so far; once one returns True the
+    upstream stream is closed and the text collected up to there is returned,
+    with an `early_stop` finish reason.
+    """
+    if isinstance(stream_iter, CompletionResult):
+        return stream_iter.text, stream_iter.to_record()
+    parts = []
+    final = None
+    for data in stream_iter:
+        assert data["error_code"] == 0
+        if "delta" not in data:
+            parts = [data["text"]]
+        elif data.get("final"):
+            final = data
+            continue
+        else:
+            if data.get("reset"):
+                parts = []
+            parts.append(data["delta"])
+        watcher = decided_by(watchers, "".join(parts)) if watchers else None
+        if watcher is not None:
+            stream_iter.close()
+            logger.info(f"stream watcher {watcher} decided the turn; stopped the stream early")
+            final = completion_record("early_stop")
+            break
+    return "".join(parts), final
+
+
+# a turn must finish well inside the Roblox HttpService timeout (30s)
+TURN_DEADLINE_SECONDS = float(os.environ.get("TURN_DEADLINE_SECONDS", 25.0))
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# providers that report failures as error records (gemini, bard, cohere) only
+# leave the reason text to go on
+RETRYABLE_ERROR_MARKERS = (
+    "429",
+    "500",
+    "502",
+    "503",
+    "504",
+    "rate limit",
+    "rate_limit",
+    "resource_exhausted",
+    "resource has been exhausted",
+    "overloaded",
+    "unavailable",
+    "timed out",
+    "timeout",
+    "connection reset",
+)
+# retrying these would repeat a side effect (posting to an assistant thread)
+NON_IDEMPOTENT_API_TYPES = {"openai_assistant"}
+
+
+def _retry_after(response):
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # an HTTP date; fall back to our own backoff
+    return None
+
+
+def classify_provider_error(error):
+    """Return `(retryable, retry_after)` for a provider exception or error record."""
+    if isinstance(error, dict):
+        reason = str(error.get("text", "")).lower()
+        return any(marker in reason for marker in RETRYABLE_ERROR_MARKERS), None
+
+    response = getattr(error, "response", None)
+    status = provider_error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES, _retry_after(response)
+
+    if isinstance(
+        error,
+        (ConnectionError, TimeoutError, httpx.TransportError, requests.ConnectionError, requests.Timeout),
+    ):
+        return True, None
+    # openai/anthropic APIConnectionError and APITimeoutError wrap the httpx error
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError"), None
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    """Jittered exponential backoff inside an overall deadline.
+
+    An endpoint can override the defaults with a `retry` block in its
+    api_endpoint config, e.g. `"retry": {"max_attempts": 2}`.
+    """
+
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 4.0
+    deadline: float = TURN_DEADLINE_SECONDS
+    # never start an attempt with less budget left than this
+    min_attempt_budget: float = 3.0
+
+    @classmethod
+    def for_endpoint(cls, model_api_dict):
+        policy = cls(**model_api_dict.get("retry", {}))
+        if model_api_dict["api_type"] in NON_IDEMPOTENT_API_TYPES:
+            policy.max_attempts = 1
+        return policy
+
+    def next_delay(self, attempt, error, started):
+        """Seconds to sleep before attempt `attempt + 1`, or None to give up."""
+        retryable, retry_after = classify_provider_error(error)
+        if not retryable or attempt >= self.max_attempts:
+            return None
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = backoff / 2 + random.uniform(0, backoff / 2)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        remaining = self.deadline - (time.monotonic() - started)
+        if delay + self.min_attempt_budget > remaining:
+            return None
+        return delay
+
+    def latest_start(self, started):
+        """Latest `time.monotonic()` an attempt of a call begun at `started` may send its request
+        at; the rate limiter queues it no longer than that."""
+        return started + self.deadline - self.min_attempt_budget
+
+
+def retry_delta_iter(stream_iter_fn, policy, model_name=None):
+    """Run the delta stream from `stream_iter_fn()`, retrying transient failures.
+
+    A retry after chunks went out is preceded by a reset record so collectors
+    drop the partial text. The closing record carries `attempts`; a failure that
+    is not retried is raised or yielded unchanged.
+    """
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        emitted = False
+        try:
+            for data in deadline_stream_iter(policy.latest_start(started), stream_iter_fn()):
+                if data["error_code"] != 0:
+                    error = data
+                    break
+                if data.get("final"):
+                    data = {**data, "attempts": attempt}
+                emitted = True
+                yield data
+            else:
+                return
+        except Exception as e:
+            error = e
+        delay = policy.next_delay(attempt, error, started)
+        if delay is None:
+            if isinstance(error, Exception):
+                raise error
+            yield error
+            return
+        logger.warning(f"{model_name}: attempt {attempt} failed ({error}), retrying in {delay:.2f}s")
+        if emitted:
+            yield {"delta": "", "error_code": 0, "reset": True}
+        time.sleep(delay)
+
+
+def call_with_retry(fn, policy, model_name=None):
+    """Call `fn()` (returning a `CompletionResult`) with the retry policy applied."""
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            with start_deadline(policy.latest_start(started)):
+                result = fn()
+        except Exception as e:
+            delay = policy.next_delay(attempt, e, started)
+            if delay is None:
+                raise
+            logger.warning(f"{model_name}: attempt {attempt} failed ({e}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        result.attempts = attempt
+        return result
+
+
 def get_api_provider_stream_iter(
     conv,
     model_name,
@@ -22,19 +383,69 @@ def get_api_provider_stream_iter(
     max_new_tokens,
     state,
 ):
+    return cumulative_stream_iter(
+        get_api_provider_delta_iter(
+            conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state
+        )
+    )
+
+
+def get_api_provider_delta_iter(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+):
+    return retry_delta_iter(
+        lambda: provider_delta_iter(
+            conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state
+        ),
+        RetryPolicy.for_endpoint(model_api_dict),
+        model_name=model_name,
+    )
+
+
+def provider_delta_iter(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+):
+    """Dispatch one request to the provider of `model_api_dict`, without retries."""
+    if has_regions(model_api_dict):
+        # every attempt goes to the region the prober currently prefers
+        return provider_delta_iter(
+            conv, model_name, region_router.route(model_api_dict), temperature, top_p, max_new_tokens, state
+        )
+    if is_balanced(model_api_dict):
+        # pick one of the entry's keys/bases for this attempt
+        return balanced_stream_iter(
+            model_api_dict,
+            lambda member_api_dict: provider_delta_iter(
+                conv, model_name, member_api_dict, temperature, top_p, max_new_tokens, state
+            ),
+        )
     if model_api_dict["api_type"] == "openai":
         prompt = conv.to_openai_api_messages(model_name=model_api_dict["model_name"])
-        stream_iter = openai_api_stream_iter(
+        stream_iter = openai_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "openai_assistant":
         last_prompt = conv.messages[-2][1]
-        stream_iter = openai_assistant_api_stream_iter(
+        stream_iter = openai_assistant_api_delta_iter(
             state,
             last_prompt,
             assistant_id=model_api_dict["assistant_id"],
@@ -42,27 +453,29 @@ def get_api_provider_stream_iter(
         )
     elif model_api_dict["api_type"] == "anthropic":
         prompt = conv.to_openai_api_messages()
-        stream_iter = anthropic_api_stream_iter(
+        stream_iter = anthropic_api_delta_iter(
             model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"],
         )
     elif model_api_dict["api_type"] == "anthropic_message":
         prompt = conv.to_openai_api_messages()
-        stream_iter = anthropic_message_api_stream_iter(
-            model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens
+        stream_iter = anthropic_message_api_delta_iter(
+            model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens,
+            stop=model_api_dict.get("stop"), api_key=model_api_dict.get("api_key"),
         )
     elif model_api_dict["api_type"] == "gemini":
         prompt = conv.to_gemini_api_messages()
-        stream_iter = gemini_api_stream_iter(
+        stream_iter = gemini_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "bard":
         prompt = conv.to_openai_api_messages()
-        stream_iter = bard_api_stream_iter(
+        stream_iter = bard_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
@@ -71,22 +484,24 @@ def get_api_provider_stream_iter(
         )
     elif model_api_dict["api_type"] == "mistral":
         prompt = conv.to_openai_api_messages()
-        stream_iter = mistral_api_stream_iter(
-            model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"]
+        stream_iter = mistral_api_delta_iter(
+            model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "nvidia":
         prompt = conv.to_openai_api_messages()
-        stream_iter = nvidia_api_stream_iter(
+        stream_iter = nvidia_api_delta_iter(
             model_name,
             prompt,
             temperature,
             top_p,
             max_new_tokens,
             model_api_dict["api_base"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "ai2":
         prompt = conv.to_openai_api_messages()
-        stream_iter = ai2_api_stream_iter(
+        stream_iter = ai2_api_delta_iter(
             model_name,
             model_api_dict["model_name"],
             prompt,
@@ -98,7 +513,7 @@ def get_api_provider_stream_iter(
         )
     elif model_api_dict["api_type"] == "cohere":
         messages = conv.to_openai_api_messages()
-        stream_iter = cohere_api_stream_iter(
+        stream_iter = cohere_api_delta_iter(
             client_name=model_api_dict.get("client_name", "FastChat"),
             model_id=model_api_dict["model_name"],
             messages=messages,
@@ -107,17 +522,18 @@ def get_api_provider_stream_iter(
             max_new_tokens=max_new_tokens,
             api_base=model_api_dict["api_base"],
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "vertex":
         prompt = conv.to_vertex_api_messages()
-        stream_iter = vertex_api_stream_iter(
-            model_name, prompt, temperature, top_p, max_new_tokens
+        stream_iter = vertex_api_delta_iter(
+            model_name, prompt, temperature, top_p, max_new_tokens, stop=model_api_dict.get("stop")
         )
     elif model_api_dict["api_type"] == "replicate":
         prompt = conv.to_replicate_api_messages()
         propmt_template = "{prompt}"
 
-        stream_iter = replicate_api_stream_iter(
+        stream_iter = replicate_api_delta_iter(
             model_name=model_api_dict["model_name"],
             prompt_template=propmt_template,
             prompt=prompt,
@@ -129,61 +545,293 @@ def get_api_provider_stream_iter(
         )
     elif model_api_dict["api_type"] == "sambanova":
         prompt = conv.to_openai_api_messages()
-        stream_iter = sambanova_api_stream_iter(
+        stream_iter = sambanova_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "xai":
         prompt = conv.to_openai_api_messages()
-        stream_iter = xai_api_stream_iter(
+        stream_iter = xai_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "dashscope":
         prompt = conv.to_openai_api_messages()
-        stream_iter = dashscope_qwen_api_stream_iter(
+        stream_iter = dashscope_qwen_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "yi":
         prompt = conv.to_openai_api_messages()
-        stream_iter = yi_api_stream_iter(
+        stream_iter = yi_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
         )
     elif model_api_dict["api_type"] == "deepseek":
         prompt = conv.to_openai_api_messages()
-        stream_iter = deepseek_api_stream_iter(
+        stream_iter = deepseek_api_delta_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
             top_p,
             max_new_tokens,
+            api_base=model_api_dict.get("api_base"),
             api_key=model_api_dict["api_key"],
+            stop=model_api_dict.get("stop"),
+        )
+    elif model_api_dict["api_type"] == "mock":
+        from src.fschat.mock_provider import mock_api_delta_iter
+
+        prompt = conv.to_openai_api_messages()
+        stream_iter = mock_api_delta_iter(
+            prompt, max_new_tokens, model_api_dict.get("mock"), stop=model_api_dict.get("stop")
         )
+    elif model_api_dict["api_type"] == "replay":
+        stream_iter = replay_delta_iter(conv, model_api_dict, temperature, top_p, max_new_tokens)
     else:
         raise NotImplementedError()
+    stream_iter = recorded_stream_iter(conv, model_api_dict, temperature, top_p, max_new_tokens, stream_iter)
 
-    return stream_iter
+    # queue behind the rate limiter before the breaker and the metrics start timing the request
+    stream_iter = timed_stream_iter(model_name, model_api_dict, stream_iter)
+    return rate_limited_stream_iter(
+        model_api_dict, conv, max_new_tokens, track_stream_iter(model_name, stream_iter)
+    )
 
 
-def openai_api_stream_iter(
+# default endpoint and api key env var of the OpenAI-compatible providers
+OPENAI_COMPATIBLE_APIS = {
+    "xai": ("https://api.x.ai/v1", "XAI_API_KEY"),
+    "dashscope": ("https://dashscope-intl.aliyuncs.com/compatible-mode/v1", "DASHSCOPE_API_KEY"),
+    "yi": ("https://api.lingyiwanwu.com/v1", "YI_API_KEY"),
+    "deepseek": ("https://api.deepseek.com", "DEEPSEEK_API_KEY"),
+}
+# api_types `complete()` calls without streaming
+NON_STREAMING_API_TYPES = {
+    "openai",
+    "anthropic_message",
+    "gemini",
+    "mistral",
+    "sambanova",
+    *OPENAI_COMPATIBLE_APIS,
+}
+
+
+def complete(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state=None,
+):
+    """Non-streaming counterpart of `get_api_provider_delta_iter`.
+
+    Uses the provider's non-streaming endpoint when it has one and drains the
+    delta stream otherwise. Returns a `CompletionResult`; it can be passed
+    anywhere a stream iterator fn is accepted by the game classes.
+    """
+    start = time.perf_counter()
+    if model_api_dict["api_type"] in NON_STREAMING_API_TYPES:
+        result = call_with_retry(
+            lambda: balanced_call(
+                region_router.route(model_api_dict),
+                lambda member_api_dict: rate_limited_call(
+                    member_api_dict,
+                    conv,
+                    max_new_tokens,
+                    lambda: provider_complete(
+                        conv, model_name, member_api_dict, temperature, top_p, max_new_tokens
+                    ),
+                ),
+            ),
+            RetryPolicy.for_endpoint(model_api_dict),
+            model_name=model_name,
+        )
+    else:
+        text, final = collect_stream(
+            get_api_provider_delta_iter(
+                conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state
+            )
+        )
+        final = final or completion_record()
+        result = CompletionResult(
+            text, final["finish_reason"], final["usage"], attempts=final.get("attempts", 1)
+        )
+    result.latency = time.perf_counter() - start
+    return result
+
+
+def provider_complete(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens):
+    """One non-streaming request, reported to the model's circuit breaker."""
+    api_type = model_api_dict["api_type"]
+    start = time.perf_counter()
+    stop = model_api_dict.get("stop")
+    try:
+        if api_type == "openai":
+            prompt = conv.to_openai_api_messages(model_name=model_api_dict["model_name"])
+            result = openai_api_complete(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_base=model_api_dict.get("api_base"),
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type in OPENAI_COMPATIBLE_APIS:
+            prompt = conv.to_openai_api_messages()
+            result = openai_compatible_api_complete(
+                api_type,
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_base=model_api_dict.get("api_base"),
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type == "anthropic_message":
+            prompt = conv.to_openai_api_messages()
+            result = anthropic_message_api_complete(
+                model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens, stop=stop,
+                api_key=model_api_dict.get("api_key"),
+            )
+        elif api_type == "gemini":
+            prompt = conv.to_gemini_api_messages()
+            result = gemini_api_complete(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type == "mistral":
+            prompt = conv.to_openai_api_messages()
+            result = mistral_api_complete(
+                model_name, prompt, temperature, top_p, max_new_tokens, api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        elif api_type == "sambanova":
+            prompt = conv.to_openai_api_messages()
+            result = sambanova_api_complete(
+                model_api_dict["model_name"],
+                prompt,
+                temperature,
+                top_p,
+                max_new_tokens,
+                api_key=model_api_dict["api_key"],
+                stop=stop,
+            )
+        else:
+            raise NotImplementedError()
+    except Exception as e:
+        model_health.record_failure(model_name, e)
+        record_complete(model_name, model_api_dict, start, error=e)
+        raise
+    model_health.record_success(model_name)
+    record_complete(model_name, model_api_dict, start, result)
+    record_result(
+        conv, model_api_dict, temperature, top_p, max_new_tokens, result, time.perf_counter() - start
+    )
+    return result
+
+
+def _openai_chat_delta_iter(res):
+    finish_reason = None
+    usage = None
+    try:
+        for chunk in res:
+            # with stream_options.include_usage the last chunk has usage and no choices
+            if getattr(chunk, "usage", None) is not None:
+                usage = openai_usage_record(chunk.usage)
+            if len(chunk.choices) > 0:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield {"delta": content, "error_code": 0}
+                if chunk.choices[0].finish_reason is not None:
+                    finish_reason = chunk.choices[0].finish_reason
+    finally:
+        # a consumer that stops early must also stop the generation upstream
+        res.close()
+    yield completion_record(finish_reason, usage)
+
+
+def raise_for_stream_status(response):
+    """Raise `httpx.HTTPStatusError` for an error answer to a streamed request."""
+    if response.is_error:
+        response.read()
+        response.raise_for_status()
+
+
+def _sse_chat_delta_iter(byte_chunks):
+    """Delta records from the raw byte chunks of an OpenAI-style SSE body."""
+    finish_reason = None
+    usage = None
+    for data in iter_sse_data(byte_chunks):
+        if data == SSE_DONE:
+            break
+        chunk = decode_chat_chunk(data)
+        if chunk.error is not None:
+            yield {"text": f"**API REQUEST ERROR** Reason: {chunk.error}.", "error_code": 1}
+            return
+        if chunk.usage:
+            usage = openai_usage_record(chunk.usage)
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.delta is not None and choice.delta.content:
+                yield {"delta": choice.delta.content, "error_code": 0}
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    yield completion_record(finish_reason, usage)
+
+
+def gemini_completion_record(chunk):
+    if chunk is None:
+        return completion_record()
+    finish_reason = None
+    if chunk.candidates and chunk.candidates[0].finish_reason:
+        finish_reason = getattr(chunk.candidates[0].finish_reason, "name", str(chunk.candidates[0].finish_reason))
+    usage = None
+    metadata = getattr(chunk, "usage_metadata", None)
+    if metadata is not None:
+        usage = usage_record(
+            metadata.prompt_token_count,
+            metadata.candidates_token_count,
+            getattr(metadata, "cached_content_token_count", None),
+        )
+    return completion_record(finish_reason, usage)
+
+
+def openai_api_delta_iter(
     model_name,
     messages,
     temperature,
@@ -191,22 +839,17 @@ def openai_api_stream_iter(
     max_new_tokens,
     api_base=None,
     api_key=None,
+    stop=None,
 ):
-    import openai
-
     if api_key is None:
         api_key = os.environ["OPENAI_API_KEY"]
 
     if "azure" in model_name:
-        client = openai.AzureOpenAI(
-            api_version="2023-07-01-preview",
-            azure_endpoint=api_base or "https://api.openai.com/v1",
-            api_key=api_key,
+        client = get_openai_client(
+            "azure_openai", api_base or "https://api.openai.com/v1", api_key, azure=True
         )
     else:
-        client = openai.OpenAI(
-            base_url=api_base or "https://api.openai.com/v1", api_key=api_key
-        )
+        client = get_openai_client("openai", api_base or "https://api.openai.com/v1", api_key)
 
     if model_name == "gpt-4-turbo":
         model_name = "gpt-4-1106-preview"
@@ -229,6 +872,8 @@ def openai_api_stream_iter(
         }
     logger.info(f"==== request ====\n{gen_params}")
 
+    # the pinned azure api version predates stream_options
+    extra_params = {} if "azure" in model_name else {"stream_options": {"include_usage": True}}
     if "o1" not in model_name and "o3" not in model_name:
         res = client.chat.completions.create(
             model=model_name,
@@ -236,6 +881,8 @@ def openai_api_stream_iter(
             temperature=temperature,
             max_tokens=max_new_tokens,
             stream=True,
+            **extra_params,
+            **stop_params(stop),
         )
     else:
         res = client.chat.completions.create(
@@ -243,28 +890,31 @@ def openai_api_stream_iter(
             messages=messages,
             temperature=temperature,
             stream=True,
+            **extra_params,
         )
-    text = ""
-    for chunk in res:
-        if len(chunk.choices) > 0:
-            text += chunk.choices[0].delta.content or ""
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+    yield from _openai_chat_delta_iter(res)
 
-def openai_assistant_api_stream_iter(
+def openai_assistant_api_delta_iter(
     state,
     prompt,
     assistant_id,
     api_key=None,
 ):
-    import openai
-    import base64
+    # annotations rewrite text that was already streamed, so the assistant stream
+    # is built cumulatively and diffed into deltas
+    return delta_stream_iter(
+        _openai_assistant_api_cumulative_iter(state, prompt, assistant_id, api_key=api_key)
+    )
+
 
+def _openai_assistant_api_cumulative_iter(
+    state,
+    prompt,
+    assistant_id,
+    api_key=None,
+):
     api_key = api_key or os.environ["OPENAI_API_KEY"]
-    client = openai.OpenAI(base_url="https://api.openai.com/v1", api_key=api_key)
+    client = get_openai_client("openai", "https://api.openai.com/v1", api_key)
 
     if state.oai_thread_id is None:
         logger.info("==== create thread ====")
@@ -394,12 +1044,12 @@ def openai_assistant_api_stream_iter(
             yield {"text": full_ret_text, "error_code": 0}
 
 
-def anthropic_api_stream_iter(model_name, prompt, temperature, top_p, max_new_tokens, api_key=None):
+def anthropic_api_delta_iter(model_name, prompt, temperature, top_p, max_new_tokens, api_key=None):
     import anthropic
 
     if api_key is None:
         api_key = os.environ["ANTHROPIC_API_KEY"]
-    c = anthropic.Anthropic(api_key=api_key)
+    c = get_anthropic_client(api_key)
 
     # Make requests
     gen_params = {
@@ -420,36 +1070,71 @@ def anthropic_api_stream_iter(model_name, prompt, temperature, top_p, max_new_to
         model=model_name,
         stream=True,
     )
-    text = ""
+    finish_reason = None
     for chunk in res:
-        text += chunk.completion
-        data = {
-            "text": text,
-            "error_code": 0,
-        }
-        yield data
+        if chunk.completion:
+            yield {"delta": chunk.completion, "error_code": 0}
+        finish_reason = chunk.stop_reason or finish_reason
+    yield completion_record(finish_reason)
+
+# cache_control breakpoints on the (several KB, per-game constant) system prompt
+# and on the conversation so far; prefixes below the model's minimum cacheable
+# length are simply not cached
+ANTHROPIC_PROMPT_CACHING = os.environ.get("ANTHROPIC_PROMPT_CACHING", "1") == "1"
+
+
+def _with_cache_control(content):
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return content
+
+
+def split_anthropic_system_prompt(messages, prompt_caching=None):
+    """The messages API takes the system prompt as a separate parameter.
+
+    With prompt caching the system prompt gets a cache breakpoint, and so does
+    the last message of a multi-turn conversation, so every turn reads the
+    previous turn's prefix from the cache.
+    """
+    if prompt_caching is None:
+        prompt_caching = ANTHROPIC_PROMPT_CACHING
+    system_prompt = ""
+    if messages[0]["role"] == "system":
+        if type(messages[0]["content"]) == dict:
+            system_prompt = messages[0]["content"]["text"]
+        elif type(messages[0]["content"]) == str:
+            system_prompt = messages[0]["content"]
+        # remove system prompt
+        messages = messages[1:]
+    if not prompt_caching:
+        return system_prompt, messages
+
+    if system_prompt:
+        system_prompt = _with_cache_control(system_prompt)
+    if len(messages) > 1:
+        messages = messages[:-1] + [
+            {**messages[-1], "content": _with_cache_control(messages[-1]["content"])}
+        ]
+    return system_prompt, messages
 
-def anthropic_message_api_stream_iter(
+
+def anthropic_message_api_delta_iter(
     model_name,
     messages,
     temperature,
     top_p,
     max_new_tokens,
     vertex_ai=False,
+    stop=None,
+    api_key=None,
 ):
-    import anthropic
-
     if vertex_ai:
-        client = anthropic.AnthropicVertex(
-            region=os.environ["GCP_LOCATION"],
-            project_id=os.environ["GCP_PROJECT_ID"],
-            max_retries=5,
-        )
+        client = get_anthropic_client(None, vertex_ai=True)
     else:
-        client = anthropic.Anthropic(
-            api_key=os.environ["ANTHROPIC_API_KEY"],
-            max_retries=5,
-        )
+        # the key of the entry (or of the balanced member serving this call)
+        client = get_anthropic_client(api_key or os.environ["ANTHROPIC_API_KEY"])
 
     text_messages = []
     for message in messages:
@@ -467,16 +1152,8 @@ def anthropic_message_api_stream_iter(
     }
     logger.info(f"==== request ====\n{gen_params}")
 
-    system_prompt = ""
-    if messages[0]["role"] == "system":
-        if type(messages[0]["content"]) == dict:
-            system_prompt = messages[0]["content"]["text"]
-        elif type(messages[0]["content"]) == str:
-            system_prompt = messages[0]["content"]
-        # remove system prompt
-        messages = messages[1:]
+    system_prompt, messages = split_anthropic_system_prompt(messages)
 
-    text = ""
     with client.messages.stream(
         temperature=temperature,
         top_p=top_p,
@@ -484,34 +1161,34 @@ def anthropic_message_api_stream_iter(
         messages=messages,
         model=model_name,
         system=system_prompt,
+        **stop_params(stop, "stop_sequences"),
     ) as stream:
         for chunk in stream.text_stream:
-            text += chunk
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+            yield {"delta": chunk, "error_code": 0}
+        message = stream.get_final_message()
+    yield completion_record(
+        message.stop_reason,
+        anthropic_usage_record(message.usage),
+    )
 
-def gemini_api_stream_iter(
-    model_name,
-    messages,
-    temperature,
-    top_p,
-    max_new_tokens,
-    api_key=None,
-    use_stream=True,
-):
-    import google.generativeai as genai  # pip install google-generativeai
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
 
+
+def gemini_chat_session(model_name, messages, temperature, top_p, max_new_tokens, api_key=None, stop=None):
+    """Start a Gemini chat holding every message but the last one."""
     if api_key is None:
         api_key = os.environ["GEMINI_API_KEY"]
-    genai.configure(api_key=api_key)
 
     generation_config = {
         "temperature": temperature,
         "max_output_tokens": max_new_tokens,
         "top_p": top_p,
+        **stop_params(stop, "stop_sequences"),
     }
     params = {
         "model": model_name,
@@ -520,13 +1197,6 @@ def gemini_api_stream_iter(
     params.update(generation_config)
     logger.info(f"==== request ====\n{params}")
 
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
-
     history = []
     system_prompt = None
     for message in messages[:-1]:
@@ -535,32 +1205,39 @@ def gemini_api_stream_iter(
             continue
         history.append({"role": message["role"], "parts": message["content"]})
 
-    model = genai.GenerativeModel(
-        model_name=model_name,
-        system_instruction=system_prompt,
-        generation_config=generation_config,
-        safety_settings=safety_settings,
+    model = gemini_model_cache.get(model_name, api_key, system_prompt, generation_config, GEMINI_SAFETY_SETTINGS)
+    return model.start_chat(history=history)
+
+
+def gemini_api_delta_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_key=None,
+    use_stream=True,
+    stop=None,
+):
+    convo = gemini_chat_session(
+        model_name, messages, temperature, top_p, max_new_tokens, api_key=api_key, stop=stop
     )
-    convo = model.start_chat(history=history)
 
     if use_stream:
         response = convo.send_message(messages[-1]["content"], stream=True)
+        chunk = None
         try:
-            text = ""
             for chunk in response:
-                text += chunk.candidates[0].content.parts[0].text
-                data = {
-                    "text": text,
-                    "error_code": 0,
-                }
-                yield data
+                yield {"delta": chunk.candidates[0].content.parts[0].text, "error_code": 0}
         except Exception as e:
             logger.error(f"==== error ====\n{e}")
-            reason = chunk.candidates
+            reason = chunk.candidates if chunk is not None else e
             yield {
                 "text": f"**API REQUEST ERROR** Reason: {reason}.",
                 "error_code": 1,
             }
+            return
+        yield gemini_completion_record(chunk)
     else:
         try:
             response = convo.send_message(messages[-1]["content"], stream=False)
@@ -568,13 +1245,10 @@ def gemini_api_stream_iter(
             pos = 0
             while pos < len(text):
                 # simulate token streaming
+                yield {"delta": text[pos:pos + 3], "error_code": 0}
                 pos += 3
                 time.sleep(0.001)
-                data = {
-                    "text": text[:pos],
-                    "error_code": 0,
-                }
-                yield data
+            yield gemini_completion_record(response)
         except Exception as e:
             logger.error(f"==== error ====\n{e}")
             yield {
@@ -583,7 +1257,7 @@ def gemini_api_stream_iter(
             }
 
 
-def bard_api_stream_iter(model_name, conv, temperature, top_p, api_key=None):
+def bard_api_delta_iter(model_name, conv, temperature, top_p, api_key=None):
     del top_p  # not supported
     del temperature  # not supported
 
@@ -622,6 +1296,7 @@ def bard_api_stream_iter(model_name, conv, temperature, top_p, api_key=None):
             "text": f"**API REQUEST ERROR** Reason: {e}.",
             "error_code": 1,
         }
+        return
 
     if res.status_code != 200:
         logger.error(f"==== error ==== ({res.status_code}): {res.text}")
@@ -629,6 +1304,7 @@ def bard_api_stream_iter(model_name, conv, temperature, top_p, api_key=None):
             "text": f"**API REQUEST ERROR** Reason: status code {res.status_code}.",
             "error_code": 1,
         }
+        return
 
     response_json = res.json()
     if "candidates" not in response_json:
@@ -638,21 +1314,20 @@ def bard_api_stream_iter(model_name, conv, temperature, top_p, api_key=None):
             "text": f"**API REQUEST ERROR** Reason: {reason}.",
             "error_code": 1,
         }
+        return
 
     response = response_json["candidates"][0]["content"]
     pos = 0
     while pos < len(response):
         # simulate token streaming
-        pos += random.randint(3, 6)
+        step = random.randint(3, 6)
         time.sleep(0.002)
-        data = {
-            "text": response[:pos],
-            "error_code": 0,
-        }
-        yield data
+        yield {"delta": response[pos:pos + step], "error_code": 0}
+        pos += step
+    yield completion_record("stop")
 
 
-def ai2_api_stream_iter(
+def ai2_api_delta_iter(
     model_name,
     model_id,
     messages,
@@ -681,9 +1356,11 @@ def ai2_api_stream_iter(
     if temperature == 0.0 and top_p < 1.0:
         raise ValueError("top_p must be 1 when temperature is 0.0")
 
-    res = requests.post(
+    client = client_pool.get_http_client("ai2", api_base)
+    with client.stream(
+        "POST",
         api_base,
-        stream=True,
+        timeout=RAW_HTTP_TIMEOUT,
         headers={"Authorization": f"Bearer {ai2_key}"},
         json={
             "model_id": model_id,
@@ -700,40 +1377,30 @@ def ai2_api_stream_iter(
                 },
             },
         },
-        timeout=5,
-    )
+    ) as res:
+        if res.status_code != 200:
+            res.read()
+            logger.error(f"unexpected response ({res.status_code}): {res.text}")
+            raise ValueError("unexpected response from InferD", res)
 
-    if res.status_code != 200:
-        logger.error(f"unexpected response ({res.status_code}): {res.text}")
-        raise ValueError("unexpected response from InferD", res)
-
-    text = ""
-    for line in res.iter_lines():
-        if line:
-            part = json.loads(line)
+        for part in iter_json_lines(res.iter_bytes()):
             if "result" in part and "output" in part["result"]:
-                for t in part["result"]["output"]["text"]:
-                    text += t
+                delta = "".join(part["result"]["output"]["text"])
             else:
                 logger.error(f"unexpected part: {part}")
                 raise ValueError("empty result in InferD response")
 
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+            yield {"delta": delta, "error_code": 0}
+    yield completion_record()
 
 
-def mistral_api_stream_iter(
-    model_name, messages, temperature, top_p, max_new_tokens, prefix=False, api_key=None
+def mistral_api_delta_iter(
+    model_name, messages, temperature, top_p, max_new_tokens, prefix=False, api_key=None, stop=None
 ):
-    from mistralai import Mistral
-
     if api_key is None:
         api_key = os.environ["MISTRAL_API_KEY"]
 
-    client = Mistral(api_key=api_key)
+    client = get_mistral_client(api_key)
 
     # Make requests
     gen_params = {
@@ -758,20 +1425,21 @@ def mistral_api_stream_iter(
         messages=messages,
         max_tokens=max_new_tokens,
         top_p=top_p,
+        **stop_params(stop),
     )
 
-    text = ""
+    finish_reason = None
+    usage = None
     for chunk in res:
         if chunk.data.choices[0].delta.content is not None:
-            text += chunk.data.choices[0].delta.content
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+            yield {"delta": chunk.data.choices[0].delta.content, "error_code": 0}
+        finish_reason = chunk.data.choices[0].finish_reason or finish_reason
+        if chunk.data.usage is not None:
+            usage = openai_usage_record(chunk.data.usage)
+    yield completion_record(finish_reason, usage)
 
 
-def nvidia_api_stream_iter(model_name, messages, temp, top_p, max_tokens, api_base):
+def nvidia_api_delta_iter(model_name, messages, temp, top_p, max_tokens, api_base, stop=None):
     assert model_name in ["llama2-70b-steerlm-chat", "yi-34b-chat"]
 
     api_key = os.environ["NVIDIA_API_KEY"]
@@ -791,24 +1459,17 @@ def nvidia_api_stream_iter(model_name, messages, temp, top_p, max_tokens, api_ba
         "max_tokens": max_tokens,
         "seed": 42,
         "stream": True,
+        **stop_params(stop),
     }
     logger.info(f"==== request ====\n{payload}")
 
-    response = requests.post(
-        api_base, headers=headers, json=payload, stream=True, timeout=1
-    )
-    text = ""
-    for line in response.iter_lines():
-        if line:
-            data = line.decode("utf-8")
-            if data.endswith("[DONE]"):
-                break
-            data = json.loads(data[6:])["choices"][0]["delta"]["content"]
-            text += data
-            yield {"text": text, "error_code": 0}
+    client = client_pool.get_http_client("nvidia", api_base)
+    with client.stream("POST", api_base, headers=headers, json=payload, timeout=RAW_HTTP_TIMEOUT) as response:
+        raise_for_stream_status(response)
+        yield from _sse_chat_delta_iter(response.iter_bytes())
 
 
-def cohere_api_stream_iter(
+def cohere_api_delta_iter(
     client_name: str,
     model_id: str,
     messages: list,
@@ -819,6 +1480,7 @@ def cohere_api_stream_iter(
     max_new_tokens: Optional[int] = None,
     api_key: Optional[str] = None,  # default is env var CO_API_KEY
     api_base: Optional[str] = None,
+    stop: Optional[list] = None,
 ):
     import cohere
 
@@ -828,11 +1490,7 @@ def cohere_api_stream_iter(
         "system": "System",
     }
 
-    client = cohere.Client(
-        api_key=api_key,
-        base_url=api_base,
-        client_name=client_name,
-    )
+    client = get_cohere_client(client_name, api_key, api_base)
 
     # prepare and log requests
     chat_history = [
@@ -862,13 +1520,16 @@ def cohere_api_stream_iter(
         temperature=temperature,
         max_tokens=max_new_tokens,
         p=top_p,
+        **stop_params(stop, "stop_sequences"),
     )
     try:
-        text = ""
+        final = completion_record()
         for streaming_item in res:
             if streaming_item.event_type == "text-generation":
-                text += streaming_item.text
-                yield {"text": text, "error_code": 0}
+                yield {"delta": streaming_item.text, "error_code": 0}
+            elif streaming_item.event_type == "stream-end":
+                final = cohere_completion_record(streaming_item)
+        yield final
     except cohere.core.ApiError as e:
         logger.error(f"==== error from cohere api: {e} ====")
         yield {
@@ -876,7 +1537,16 @@ def cohere_api_stream_iter(
             "error_code": 1,
         }
 
-def vertex_api_stream_iter(model_name, messages, temperature, top_p, max_new_tokens):
+
+def cohere_completion_record(stream_end):
+    usage = None
+    meta = getattr(stream_end.response, "meta", None)
+    billed_units = getattr(meta, "billed_units", None)
+    if billed_units is not None:
+        usage = usage_record(billed_units.input_tokens, billed_units.output_tokens)
+    return completion_record(stream_end.finish_reason, usage)
+
+def vertex_api_delta_iter(model_name, messages, temperature, top_p, max_new_tokens, stop=None):
     import vertexai
     from vertexai import generative_models
     from vertexai.generative_models import (
@@ -925,23 +1595,20 @@ def vertex_api_stream_iter(model_name, messages, temperature, top_p, max_new_tok
         messages,
         stream=True,
         generation_config=GenerationConfig(
-            top_p=top_p, max_output_tokens=max_new_tokens, temperature=temperature
+            top_p=top_p, max_output_tokens=max_new_tokens, temperature=temperature,
+            **stop_params(stop, "stop_sequences"),
         ),
         safety_settings=safety_settings,
     )
 
-    ret = ""
+    chunk = None
     for chunk in generator:
         # NOTE(chris): This may be a vertex api error, below is HOTFIX: https://github.com/googleapis/python-aiplatform/issues/3129
-        ret += chunk.candidates[0].content.parts[0]._raw_part.text
+        yield {"delta": chunk.candidates[0].content.parts[0]._raw_part.text, "error_code": 0}
         # ret += chunk.text
-        data = {
-            "text": ret,
-            "error_code": 0,
-        }
-        yield data
+    yield gemini_completion_record(chunk)
 
-def replicate_api_stream_iter(
+def replicate_api_delta_iter(
     model_name,
     prompt_template,
     prompt,
@@ -966,31 +1633,25 @@ def replicate_api_stream_iter(
     }
     logger.info(f"==== request ====\n{gen_params}")
 
-    text = ""
     for event in replicate.stream(
         model_name,
         input=gen_params
-    ):  
-        text += str(event)
-        data = {
-            "text": text,
-            "error_code": 0,
-        }
-        yield data
+    ):
+        yield {"delta": str(event), "error_code": 0}
+    yield completion_record()
 
-def sambanova_api_stream_iter(model_name, messages, temp, top_p, max_tokens, api_key=None):
+def sambanova_api_request(model_name, messages, temp, top_p, max_tokens, api_key=None, stream=True, stop=None):
+    """(url, headers, payload) of a SambaNova chat completion request."""
     if api_key is None:
         api_key = os.environ["SAMBANOVA_API_KEY"]
 
-    # The endpoint URL
     # TODO: make this configurable
     url = "https://api.sambanova.ai/v1/chat/completions"
-
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    # nvidia api does not accept 0 temperature
+    # sambanova api does not accept 0 temperature
     if temp == 0.0:
         temp = 0.0001
 
@@ -1000,27 +1661,25 @@ def sambanova_api_stream_iter(model_name, messages, temp, top_p, max_tokens, api
         "temperature": temp,
         "top_p": top_p,
         "max_tokens": max_tokens,
-        "stop": ["<|eot_id|>"],
+        "stop": ["<|eot_id|>", *(stop or [])],
         "seed": 42,
-        "stream": True,
+        "stream": stream,
     }
     logger.info(f"==== request ====\n{payload}")
+    return url, headers, payload
 
-    response = requests.post(
-        url, headers=headers, data=json.dumps(payload)
+
+def sambanova_api_delta_iter(model_name, messages, temp, top_p, max_tokens, api_key=None, stop=None):
+    url, headers, payload = sambanova_api_request(
+        model_name, messages, temp, top_p, max_tokens, api_key=api_key, stop=stop
     )
-    text = ""
-    for line in response.iter_lines():
-        if line:
-            # print(line)
-            data = line.decode("utf-8")
-            if data.endswith("[DONE]"):
-                break
-            data = json.loads(data[6:])["choices"][0]["delta"]["content"]
-            text += data
-            yield {"text": text, "error_code": 0}
-
-def xai_api_stream_iter(
+    client = client_pool.get_http_client("sambanova", url)
+    with client.stream("POST", url, headers=headers, json=payload, timeout=RAW_HTTP_TIMEOUT) as response:
+        raise_for_stream_status(response)
+        yield from _sse_chat_delta_iter(response.iter_bytes())
+
+
+def xai_api_delta_iter(
     model_name,
     messages,
     temperature,
@@ -1028,15 +1687,12 @@ def xai_api_stream_iter(
     max_new_tokens,
     api_base=None,
     api_key=None,
+    stop=None,
 ):
-    import openai
-
     if api_key is None:
         api_key = os.environ["XAI_API_KEY"]
 
-    client = openai.OpenAI(
-        base_url=api_base or "https://api.x.ai/v1", api_key=api_key
-    )
+    client = get_openai_client("xai", api_base or "https://api.x.ai/v1", api_key)
 
     # Make requests
     gen_params = {
@@ -1054,18 +1710,12 @@ def xai_api_stream_iter(
         temperature=temperature,
         max_tokens=max_new_tokens,
         stream=True,
+        stream_options={"include_usage": True},
+        **stop_params(stop),
     )
-    text = ""
-    for chunk in res:
-        if len(chunk.choices) > 0:
-            text += chunk.choices[0].delta.content or ""
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+    yield from _openai_chat_delta_iter(res)
 
-def dashscope_qwen_api_stream_iter(
+def dashscope_qwen_api_delta_iter(
     model_name,
     messages,
     temperature,
@@ -1073,15 +1723,12 @@ def dashscope_qwen_api_stream_iter(
     max_new_tokens,
     api_base=None,
     api_key=None,
+    stop=None,
 ):
-    import openai
-
     if api_key is None:
         api_key = os.environ["DASHSCOPE_API_KEY"]
 
-    client = openai.OpenAI(
-        base_url=api_base or "https://dashscope-intl.aliyuncs.com/compatible-mode/v1", api_key=api_key
-    )
+    client = get_openai_client("dashscope", api_base or "https://dashscope-intl.aliyuncs.com/compatible-mode/v1", api_key)
 
     # Make requests
     gen_params = {
@@ -1099,18 +1746,12 @@ def dashscope_qwen_api_stream_iter(
         temperature=temperature,
         max_tokens=max_new_tokens,
         stream=True,
+        stream_options={"include_usage": True},
+        **stop_params(stop),
     )
-    text = ""
-    for chunk in res:
-        if len(chunk.choices) > 0:
-            text += chunk.choices[0].delta.content or ""
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+    yield from _openai_chat_delta_iter(res)
 
-def yi_api_stream_iter(
+def yi_api_delta_iter(
     model_name,
     messages,
     temperature,
@@ -1118,15 +1759,12 @@ def yi_api_stream_iter(
     max_new_tokens,
     api_base=None,
     api_key=None,
+    stop=None,
 ):
-    import openai
-
     if api_key is None:
         api_key = os.environ["YI_API_KEY"]
 
-    client = openai.OpenAI(
-        base_url=api_base or "https://api.lingyiwanwu.com/v1", api_key=api_key
-    )
+    client = get_openai_client("yi", api_base or "https://api.lingyiwanwu.com/v1", api_key)
 
     # Make requests
     gen_params = {
@@ -1144,18 +1782,11 @@ def yi_api_stream_iter(
         temperature=temperature,
         max_tokens=max_new_tokens,
         stream=True,
+        **stop_params(stop),
     )
-    text = ""
-    for chunk in res:
-        if len(chunk.choices) > 0:
-            text += chunk.choices[0].delta.content or ""
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+    yield from _openai_chat_delta_iter(res)
 
-def deepseek_api_stream_iter(
+def deepseek_api_delta_iter(
     model_name,
     messages,
     temperature,
@@ -1163,15 +1794,12 @@ def deepseek_api_stream_iter(
     max_new_tokens,
     api_base=None,
     api_key=None,
+    stop=None,
 ):
-    import openai
-
     if api_key is None:
         api_key = os.environ["DEEPSEEK_API_KEY"]
 
-    client = openai.OpenAI(
-        base_url=api_base or "https://api.deepseek.com", api_key=api_key
-    )
+    client = get_openai_client("deepseek", api_base or "https://api.deepseek.com", api_key)
 
     # Make requests
     gen_params = {
@@ -1189,13 +1817,234 @@ def deepseek_api_stream_iter(
         temperature=temperature,
         max_tokens=max_new_tokens,
         stream=True,
+        stream_options={"include_usage": True},
+        **stop_params(stop),
     )
-    text = ""
-    for chunk in res:
-        if len(chunk.choices) > 0:
-            text += chunk.choices[0].delta.content or ""
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
\ No newline at end of file
+    yield from _openai_chat_delta_iter(res)
+
+
+
+# ------------------------- non-streaming completions ------------------------- #
+
+def chat_completion_result(res):
+    """CompletionResult from an OpenAI or Mistral SDK chat completion."""
+    choice = res.choices[0]
+    return CompletionResult(
+        choice.message.content or "", choice.finish_reason, openai_usage_record(res.usage)
+    )
+
+
+def chat_completion_json_result(body):
+    """CompletionResult from a raw OpenAI-style chat completion body."""
+    choice = body["choices"][0]
+    return CompletionResult(
+        choice["message"].get("content") or "",
+        choice.get("finish_reason"),
+        openai_usage_record(body.get("usage")),
+    )
+
+
+def anthropic_completion_result(message):
+    text = "".join(block.text for block in message.content if block.type == "text")
+    return CompletionResult(
+        text,
+        message.stop_reason,
+        anthropic_usage_record(message.usage),
+    )
+
+
+def gemini_completion_result(response):
+    record = gemini_completion_record(response)
+    return CompletionResult(
+        response.candidates[0].content.parts[0].text, record["finish_reason"], record["usage"]
+    )
+
+
+def openai_api_complete(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    if api_key is None:
+        api_key = os.environ["OPENAI_API_KEY"]
+
+    if "azure" in model_name:
+        client = get_openai_client(
+            "azure_openai", api_base or "https://api.openai.com/v1", api_key, azure=True
+        )
+    else:
+        client = get_openai_client("openai", api_base or "https://api.openai.com/v1", api_key)
+
+    if model_name == "gpt-4-turbo":
+        model_name = "gpt-4-1106-preview"
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    reasoning_model = "o1" in model_name or "o3" in model_name
+    if not reasoning_model:
+        gen_params["max_new_tokens"] = max_new_tokens
+    logger.info(f"==== request ====\n{gen_params}")
+
+    if not reasoning_model:
+        res = client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_new_tokens,
+            **stop_params(stop),
+        )
+    else:
+        res = client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+        )
+    return chat_completion_result(res)
+
+
+def openai_compatible_api_complete(
+    api_type,
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stop=None,
+):
+    default_api_base, api_key_env = OPENAI_COMPATIBLE_APIS[api_type]
+    client = get_openai_client(
+        api_type, api_base or default_api_base, api_key or os.environ[api_key_env]
+    )
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    res = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        **stop_params(stop),
+    )
+    return chat_completion_result(res)
+
+
+def anthropic_message_api_complete(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    vertex_ai=False,
+    stop=None,
+    api_key=None,
+):
+    if vertex_ai:
+        client = get_anthropic_client(None, vertex_ai=True)
+    else:
+        # the key of the entry (or of the balanced member serving this call)
+        client = get_anthropic_client(api_key or os.environ["ANTHROPIC_API_KEY"])
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    system_prompt, messages = split_anthropic_system_prompt(messages)
+    message = client.messages.create(
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_new_tokens,
+        messages=messages,
+        model=model_name,
+        system=system_prompt,
+        **stop_params(stop, "stop_sequences"),
+    )
+    return anthropic_completion_result(message)
+
+
+def gemini_api_complete(model_name, messages, temperature, top_p, max_new_tokens, api_key=None, stop=None):
+    convo = gemini_chat_session(
+        model_name, messages, temperature, top_p, max_new_tokens, api_key=api_key, stop=stop
+    )
+    response = convo.send_message(messages[-1]["content"], stream=False)
+    return gemini_completion_result(response)
+
+
+def mistral_api_complete(model_name, messages, temperature, top_p, max_new_tokens, api_key=None, stop=None):
+    if api_key is None:
+        api_key = os.environ["MISTRAL_API_KEY"]
+
+    client = get_mistral_client(api_key)
+
+    gen_params = {
+        "model": model_name,
+        "prompt": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    logger.info(f"==== request ====\n{gen_params}")
+
+    messages[-1]["prefix"] = True
+
+    res = client.chat.complete(
+        model=model_name,
+        temperature=temperature,
+        messages=messages,
+        max_tokens=max_new_tokens,
+        top_p=top_p,
+        **stop_params(stop),
+    )
+    return chat_completion_result(res)
+
+
+def sambanova_api_complete(model_name, messages, temp, top_p, max_tokens, api_key=None, stop=None):
+    url, headers, payload = sambanova_api_request(
+        model_name, messages, temp, top_p, max_tokens, api_key=api_key, stream=False, stop=stop
+    )
+    client = client_pool.get_http_client("sambanova", url)
+    response = client.post(url, headers=headers, json=payload, timeout=RAW_HTTP_TIMEOUT)
+    response.raise_for_status()
+    return chat_completion_json_result(response.json())
+
+
+# legacy cumulative-text iterators: every record carries the whole response so far
+openai_api_stream_iter = cumulative(openai_api_delta_iter)
+openai_assistant_api_stream_iter = cumulative(openai_assistant_api_delta_iter)
+anthropic_api_stream_iter = cumulative(anthropic_api_delta_iter)
+anthropic_message_api_stream_iter = cumulative(anthropic_message_api_delta_iter)
+gemini_api_stream_iter = cumulative(gemini_api_delta_iter)
+bard_api_stream_iter = cumulative(bard_api_delta_iter)
+ai2_api_stream_iter = cumulative(ai2_api_delta_iter)
+mistral_api_stream_iter = cumulative(mistral_api_delta_iter)
+nvidia_api_stream_iter = cumulative(nvidia_api_delta_iter)
+cohere_api_stream_iter = cumulative(cohere_api_delta_iter)
+vertex_api_stream_iter = cumulative(vertex_api_delta_iter)
+replicate_api_stream_iter = cumulative(replicate_api_delta_iter)
+sambanova_api_stream_iter = cumulative(sambanova_api_delta_iter)
+xai_api_stream_iter = cumulative(xai_api_delta_iter)
+dashscope_qwen_api_stream_iter = cumulative(dashscope_qwen_api_delta_iter)
+yi_api_stream_iter = cumulative(yi_api_delta_iter)
+deepseek_api_stream_iter = cumulative(deepseek_api_delta_iter)
@@ -0,0 +1,175 @@
+"""Priority scheduling of the LLM calls made by game routes.
+
+Every async generation in `BaseGame`, `BaseNPC` and `Action` takes a slot here
+first. `LLM_MAX_CONCURRENT_CALLS` (unset or 0: no cap) bounds how many run at
+once per worker; when they are all taken, waiting calls are admitted by
+priority class, gameplay turns first:
+
+    turn       /start, /ask_question, /regenerate, ... (shed only past the turn deadline)
+    assistant  /assistant suggestions
+    hint       /hint
+    npc        NPC chat and action picks
+
+The low-priority classes also have their own concurrency cap, so they can never
+fill the provider quota by themselves, and are shed (answered with 503 and a
+`Retry-After`) when their queue is full or they waited `max_wait` seconds.
+A turn waits for its slot until its `current_start_deadline`, or
+`TURN_DEADLINE_SECONDS` when none is set. Counts are per worker process, like
+the breakers.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import os
+import time
+from collections import defaultdict
+
+from fastchat.utils import build_logger
+from src.fschat.api_provider_game import TURN_DEADLINE_SECONDS
+from src.fschat.rate_limiter import current_start_deadline
+
+
+logger = build_logger("web_server", "web_server.log")
+
+# opt-in: the blocking provider calls used to be bounded only by the threadpool
+LLM_MAX_CONCURRENT_CALLS = int(os.environ.get("LLM_MAX_CONCURRENT_CALLS", 0)) or None
+# lower `priority` goes first; `None` means no cap / no queue limit / wait until
+# the turn deadline
+PRIORITY_CLASSES = {
+    "turn": {"priority": 0, "max_concurrent": None, "max_queue": None, "max_wait": None},
+    "assistant": {"priority": 1, "max_concurrent": 8, "max_queue": 16, "max_wait": 5.0},
+    "hint": {"priority": 1, "max_concurrent": 8, "max_queue": 16, "max_wait": 5.0},
+    "npc": {"priority": 2, "max_concurrent": 8, "max_queue": 16, "max_wait": 3.0},
+}
+# seconds a shed client is told to wait when its class has no `max_wait`
+DEFAULT_RETRY_AFTER = 2
+
+
+class CallShed(Exception):
+    def __init__(self, call_class, reason, retry_after):
+        self.call_class = call_class
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"{call_class} call shed: {reason}")
+
+
+class CallScheduler:
+    def __init__(self, max_concurrent=LLM_MAX_CONCURRENT_CALLS, classes=PRIORITY_CLASSES):
+        self.max_concurrent = max_concurrent
+        self.classes = classes
+        self._running = defaultdict(int)
+        self._total = 0
+        # (priority, arrival, call_class, future) of the queued calls
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self._stats = defaultdict(
+            lambda: {"admitted": 0, "queued": 0, "shed": 0, "wait_seconds": 0.0, "longest_wait": 0.0}
+        )
+
+    def _has_free_slot(self):
+        return self.max_concurrent is None or self._total < self.max_concurrent
+
+    def _can_run(self, call_class):
+        cap = self.classes[call_class]["max_concurrent"]
+        return self._has_free_slot() and (cap is None or self._running[call_class] < cap)
+
+    def _admit(self, call_class):
+        self._running[call_class] += 1
+        self._total += 1
+        self._stats[call_class]["admitted"] += 1
+
+    def _dispatch(self):
+        """Hand free slots to the queued calls, highest priority first."""
+        self._waiters = sorted(w for w in self._waiters if not w[3].done())
+        for waiter in list(self._waiters):
+            if not self._has_free_slot():
+                break
+            _, _, call_class, future = waiter
+            # a class at its own cap does not hold up the classes behind it
+            if self._can_run(call_class):
+                self._admit(call_class)
+                future.set_result(None)
+                self._waiters.remove(waiter)
+
+    @staticmethod
+    def _max_wait(config):
+        if config["max_wait"] is not None:
+            return config["max_wait"]
+        deadline = current_start_deadline.get()
+        if deadline is None:
+            return TURN_DEADLINE_SECONDS
+        return max(0.0, deadline - time.monotonic())
+
+    def _shed(self, call_class, reason):
+        config = self.classes[call_class]
+        self._stats[call_class]["shed"] += 1
+        logger.warning(f"scheduler: shedding a {call_class} call ({reason})")
+        raise CallShed(call_class, reason, config["max_wait"] or DEFAULT_RETRY_AFTER)
+
+    async def acquire(self, call_class):
+        if self._can_run(call_class):
+            self._admit(call_class)
+            return
+        config = self.classes[call_class]
+        queued = sum(1 for w in self._waiters if w[2] == call_class and not w[3].done())
+        if config["max_queue"] is not None and queued >= config["max_queue"]:
+            self._shed(call_class, f"{queued} already queued")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((config["priority"], next(self._arrivals), call_class, future))
+        stats = self._stats[call_class]
+        stats["queued"] += 1
+        max_wait = self._max_wait(config)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait({future}, timeout=max_wait)
+        except asyncio.CancelledError:
+            if future.done():
+                # granted just as the caller went away
+                self.release(call_class)
+            else:
+                future.cancel()
+            raise
+        wait = time.perf_counter() - start
+        stats["wait_seconds"] += wait
+        stats["longest_wait"] = max(stats["longest_wait"], wait)
+        if not future.done():
+            future.cancel()
+            self._shed(call_class, f"no slot within {max_wait:.1f}s")
+
+    def release(self, call_class):
+        self._running[call_class] -= 1
+        self._total -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, call_class):
+        """Hold a call slot of `call_class` for the body of the `async with`."""
+        await self.acquire(call_class)
+        try:
+            yield
+        finally:
+            self.release(call_class)
+
+    def stats(self):
+        waiting = defaultdict(int)
+        for _, _, call_class, future in self._waiters:
+            if not future.done():
+                waiting[call_class] += 1
+        return {
+            "max_concurrent": self.max_concurrent,
+            "running": self._total,
+            "classes": {
+                call_class: {
+                    **config,
+                    "running": self._running[call_class],
+                    "waiting": waiting[call_class],
+                    **self._stats[call_class],
+                }
+                for call_class, config in self.classes.items()
+            },
+        }
+
+
+call_scheduler = CallScheduler()
@@ -0,0 +1,280 @@
+"""Record provider streams and replay them (`"api_type": "replay"`).
+
+With `CASSETTE_RECORD=1` every successful provider response is saved, with the
+time each record arrived, to a sqlite store (`CASSETTE_DB`) keyed by the
+endpoint's model name and a hash of the request. A replay endpoint serves those
+recordings back instead of calling the provider:
+
+    "gpt-4o-2024-11-20": {
+        "model_name": "gpt-4o-2024-11-20",
+        "api_type": "replay",
+        ...
+        "replay": {"cassette": "gpt-4o-2024-11-20", "speed": 1.0, "on_miss": "error"}
+    }
+
+`cassette` defaults to the entry's model name; `speed` scales the recorded
+timing (2.0 replays twice as fast, 0 without any delay). A request that was never
+recorded gets an error record, or a `mock_provider` reply with `"on_miss": "mock"`.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from fastchat.utils import build_logger
+
+
+logger = build_logger("web_server", "web_server.log")
+
+CASSETTE_RECORD = os.environ.get("CASSETTE_RECORD", "0") == "1"
+CASSETTE_DB = os.environ.get(
+    "CASSETTE_DB", os.path.join(tempfile.gettempdir(), "ai_space_escape_cassettes.sqlite")
+)
+# never record our own fakes or calls with side effects
+UNRECORDED_API_TYPES = {"mock", "replay", "openai_assistant"}
+
+
+def cassette_key(conv, temperature, top_p, max_new_tokens, stop=None):
+    """Hash of the request, independent of the endpoint that serves it."""
+    messages = [
+        {"role": m["role"], "content": m["content"].strip() if isinstance(m["content"], str) else m["content"]}
+        for m in conv.to_openai_api_messages()
+    ]
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    if stop:
+        # only when set, so recordings made without stop sequences stay valid
+        payload["stop"] = list(stop)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class CassetteStore:
+    def __init__(self, path=CASSETTE_DB):
+        self.path = path
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"recorded": 0, "replayed": 0, "misses": 0})
+
+    def _conn(self):
+        # sqlite connections must not cross threads or a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS cassettes (
+                    cassette TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    records BLOB NOT NULL,
+                    recorded_at REAL NOT NULL,
+                    PRIMARY KEY (cassette, key)
+                )"""
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, cassette, name):
+        with self._stats_lock:
+            self._stats[cassette][name] += 1
+
+    def save(self, cassette, key, timed_records):
+        """Store `[(seconds since request start, record), ...]`; the latest take wins."""
+        blob = zlib.compress(json.dumps(timed_records, separators=(",", ":")).encode())
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cassettes (cassette, key, records, recorded_at) VALUES (?, ?, ?, ?)",
+                    (cassette, key, blob, time.time()),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"could not record cassette {cassette}: {e}")
+            return
+        self._count(cassette, "recorded")
+
+    def load(self, cassette, key):
+        row = self._conn().execute(
+            "SELECT records FROM cassettes WHERE cassette = ? AND key = ?", (cassette, key)
+        ).fetchone()
+        self._count(cassette, "misses" if row is None else "replayed")
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def stats(self):
+        with self._stats_lock:
+            this_worker = {name: dict(counts) for name, counts in self._stats.items()}
+        try:
+            stored = dict(
+                self._conn().execute("SELECT cassette, COUNT(*) FROM cassettes GROUP BY cassette").fetchall()
+            )
+        except sqlite3.Error:
+            stored = {}
+        return {
+            "recording": CASSETTE_RECORD,
+            "path": self.path,
+            "stored": stored,
+            "this_worker": this_worker,
+        }
+
+
+cassette_store = CassetteStore()
+
+
+# --------------------------------- recording --------------------------------- #
+
+def _should_record(model_api_dict):
+    return CASSETTE_RECORD and model_api_dict["api_type"] not in UNRECORDED_API_TYPES
+
+
+def _timed(start, data):
+    return [round(time.perf_counter() - start, 4), data]
+
+
+def _complete(timed_records):
+    # only a stream that ran to its closing record is worth replaying
+    return bool(timed_records) and bool(timed_records[-1][1].get("final"))
+
+
+def recorded_stream_iter(conv, model_api_dict, temperature, top_p, max_new_tokens, stream_iter):
+    """Save `stream_iter` to the cassette store as it is consumed, when recording."""
+    if not _should_record(model_api_dict):
+        return stream_iter
+    key = cassette_key(conv, temperature, top_p, max_new_tokens, model_api_dict.get("stop"))
+    return _record_stream_iter(model_api_dict["model_name"], key, stream_iter)
+
+
+def _record_stream_iter(cassette, key, stream_iter):
+    start = time.perf_counter()
+    timed_records = []
+    for data in stream_iter:
+        if data["error_code"] != 0:
+            yield data
+            return
+        timed_records.append(_timed(start, data))
+        yield data
+    if _complete(timed_records):
+        cassette_store.save(cassette, key, timed_records)
+
+
+def async_recorded_stream_iter(conv, model_api_dict, temperature, top_p, max_new_tokens, stream_iter):
+    """Async `recorded_stream_iter`."""
+    if not _should_record(model_api_dict):
+        return stream_iter
+    key = cassette_key(conv, temperature, top_p, max_new_tokens, model_api_dict.get("stop"))
+    return _async_record_stream_iter(model_api_dict["model_name"], key, stream_iter)
+
+
+async def _async_record_stream_iter(cassette, key, stream_iter):
+    start = time.perf_counter()
+    timed_records = []
+    try:
+        async for data in stream_iter:
+            if data["error_code"] != 0:
+                yield data
+                return
+            timed_records.append(_timed(start, data))
+            yield data
+    finally:
+        await stream_iter.aclose()
+    if _complete(timed_records):
+        await asyncio.to_thread(cassette_store.save, cassette, key, timed_records)
+
+
+def _result_records(result, latency):
+    final = result.to_record()
+    for name in ("latency", "attempts", "cached", "coalesced"):
+        final.pop(name)
+    latency = round(latency, 4)
+    return [[latency, {"delta": result.text, "error_code": 0}], [latency, final]]
+
+
+def record_result(conv, model_api_dict, temperature, top_p, max_new_tokens, result, latency):
+    """Save a non-streaming `CompletionResult` that took `latency` seconds, when recording."""
+    if _should_record(model_api_dict):
+        key = cassette_key(conv, temperature, top_p, max_new_tokens, model_api_dict.get("stop"))
+        cassette_store.save(model_api_dict["model_name"], key, _result_records(result, latency))
+
+
+async def async_record_result(conv, model_api_dict, temperature, top_p, max_new_tokens, result, latency):
+    """Async `record_result`."""
+    if _should_record(model_api_dict):
+        key = cassette_key(conv, temperature, top_p, max_new_tokens, model_api_dict.get("stop"))
+        await asyncio.to_thread(
+            cassette_store.save, model_api_dict["model_name"], key, _result_records(result, latency)
+        )
+
+
+# ---------------------------------- replay ---------------------------------- #
+
+def _replay_config(model_api_dict):
+    config = model_api_dict.get("replay", {})
+    return (
+        config.get("cassette", model_api_dict["model_name"]),
+        config.get("speed", 1.0),
+        config.get("on_miss", "error"),
+    )
+
+
+def _miss_record(cassette):
+    return {"text": f"**API REQUEST ERROR** Reason: no recording in cassette {cassette} for this request.", "error_code": 1}
+
+
+def _delays(timed_records, speed):
+    elapsed = 0.0
+    for offset, data in timed_records:
+        delay = (offset - elapsed) / speed if speed else 0.0
+        elapsed = offset
+        yield max(delay, 0.0), data
+
+
+def replay_delta_iter(conv, model_api_dict, temperature, top_p, max_new_tokens):
+    cassette, speed, on_miss = _replay_config(model_api_dict)
+    key = cassette_key(conv, temperature, top_p, max_new_tokens, model_api_dict.get("stop"))
+    timed_records = cassette_store.load(cassette, key)
+    if timed_records is None:
+        if on_miss == "mock":
+            from src.fschat.mock_provider import mock_api_delta_iter
+
+            yield from mock_api_delta_iter(
+                conv.to_openai_api_messages(), max_new_tokens, model_api_dict.get("mock"), model_api_dict.get("stop")
+            )
+        else:
+            yield _miss_record(cassette)
+        return
+    for delay, data in _delays(timed_records, speed):
+        if delay:
+            time.sleep(delay)
+        yield data
+
+
+async def replay_async_delta_iter(conv, model_api_dict, temperature, top_p, max_new_tokens):
+    cassette, speed, on_miss = _replay_config(model_api_dict)
+    key = cassette_key(conv, temperature, top_p, max_new_tokens, model_api_dict.get("stop"))
+    timed_records = await asyncio.to_thread(cassette_store.load, cassette, key)
+    if timed_records is None:
+        if on_miss == "mock":
+            from src.fschat.mock_provider import mock_api_async_delta_iter
+
+            async for data in mock_api_async_delta_iter(
+                conv.to_openai_api_messages(), max_new_tokens, model_api_dict.get("mock"), model_api_dict.get("stop")
+            ):
+                yield data
+        else:
+            yield _miss_record(cassette)
+        return
+    for delay, data in _delays(timed_records, speed):
+        if delay:
+            await asyncio.sleep(delay)
+        yield data
@@ -0,0 +1,376 @@
+"""Process-wide pool of provider SDK clients.
+
+Clients are keyed by (api_type, api_base, api_key) so every call against the same
+account reuses one keep-alive HTTP connection pool instead of paying a fresh
+TCP/TLS handshake per turn. Clients that sit unused for `CLIENT_IDLE_TTL` seconds
+are closed and dropped.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import httpx
+
+from src.fschat.rate_limiter import current_bucket, rate_limiter
+
+
+# keep-alive limits shared by every pooled HTTP client
+POOL_MAX_CONNECTIONS = int(os.environ.get("PROVIDER_POOL_MAX_CONNECTIONS", 100))
+POOL_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("PROVIDER_POOL_MAX_KEEPALIVE_CONNECTIONS", 20))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get("PROVIDER_POOL_KEEPALIVE_EXPIRY", 60.0))
+# seconds a pooled client may sit unused before it is evicted
+CLIENT_IDLE_TTL = float(os.environ.get("PROVIDER_CLIENT_IDLE_TTL", 600.0))
+# configured Gemini models kept, one per (model, key, system prompt, generation config)
+GEMINI_MODEL_CACHE_SIZE = int(os.environ.get("GEMINI_MODEL_CACHE_SIZE", 128))
+# generous read timeout: reasoning models can take a while before the first token
+DEFAULT_HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+# providers called over raw HTTP (nvidia, sambanova, ai2): `read` bounds the wait for
+# each chunk of a stream, not the whole answer
+RAW_HTTP_TIMEOUT = httpx.Timeout(
+    float(os.environ.get("PROVIDER_RAW_HTTP_READ_TIMEOUT", 120.0)),
+    connect=float(os.environ.get("PROVIDER_RAW_HTTP_CONNECT_TIMEOUT", 10.0)),
+)
+
+
+def _key_fingerprint(api_key) -> str:
+    """Never keep raw api keys in the pool index or in stats output."""
+    if api_key is None:
+        return "none"
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+class _PoolEntry:
+    def __init__(self, client, http_client, is_async):
+        self.client = client
+        self.http_client = http_client
+        self.is_async = is_async
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    def __init__(
+        self,
+        max_connections: int = POOL_MAX_CONNECTIONS,
+        max_keepalive_connections: int = POOL_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = POOL_KEEPALIVE_EXPIRY,
+        idle_ttl: float = CLIENT_IDLE_TTL,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._client_stats = defaultdict(lambda: {"created": 0, "reused": 0, "evicted": 0})
+        self._conn_stats = defaultdict(lambda: {"requests": 0, "connections_opened": 0})
+
+    # ----------------------------- http clients ----------------------------- #
+
+    def _count_request(self, api_type):
+        with self._lock:
+            self._conn_stats[api_type]["requests"] += 1
+
+    def _count_connection(self, api_type, event_name):
+        # httpcore only emits connect_tcp when it has to open a new connection;
+        # a request served from the keep-alive pool skips it entirely
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._conn_stats[api_type]["connections_opened"] += 1
+
+    def _new_http_client(self, api_type, is_async):
+        if is_async:
+            return self._new_async_http_client(api_type)
+        return self._new_sync_http_client(api_type)
+
+    def _new_async_http_client(self, api_type):
+        async def trace(event_name, info):
+            self._count_connection(api_type, event_name)
+
+        async def on_request(request):
+            self._count_request(api_type)
+            request.extensions["trace"] = trace
+
+        async def on_response(response):
+            # the bucket lives in sqlite shared with the other workers
+            if current_bucket.get() is not None:
+                await asyncio.to_thread(rate_limiter.observe, response)
+
+        return httpx.AsyncClient(
+            limits=self.limits,
+            timeout=DEFAULT_HTTP_TIMEOUT,
+            follow_redirects=True,
+            event_hooks={"request": [on_request], "response": [on_response]},
+        )
+
+    def _new_sync_http_client(self, api_type):
+        def trace(event_name, info):
+            self._count_connection(api_type, event_name)
+
+        def on_request(request):
+            self._count_request(api_type)
+            request.extensions["trace"] = trace
+
+        return httpx.Client(
+            limits=self.limits,
+            timeout=DEFAULT_HTTP_TIMEOUT,
+            follow_redirects=True,
+            event_hooks={"request": [on_request], "response": [rate_limiter.observe]},
+        )
+
+    # ------------------------------- pooling -------------------------------- #
+
+    def get(self, api_type, api_base, api_key, factory, is_async=False):
+        """Return the pooled client for these credentials, building it with
+        `factory(http_client)` on first use."""
+        key = (api_type, api_base, _key_fingerprint(api_key), is_async)
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._pop_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_used = now
+                self._client_stats[api_type]["reused"] += 1
+        for stale in evicted:
+            self._close(stale)
+        if entry is not None:
+            return entry.client
+
+        http_client = self._new_http_client(api_type, is_async)
+        client = factory(http_client)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _PoolEntry(client, http_client, is_async)
+                self._entries[key] = entry
+                self._client_stats[api_type]["created"] += 1
+                return client
+            # lost a race with another thread; keep theirs
+            entry.last_used = now
+            self._client_stats[api_type]["reused"] += 1
+        self._close(_PoolEntry(client, http_client, is_async))
+        return entry.client
+
+    def get_http_client(self, api_type, api_base, is_async=False):
+        """Pooled bare httpx client for providers we call without an SDK."""
+        return self.get(api_type, api_base, None, lambda http_client: http_client, is_async=is_async)
+
+    async def preconnect(self, api_type, api_base, api_key, url, timeout=10.0):
+        """Open a keep-alive connection to `url` on the async client pooled for these
+        credentials; returns the HTTP status, or None if there is no such client."""
+        with self._lock:
+            entry = self._entries.get((api_type, api_base, _key_fingerprint(api_key), True))
+        if entry is None:
+            return None
+        response = await entry.http_client.head(url, timeout=timeout)
+        return response.status_code
+
+    def _pop_idle(self, now):
+        expired = [
+            key for key, entry in self._entries.items()
+            if now - entry.last_used > self.idle_ttl
+        ]
+        evicted = []
+        for key in expired:
+            evicted.append(self._entries.pop(key))
+            self._client_stats[key[0]]["evicted"] += 1
+        return evicted
+
+    def _close(self, entry):
+        if not entry.is_async:
+            entry.http_client.close()
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop to run aclose() on; connections are dropped with the client
+            return
+        loop.create_task(entry.http_client.aclose())
+
+    def evict_idle(self):
+        with self._lock:
+            evicted = self._pop_idle(time.monotonic())
+        for entry in evicted:
+            self._close(entry)
+        return len(evicted)
+
+    def stats(self):
+        with self._lock:
+            per_api_type = {}
+            for api_type in set(self._client_stats) | set(self._conn_stats):
+                client_stats = dict(self._client_stats[api_type])
+                conn_stats = dict(self._conn_stats[api_type])
+                conn_stats["connections_reused"] = max(
+                    0, conn_stats["requests"] - conn_stats["connections_opened"]
+                )
+                per_api_type[api_type] = {**client_stats, **conn_stats}
+            total_requests = sum(s["requests"] for s in per_api_type.values())
+            total_reused = sum(s["connections_reused"] for s in per_api_type.values())
+            return {
+                "pooled_clients": len(self._entries),
+                "requests": total_requests,
+                "connections_reused": total_reused,
+                "connection_reuse_ratio": total_reused / total_requests if total_requests else 0.0,
+                "by_api_type": per_api_type,
+            }
+
+
+client_pool = ClientPool()
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class GeminiModelCache:
+    """LRU of configured `genai.GenerativeModel`s.
+
+    The SDK keeps one process-wide api key, set by `genai.configure()`, and a
+    model takes the client of the key configured when it first calls. So the key
+    is configured and the model's clients are bound under one lock: each cached
+    model keeps calling with its own key, whichever entry reconfigures the SDK
+    next. A turn then just starts a chat on the cached model with its history.
+    """
+
+    def __init__(self, max_size=GEMINI_MODEL_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self._configured_key = None
+        self._stats = {"hits": 0, "misses": 0, "evicted": 0, "configured": 0}
+
+    @staticmethod
+    def cache_key(model_name, api_key, system_instruction, generation_config):
+        system_digest = hashlib.sha256(system_instruction.encode()).hexdigest() if system_instruction else None
+        return (
+            model_name,
+            _key_fingerprint(api_key),
+            system_digest,
+            json.dumps(generation_config, sort_keys=True),
+        )
+
+    def _bind(self, genai, model, api_key):
+        """Give `model` the clients of `api_key`; call with the lock held."""
+        from google.generativeai import client as genai_client
+
+        if api_key != self._configured_key:
+            genai.configure(api_key=api_key)
+            self._configured_key = api_key
+            self._stats["configured"] += 1
+        # `GenerativeModel` otherwise takes the default client lazily, on its first call
+        if model._client is None:
+            model._client = genai_client.get_default_generative_client()
+        if model._async_client is None and _in_event_loop():
+            model._async_client = genai_client.get_default_generative_async_client()
+
+    def get(self, model_name, api_key, system_instruction, generation_config, safety_settings):
+        import google.generativeai as genai  # pip install google-generativeai
+
+        key = self.cache_key(model_name, api_key, system_instruction, generation_config)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self._stats["hits"] += 1
+                self._bind(genai, model, api_key)
+                return model
+            self._stats["misses"] += 1
+
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            system_instruction=system_instruction,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+        )
+        with self._lock:
+            # a racing thread may have built the same model; either copy will do
+            self._bind(genai, model, api_key)
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+                self._stats["evicted"] += 1
+        return model
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._models), "max_size": self.max_size, **self._stats}
+
+
+gemini_model_cache = GeminiModelCache()
+
+
+def get_openai_client(api_type, api_base, api_key, is_async=False, azure=False):
+    # retries are done by RetryPolicy in api_provider_game, inside the turn deadline
+    import openai
+
+    if azure:
+        cls = openai.AsyncAzureOpenAI if is_async else openai.AzureOpenAI
+        factory = lambda http_client: cls(
+            api_version="2023-07-01-preview",
+            azure_endpoint=api_base,
+            api_key=api_key,
+            max_retries=0,
+            http_client=http_client,
+        )
+    else:
+        cls = openai.AsyncOpenAI if is_async else openai.OpenAI
+        factory = lambda http_client: cls(
+            base_url=api_base, api_key=api_key, max_retries=0, http_client=http_client
+        )
+    return client_pool.get(api_type, api_base, api_key, factory, is_async=is_async)
+
+
+def get_anthropic_client(api_key, is_async=False, vertex_ai=False, max_retries=0):
+    import anthropic
+
+    if vertex_ai:
+        region = os.environ["GCP_LOCATION"]
+        project_id = os.environ["GCP_PROJECT_ID"]
+        cls = anthropic.AsyncAnthropicVertex if is_async else anthropic.AnthropicVertex
+        factory = lambda http_client: cls(
+            region=region,
+            project_id=project_id,
+            max_retries=max_retries,
+            http_client=http_client,
+        )
+        return client_pool.get("anthropic_vertex", f"{project_id}/{region}", None, factory, is_async=is_async)
+
+    cls = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+    factory = lambda http_client: cls(
+        api_key=api_key, max_retries=max_retries, http_client=http_client
+    )
+    return client_pool.get("anthropic", None, api_key, factory, is_async=is_async)
+
+
+def get_mistral_client(api_key, is_async=False):
+    from mistralai import Mistral
+
+    if is_async:
+        factory = lambda http_client: Mistral(api_key=api_key, async_client=http_client)
+    else:
+        factory = lambda http_client: Mistral(api_key=api_key, client=http_client)
+    return client_pool.get("mistral", None, api_key, factory, is_async=is_async)
+
+
+def get_cohere_client(client_name, api_key, api_base, is_async=False):
+    import cohere
+
+    cls = cohere.AsyncClient if is_async else cohere.Client
+    factory = lambda http_client: cls(
+        api_key=api_key,
+        base_url=api_base,
+        client_name=client_name,
+        httpx_client=http_client,
+    )
+    return client_pool.get("cohere", api_base, api_key, factory, is_async=is_async)
@@ -467,7 +467,11 @@ class Conversation:
         return ret
 
     def to_openai_api_messages(self, model_name=None):
-        """Convert the conversation to OpenAI chat completion format."""
+        """Convert the conversation to OpenAI chat completion format.
+
+        Keep the output append-only (system prompt first, then the turns in
+        order, nothing per-request in front): providers cache prompts by prefix.
+        """
         if self.system_message == "" or (model_name and "o1" in model_name):
             ret = []
         else:
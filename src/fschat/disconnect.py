@@ -0,0 +1,171 @@
+"""Stop generating for Roblox clients that went away.
+
+A Roblox server that times out (or a player who leaves) drops the HTTP request,
+but the handler would keep draining the provider stream and commit a turn nobody
+sees. Game routes wrap their generation in `cancel_on_disconnect`, which polls
+the request while the turn runs; on disconnect the turn's task is cancelled,
+which closes the upstream stream through the provider iterators' `finally`
+blocks, and `ClientDisconnected` skips the rest of the handler (DB write
+included). The app answers it with 499 and still bills what the turn spent:
+the usage of its finished calls and, for a call cut off mid-stream, the
+prompt plus the output streamed so far (`bill_if_abandoned`), go to the
+session row and the per-model daily rollup.
+
+Per route, the wall time and output tokens of completed turns give the
+expected cost of a turn; what an abandoned turn did not spend of that is
+reported as saved in `/monitor/disconnects`.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import dataclasses
+import os
+import threading
+import time
+from collections import defaultdict
+
+from fastchat.utils import build_logger
+from src.fschat.rate_limiter import CHARS_PER_TOKEN
+from src.fschat.usage_accounting import call_usage
+
+
+logger = build_logger("web_server", "web_server.log")
+
+DISCONNECT_POLL_SECONDS = float(os.environ.get("DISCONNECT_POLL_SECONDS", 0.25))
+# nginx's code for "client closed request"
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    def __init__(self, route, billing=()):
+        self.route = route
+        # `[(session table, session id or None, usage entries), ...]` the handler did not get to save
+        self.billing = list(billing)
+        super().__init__(f"client disconnected during {route}")
+
+
+@dataclasses.dataclass
+class TurnProgress:
+    """Output streamed so far by the turn running in this context."""
+
+    output_chars: int = 0
+    # games/NPCs/actions that made calls for the turn; their `pending_usage` is billed if it is abandoned
+    owners: list = dataclasses.field(default_factory=list)
+
+    def billing(self):
+        return [
+            (owner.session_table, owner.session_id, owner.pending_usage)
+            for owner in self.owners
+            if owner.pending_usage
+        ]
+
+
+current_turn = contextvars.ContextVar("current_turn", default=None)
+
+
+def note_output(delta):
+    """Count streamed output against the current turn, if one is being watched."""
+    progress = current_turn.get()
+    if progress is not None:
+        progress.output_chars += len(delta)
+
+
+@contextlib.contextmanager
+def bill_if_abandoned(owner, model_name, model_api_info, conversation):
+    """Add what a call streamed to `owner.pending_usage` if the turn is cancelled during it.
+
+    `owner` (a game, NPC or action) has `pending_usage`, `session_table` and `session_id`.
+    """
+    progress = current_turn.get()
+    if progress is None:
+        yield
+        return
+    if owner not in progress.owners:
+        progress.owners.append(owner)
+    start_chars = progress.output_chars
+    try:
+        yield
+    except asyncio.CancelledError:
+        output_chars = progress.output_chars - start_chars
+        # a call that streamed nothing may still have been queued; only bill what surely went out
+        if output_chars:
+            partial = {"usage": {"input_tokens": None, "output_tokens": output_chars // CHARS_PER_TOKEN}}
+            owner.pending_usage.append(call_usage(model_name, model_api_info, conversation, None, partial))
+        raise
+
+
+class DisconnectStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(
+            lambda: {
+                "completed": 0,
+                "completed_seconds": 0.0,
+                "completed_output_tokens": 0,
+                "abandoned": 0,
+                "abandoned_seconds": 0.0,
+                "abandoned_output_tokens": 0,
+                "saved_seconds": 0.0,
+                "saved_output_tokens": 0,
+            }
+        )
+
+    def completed(self, route, seconds, output_chars):
+        with self._lock:
+            stats = self._stats[route]
+            stats["completed"] += 1
+            stats["completed_seconds"] += seconds
+            stats["completed_output_tokens"] += output_chars // CHARS_PER_TOKEN
+
+    def abandoned(self, route, seconds, output_chars):
+        output_tokens = output_chars // CHARS_PER_TOKEN
+        with self._lock:
+            stats = self._stats[route]
+            stats["abandoned"] += 1
+            stats["abandoned_seconds"] += seconds
+            stats["abandoned_output_tokens"] += output_tokens
+            # savings are estimated against the mean completed turn of the route
+            if stats["completed"]:
+                mean_seconds = stats["completed_seconds"] / stats["completed"]
+                mean_tokens = stats["completed_output_tokens"] / stats["completed"]
+                stats["saved_seconds"] += max(mean_seconds - seconds, 0.0)
+                stats["saved_output_tokens"] += max(int(mean_tokens) - output_tokens, 0)
+
+    def stats(self):
+        with self._lock:
+            return {route: dict(counts) for route, counts in self._stats.items()}
+
+
+disconnect_stats = DisconnectStats()
+
+
+async def cancel_on_disconnect(request, awaitable, route=None):
+    """Await `awaitable` (a game turn) unless the client of `request` disconnects first."""
+    route = route or request.url.path
+    progress = TurnProgress()
+    # the task copies the context, so the turn's collectors see `progress`
+    token = current_turn.set(progress)
+    try:
+        task = asyncio.ensure_future(awaitable)
+    finally:
+        current_turn.reset(token)
+
+    start = time.perf_counter()
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if not task.done() and await request.is_disconnected():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                elapsed = time.perf_counter() - start
+                disconnect_stats.abandoned(route, elapsed, progress.output_chars)
+                logger.info(f"client disconnected from {route} after {elapsed:.1f}s; cancelled the turn")
+                raise ClientDisconnected(route, progress.billing())
+    except asyncio.CancelledError:
+        # the handler itself is being cancelled (e.g. shutdown); take the turn with it
+        task.cancel()
+        raise
+    result = task.result()
+    disconnect_stats.completed(route, time.perf_counter() - start, progress.output_chars)
+    return result
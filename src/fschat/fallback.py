@@ -0,0 +1,137 @@
+"""Ordered fallback models for turns whose provider fails.
+
+An endpoint entry in `src/config/api_endpoint*.json` lists the models that may
+serve a turn in its place, in order (names are looked up in every endpoint
+config, like hedging pools):
+
+    "gemini-1.5-pro": {
+        ...
+        "fallback": ["gemini-1.5-flash", "gpt-4o-2024-11-20"]
+    }
+
+When the model's call fails (after its own retries), the turn is run on the
+next model of the list with the conversation translated into that model's
+template; models whose circuit breaker is open are tried last. The game keeps
+its model for later turns, so every turn is first offered to the model the
+game was started with, and the session row's `turn_models` records which model
+actually served each turn.
+"""
+
+import threading
+from collections import defaultdict
+
+from fastchat.utils import build_logger
+from src.fschat.model_adapter import get_conversation_template
+from src.fschat.model_health import model_health
+from utils import get_api_endpoint_info
+
+
+logger = build_logger("web_server", "web_server.log")
+
+
+def _is_o1(model_name):
+    # same test as BaseGame.initialize_game, which folds the system prompt into the first message
+    return "o1" in model_name
+
+
+def translate_conversation(conversation, model_name):
+    """Copy of `conversation` in the conversation template of `model_name`."""
+    translated = get_conversation_template(model_name)
+    translated.set_system_message(conversation.system_message)
+    messages = [list(message) for message in conversation.messages[conversation.offset:]]
+    system = conversation.system_message
+    if messages and system and isinstance(messages[0][1], str):
+        folded = system + "\n\n"
+        if _is_o1(model_name) and not messages[0][1].startswith(folded):
+            messages[0][1] = folded + messages[0][1]
+        elif not _is_o1(model_name) and messages[0][1].startswith(folded):
+            messages[0][1] = messages[0][1][len(folded):]
+    # messages alternate user/assistant by position in every template
+    for i, (_, message) in enumerate(messages):
+        translated.append_message(translated.roles[i % 2], message)
+    return translated
+
+
+def fallback_chain(model_name, model_api_info):
+    """`[(model_name, model_api_info), ...]` to try for a turn of `model_name`, in order."""
+    chain = [(model_name, model_api_info)]
+    for name in (model_api_info or {}).get("fallback", []):
+        api_info = get_api_endpoint_info(name)
+        if api_info is None:
+            logger.warning(f"fallback {name} of {model_name} is not in any endpoint config")
+            continue
+        chain.append((name, api_info))
+    # a tripped model would only burn the turn's deadline; keep it as a last resort
+    return sorted(chain, key=lambda candidate: model_health.is_open(candidate[0]))
+
+
+class FallbackStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"turns": 0, "failed": 0, "served_by": defaultdict(int)})
+
+    def record(self, model_name, served_by):
+        with self._lock:
+            stats = self._stats[model_name]
+            stats["turns"] += 1
+            if served_by is None:
+                stats["failed"] += 1
+            else:
+                stats["served_by"][served_by] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: dict(counts, served_by=dict(counts["served_by"]))
+                for name, counts in self._stats.items()
+            }
+
+
+fallback_stats = FallbackStats()
+
+
+def turn_record(type, model_name, served_by):
+    """Entry of a session row's `turn_models`."""
+    record = {"type": type, "model": served_by}
+    if served_by != model_name:
+        record["fallback_from"] = model_name
+    return record
+
+
+def collect_with_fallback(run, model_name, model_api_info, conversation):
+    """Run a turn of `model_name`, falling back along its chain when it fails.
+
+    `run(model_name, model_api_info, conversation)` collects one attempt and
+    returns `(output, final)`. Returns `(output, final, served_by, its model_api_info)`;
+    if every model fails, the error of the last one is raised.
+    """
+    error = None
+    for candidate, candidate_info in fallback_chain(model_name, model_api_info):
+        conv = conversation if candidate == model_name else translate_conversation(conversation, candidate)
+        try:
+            output, final = run(candidate, candidate_info, conv)
+        except Exception as e:
+            error = e
+            logger.warning(f"{candidate} failed a turn of {model_name} ({e!r}), trying the next fallback")
+            continue
+        fallback_stats.record(model_name, candidate)
+        return output, final, candidate, candidate_info
+    fallback_stats.record(model_name, None)
+    raise error
+
+
+async def async_collect_with_fallback(run, model_name, model_api_info, conversation):
+    """Async `collect_with_fallback`; `run(...)` returns an awaitable."""
+    error = None
+    for candidate, candidate_info in fallback_chain(model_name, model_api_info):
+        conv = conversation if candidate == model_name else translate_conversation(conversation, candidate)
+        try:
+            output, final = await run(candidate, candidate_info, conv)
+        except Exception as e:
+            error = e
+            logger.warning(f"{candidate} failed a turn of {model_name} ({e!r}), trying the next fallback")
+            continue
+        fallback_stats.record(model_name, candidate)
+        return output, final, candidate, candidate_info
+    fallback_stats.record(model_name, None)
+    raise error
@@ -0,0 +1,101 @@
+"""Output-token caps and stop sequences per game and call type.
+
+`src/config/generation_profiles.json` (or `GENERATION_PROFILES_FILE`) holds a
+`default` profile, per-model overrides under `models`, and per-game profiles
+keyed by the game's name and call type, which may carry their own `models`:
+
+    "games": {
+        "Akinator": {
+            "question": {
+                "max_new_tokens": 96,
+                "stop": ["\\nAnswer"],
+                "models": {"gemini-2.0-flash-thinking-exp": {"max_new_tokens": 2048}}
+            }
+        }
+    }
+
+Stop only on the marker of the next turn (the user's "Answer"): a reply may
+open with a line of its own before "Question N:", so stopping on the reply's
+own header would cut off the question itself.
+
+Layers apply in that order: default, game/call type, model, game/call type
+model. Each turn's finish reason is tracked per profile so a cap that cuts off
+too many replies shows up in `/monitor/generation_profiles`.
+"""
+
+import functools
+import json
+import os
+import threading
+from collections import defaultdict
+
+
+GENERATION_PROFILES_FILE = os.environ.get(
+    "GENERATION_PROFILES_FILE", "src/config/generation_profiles.json"
+)
+DEFAULT_PROFILE = {"max_new_tokens": 1024, "stop": None}
+# finish reasons of a reply cut off by the token cap (OpenAI, Anthropic, Gemini/Cohere)
+TRUNCATED_FINISH_REASONS = {"length", "max_tokens", "MAX_TOKENS"}
+
+
+@functools.lru_cache(maxsize=None)
+def load_generation_profiles(path=GENERATION_PROFILES_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def generation_profile(game, call_type, model_name):
+    """`{"max_new_tokens", "stop"}` for a `call_type` turn of `game` played by `model_name`."""
+    config = load_generation_profiles()
+    call_config = config.get("games", {}).get(game, {}).get(call_type, {})
+    profile = dict(DEFAULT_PROFILE)
+    for layer in (
+        config.get("default", {}),
+        call_config,
+        config.get("models", {}).get(model_name, {}),
+        call_config.get("models", {}).get(model_name, {}),
+    ):
+        profile.update({k: v for k, v in layer.items() if k != "models"})
+    return profile
+
+
+class ProfileOutcomes:
+    """How the turns of each (game, call type, model) ended."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(
+            lambda: {"turns": 0, "truncated": 0, "output_tokens": 0, "finish_reasons": defaultdict(int)}
+        )
+
+    def record(self, game, call_type, model_name, completion):
+        """Count the closing record of a turn; replies served from the cache are skipped."""
+        if not completion or completion.get("cached"):
+            return
+        finish_reason = completion.get("finish_reason")
+        output_tokens = (completion.get("usage") or {}).get("output_tokens") or 0
+        with self._lock:
+            stats = self._stats[(game, call_type, model_name)]
+            stats["turns"] += 1
+            stats["truncated"] += finish_reason in TRUNCATED_FINISH_REASONS
+            stats["output_tokens"] += output_tokens
+            stats["finish_reasons"][str(finish_reason)] += 1
+
+    def stats(self):
+        with self._lock:
+            outcomes = {
+                key: dict(counts, finish_reasons=dict(counts["finish_reasons"]))
+                for key, counts in self._stats.items()
+            }
+        by_profile = defaultdict(dict)
+        for (game, call_type, model_name), counts in sorted(outcomes.items(), key=lambda kv: str(kv[0])):
+            counts["truncation_rate"] = counts["truncated"] / counts["turns"]
+            counts["mean_output_tokens"] = counts["output_tokens"] / counts["turns"]
+            counts["profile"] = generation_profile(game, call_type, model_name)
+            by_profile[f"{game}/{call_type}"][model_name] = counts
+        return {"config": GENERATION_PROFILES_FILE, "by_profile": dict(by_profile)}
+
+
+profile_outcomes = ProfileOutcomes()
@@ -0,0 +1,261 @@
+"""Hedged requests across equivalent endpoints.
+
+An endpoint entry in `src/config/api_endpoint*.json` opts in with a `hedging`
+block naming its equivalents (other entries, looked up in every endpoint config):
+
+    "gpt-4o-2024-11-20": {
+        ...
+        "hedging": {
+            "pool": ["gpt-4o-2024-11-20-eu"],
+            "percentile": 95,
+            "min_delay": 1.0,
+            "max_delay": 6.0
+        }
+    }
+
+If the first chunk has not arrived after the `percentile` of the model's recent
+time-to-first-token (clamped to [min_delay, max_delay]), the next pool member is
+fired as well. The first stream to produce a chunk wins, the others are
+cancelled and closed. The delay, like the time-to-first-token samples, counts
+from when the latest attempt got through the rate limiter and sent its request
+(`rate_limiter.current_on_sent`), so a throttled bucket does not fire hedges.
+
+Hedging is only wired into the async engine (`api_provider_async`); the sync
+engine serves the threadpool routes and sends a single request per attempt.
+"""
+
+import asyncio
+import threading
+import time
+from collections import defaultdict, deque
+
+from fastchat.utils import build_logger
+from src.fschat.rate_limiter import current_on_sent
+from utils import get_api_endpoint_info
+
+
+logger = build_logger("web_server", "web_server.log")
+
+# below this many samples the percentile is too noisy; use `default_delay`
+MIN_SAMPLES = 20
+DEFAULT_HEDGING_CONFIG = {
+    "pool": [],
+    "percentile": 95,
+    "min_delay": 1.0,
+    "max_delay": 8.0,
+    "default_delay": 3.0,
+}
+
+
+class LatencyTracker:
+    """Rolling window of time-to-first-token samples per model."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, model_name, seconds):
+        with self._lock:
+            self._samples[model_name].append(seconds)
+
+    def percentile(self, model_name, percentile):
+        with self._lock:
+            samples = sorted(self._samples[model_name])
+        if len(samples) < MIN_SAMPLES:
+            return None
+        idx = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[idx]
+
+    def hedge_delay(self, model_name, config):
+        delay = self.percentile(model_name, config["percentile"])
+        if delay is None:
+            delay = config["default_delay"]
+        return min(max(delay, config["min_delay"]), config["max_delay"])
+
+    def stats(self):
+        with self._lock:
+            models = {name: sorted(samples) for name, samples in self._samples.items()}
+        return {
+            name: {
+                "samples": len(samples),
+                "p50": samples[len(samples) // 2] if samples else None,
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else None,
+            }
+            for name, samples in models.items()
+        }
+
+
+latency_tracker = LatencyTracker()
+_hedge_stats = defaultdict(lambda: {"requests": 0, "hedges_fired": 0, "backup_wins": 0})
+_hedge_stats_lock = threading.Lock()
+
+
+def _count(model_name, key):
+    with _hedge_stats_lock:
+        _hedge_stats[model_name][key] += 1
+
+
+def hedging_stats():
+    with _hedge_stats_lock:
+        per_model = {name: dict(counts) for name, counts in _hedge_stats.items()}
+    return {"by_model": per_model, "ttft": latency_tracker.stats()}
+
+
+def _resolve_pool(pool, stop=None):
+    endpoints = []
+    for member in pool:
+        if isinstance(member, dict):
+            endpoints.append((member["model_name"], member))
+            continue
+        api_dict = get_api_endpoint_info(member)
+        if api_dict is None:
+            logger.warning(f"hedging pool member {member} is not in any endpoint config")
+            continue
+        # the stop sequences belong to the request, not the endpoint
+        endpoints.append((member, dict(api_dict, stop=stop) if stop else api_dict))
+    return endpoints
+
+
+async def _first_record(stream_iter):
+    return await stream_iter.__anext__()
+
+
+async def _close_quietly(stream_iter):
+    try:
+        await stream_iter.aclose()
+    except Exception as e:
+        logger.warning(f"closing cancelled hedge failed: {e}")
+
+
+async def hedged_delta_iter(
+    stream_iter_fn,
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+):
+    """Race `stream_iter_fn` over `model_name` and its hedging pool.
+
+    `stream_iter_fn` is an unhedged async delta dispatcher. Records of the winning
+    stream are passed through; its closing record gets `served_by` and `hedged`.
+    """
+    config = {**DEFAULT_HEDGING_CONFIG, **model_api_dict["hedging"]}
+    candidates = [(model_name, model_api_dict)] + _resolve_pool(config["pool"], model_api_dict.get("stop"))
+    delay = latency_tracker.hedge_delay(model_name, config)
+    _count(model_name, "requests")
+
+    attempts = {}  # task -> (name, stream_iter)
+    sent_at = {}  # candidate index -> when its request went out
+    sent_events = {}  # candidate index -> set once its request went out
+    errors = []
+    next_candidate = 0
+    winner = None
+
+    def launch():
+        nonlocal next_candidate
+        index = next_candidate
+        name, api_dict = candidates[index]
+        next_candidate += 1
+        sent = sent_events[index] = asyncio.Event()
+
+        def on_sent():
+            sent_at.setdefault(index, time.perf_counter())
+            sent.set()
+
+        stream_iter = stream_iter_fn(
+            conv, name, api_dict, temperature, top_p, max_new_tokens, state
+        )
+        # the task copies the context now, so only this attempt reports to `on_sent`
+        token = current_on_sent.set(on_sent)
+        try:
+            attempts[asyncio.ensure_future(_first_record(stream_iter))] = (name, stream_iter)
+        finally:
+            current_on_sent.reset(token)
+
+    launch()
+    sent_waiter = sent_waiter_index = None
+    try:
+        while attempts and winner is None:
+            waits = set(attempts)
+            timeout = None
+            latest = next_candidate - 1
+            if next_candidate < len(candidates):
+                if latest not in sent_at:
+                    # still queued on the rate limiter: the hedge delay has not started
+                    if sent_waiter_index != latest:
+                        if sent_waiter is not None:
+                            sent_waiter.cancel()
+                        sent_waiter = asyncio.ensure_future(sent_events[latest].wait())
+                        sent_waiter_index = latest
+                    waits.add(sent_waiter)
+                else:
+                    timeout = max(0.0, sent_at[latest] + delay - time.perf_counter())
+            done, _ = await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if sent_waiter in done:
+                done.discard(sent_waiter)
+                if not done:
+                    continue
+            if not done:
+                logger.info(f"hedging {model_name}: no first chunk after {delay:.2f}s, firing {candidates[next_candidate][0]}")
+                _count(model_name, "hedges_fired")
+                launch()
+                continue
+            for task in done:
+                name, stream_iter = attempts.pop(task)
+                if task.exception() is not None or task.result()["error_code"] != 0:
+                    errors.append(task.exception() or task.result())
+                    # a failed attempt should not make the survivors wait a full delay
+                    if not attempts and next_candidate < len(candidates):
+                        _count(model_name, "hedges_fired")
+                        launch()
+                    continue
+                if winner is None:
+                    winner = (name, stream_iter, task.result())
+                else:
+                    await _close_quietly(stream_iter)
+    finally:
+        if sent_waiter is not None:
+            sent_waiter.cancel()
+        # cancel the losers and close their streams so the connections are released
+        for task in attempts:
+            task.cancel()
+        for task, (_, stream_iter) in attempts.items():
+            try:
+                await task
+            except BaseException:
+                pass
+            await _close_quietly(stream_iter)
+
+    if winner is None:
+        # every candidate failed; surface the first failure like an unhedged call
+        error = errors[0]
+        if isinstance(error, BaseException):
+            raise error
+        yield error
+        return
+
+    name, stream_iter, first = winner
+    # when a backup wins this is a lower bound of the primary's TTFT, which is
+    # exactly what should push its hedge delay up; a primary still queued on
+    # the rate limiter says nothing about the provider
+    if 0 in sent_at:
+        latency_tracker.record(model_name, time.perf_counter() - sent_at[0])
+    hedged = next_candidate > 1
+    if name != model_name:
+        _count(model_name, "backup_wins")
+
+    def tag(record):
+        if record.get("final"):
+            return {**record, "served_by": name, "hedged": hedged}
+        return record
+
+    try:
+        yield tag(first)
+        async for record in stream_iter:
+            yield tag(record)
+    finally:
+        await _close_quietly(stream_iter)
@@ -0,0 +1,304 @@
+"""Spread one logical endpoint over several API keys and/or bases.
+
+An endpoint entry in `src/config/api_endpoint*.json` can list extra keys or
+bases next to (or instead of) its `api_key`/`api_base`:
+
+    "gpt-4o-2024-11-20": {
+        "model_name": "gpt-4o-2024-11-20",
+        "api_type": "openai",
+        "api_base": "https://api.openai.com/v1",
+        "api_keys": ["sk-team-a", "sk-team-b"],
+        "balancing": {
+            "strategy": "least_outstanding",
+            "quarantine_seconds": 30,
+            "auth_quarantine_seconds": 600
+        }
+    }
+
+The shipped `src/config/api_endpoint.json` keeps a single `api_key` per entry;
+replace it with `api_keys` (and optionally `balancing`) to turn balancing on.
+
+`api_keys` share the entry's `api_base` and `api_bases` share its `api_key`;
+with both, they are paired by position. For anything else, `upstreams` lists
+the members explicitly, each with an optional `weight`:
+
+    "upstreams": [
+        {"api_key": "sk-us", "api_base": "https://us.example.com/v1", "weight": 2},
+        {"api_key": "sk-eu", "api_base": "https://eu.example.com/v1"}
+    ]
+
+Every provider request picks a member, by fewest requests in flight relative to
+its weight (`least_outstanding`, the default) or by `weighted_round_robin`. A
+member answering 429 is taken out of rotation for its `retry-after` (at least
+`quarantine_seconds`), one answering 401/403 for `auth_quarantine_seconds`; a
+retry then lands on another member. Rotation state is per worker process,
+while the rate limiter already keeps one bucket per key across workers.
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import defaultdict
+
+from fastchat.utils import build_logger
+
+
+logger = build_logger("web_server", "web_server.log")
+
+DEFAULT_BALANCING_CONFIG = {
+    "strategy": "least_outstanding",
+    "quarantine_seconds": 30.0,
+    "auth_quarantine_seconds": 600.0,
+}
+BALANCING_STRATEGIES = ("least_outstanding", "weighted_round_robin")
+RATE_LIMITED_STATUS_CODES = {429}
+AUTH_FAILURE_STATUS_CODES = {401, 403}
+# error records only carry text; `**API REQUEST ERROR** Reason: status code 429.`
+_STATUS_IN_TEXT = re.compile(r"status code:? ?(\d{3})")
+_RATE_LIMITED_MARKERS = ("rate limit", "rate_limit", "too many requests", "resource_exhausted")
+_AUTH_FAILURE_MARKERS = ("invalid api key", "invalid_api_key", "incorrect api key", "unauthorized", "permission denied")
+
+
+def provider_error_status(error):
+    """HTTP status of a provider exception or error record, if it can be told."""
+    if isinstance(error, dict):
+        reason = str(error.get("text", "")).lower()
+        match = _STATUS_IN_TEXT.search(reason)
+        if match:
+            return int(match.group(1))
+        if any(marker in reason for marker in _RATE_LIMITED_MARKERS):
+            return 429
+        if any(marker in reason for marker in _AUTH_FAILURE_MARKERS):
+            return 401
+        return None
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if status is None and isinstance(getattr(error, "code", None), int):
+        status = error.code  # google.api_core exceptions
+    return status
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _fingerprint(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12] if api_key else "none"
+
+
+def is_balanced(model_api_dict):
+    return any(name in model_api_dict for name in ("api_keys", "api_bases", "upstreams"))
+
+
+def upstream_members(model_api_dict):
+    """`[(api_key, api_base, weight), ...]` of a balanced endpoint entry."""
+    if "upstreams" in model_api_dict:
+        return [
+            (
+                upstream.get("api_key", model_api_dict.get("api_key")),
+                upstream.get("api_base", model_api_dict.get("api_base")),
+                upstream.get("weight", 1),
+            )
+            for upstream in model_api_dict["upstreams"]
+        ]
+    api_keys = model_api_dict.get("api_keys")
+    api_bases = model_api_dict.get("api_bases")
+    if api_keys and api_bases:
+        if len(api_keys) != len(api_bases):
+            raise ValueError(
+                f'{model_api_dict["model_name"]}: api_keys and api_bases are paired and must have the same length'
+            )
+        return [(api_key, api_base, 1) for api_key, api_base in zip(api_keys, api_bases)]
+    if api_keys:
+        return [(api_key, model_api_dict.get("api_base"), 1) for api_key in api_keys]
+    return [(model_api_dict.get("api_key"), api_base, 1) for api_base in api_bases]
+
+
+def balancing_config(model_api_dict):
+    config = {**DEFAULT_BALANCING_CONFIG, **model_api_dict.get("balancing", {})}
+    if config["strategy"] not in BALANCING_STRATEGIES:
+        raise ValueError(f'unknown balancing strategy {config["strategy"]!r}, expected one of {BALANCING_STRATEGIES}')
+    return config
+
+
+class KeyBalancer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # per member (one api key on one base), shared by every entry using it
+        self._members = defaultdict(
+            lambda: {
+                "outstanding": 0,
+                "requests": 0,
+                "rate_limited": 0,
+                "auth_failures": 0,
+                "quarantined_until": 0.0,
+            }
+        )
+        # smooth weighted round-robin position per entry
+        self._current_weights = defaultdict(dict)
+        # member ids per entry, for the stats
+        self._entries = {}
+
+    @staticmethod
+    def member_id(model_api_dict, api_key, api_base):
+        return f'{model_api_dict["api_type"]}/{api_base or "default"}/{_fingerprint(api_key)}'
+
+    def _pick(self, entry, config, members, now):
+        available = [m for m in members if self._members[m[0]]["quarantined_until"] <= now]
+        if not available:
+            # everything is quarantined; the member that comes back first is the best bet
+            return min(members, key=lambda m: self._members[m[0]]["quarantined_until"])
+        if config["strategy"] == "weighted_round_robin":
+            current = self._current_weights[entry]
+            total = sum(weight for _, weight in available)
+            for member, weight in available:
+                current[member] = current.get(member, 0) + weight
+            chosen = max(available, key=lambda m: current[m[0]])
+            current[chosen[0]] -= total
+            return chosen
+        # ties (e.g. nothing in flight) go to the member that has served the least
+        return min(
+            available,
+            key=lambda m: (
+                (self._members[m[0]]["outstanding"] + 1) / m[1],
+                self._members[m[0]]["requests"] / m[1],
+            ),
+        )
+
+    def acquire(self, model_api_dict):
+        """Pick a member of the entry; returns `(member_id, model_api_dict for that member)`."""
+        config = balancing_config(model_api_dict)
+        entry = model_api_dict["model_name"]
+        upstreams = {
+            self.member_id(model_api_dict, api_key, api_base): (api_key, api_base, weight)
+            for api_key, api_base, weight in upstream_members(model_api_dict)
+        }
+        members = [(member, weight) for member, (_, _, weight) in upstreams.items() if weight > 0]
+        now = time.monotonic()
+        with self._lock:
+            self._entries[entry] = [member for member, _ in members]
+            member, _ = self._pick(entry, config, members, now)
+            state = self._members[member]
+            state["outstanding"] += 1
+            state["requests"] += 1
+            if state["quarantined_until"] > now:
+                logger.warning(f"{entry}: every upstream is quarantined, using {member} anyway")
+        api_key, api_base, _ = upstreams[member]
+        member_api_dict = {
+            name: value
+            for name, value in model_api_dict.items()
+            if name not in ("api_keys", "api_bases", "upstreams", "balancing")
+        }
+        member_api_dict.update(api_key=api_key, api_base=api_base)
+        return member, member_api_dict
+
+    def release(self, member, model_api_dict, error=None):
+        """Return the member; an `error` of 429 or 401/403 takes it out of rotation."""
+        status = provider_error_status(error) if error is not None else None
+        config = balancing_config(model_api_dict)
+        quarantine = None
+        with self._lock:
+            state = self._members[member]
+            state["outstanding"] -= 1
+            if status in RATE_LIMITED_STATUS_CODES:
+                state["rate_limited"] += 1
+                quarantine = max(config["quarantine_seconds"], _retry_after(error) or 0.0)
+            elif status in AUTH_FAILURE_STATUS_CODES:
+                state["auth_failures"] += 1
+                quarantine = config["auth_quarantine_seconds"]
+            if quarantine is not None:
+                state["quarantined_until"] = max(state["quarantined_until"], time.monotonic() + quarantine)
+        if quarantine is not None:
+            logger.warning(f"{member} answered {status}, out of rotation for {quarantine:.0f}s")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                entry: {
+                    member: {
+                        **{k: v for k, v in self._members[member].items() if k != "quarantined_until"},
+                        "quarantined_for": max(0.0, self._members[member]["quarantined_until"] - now),
+                    }
+                    for member in members
+                }
+                for entry, members in self._entries.items()
+            }
+
+
+key_balancer = KeyBalancer()
+
+
+def balanced_stream_iter(model_api_dict, stream_iter_fn):
+    """Run `stream_iter_fn(member_api_dict)` against a member of a balanced entry."""
+    member, member_api_dict = key_balancer.acquire(model_api_dict)
+    error = None
+    try:
+        for data in stream_iter_fn(member_api_dict):
+            if data["error_code"] != 0:
+                error = data
+            yield data
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        key_balancer.release(member, model_api_dict, error)
+
+
+async def async_balanced_stream_iter(model_api_dict, stream_iter_fn):
+    """Async `balanced_stream_iter`."""
+    member, member_api_dict = key_balancer.acquire(model_api_dict)
+    error = None
+    stream_iter = stream_iter_fn(member_api_dict)
+    try:
+        async for data in stream_iter:
+            if data["error_code"] != 0:
+                error = data
+            yield data
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        try:
+            await stream_iter.aclose()
+        finally:
+            key_balancer.release(member, model_api_dict, error)
+
+
+def balanced_call(model_api_dict, fn):
+    """Call `fn(member_api_dict)`; with a single key and base, `fn(model_api_dict)`."""
+    if not is_balanced(model_api_dict):
+        return fn(model_api_dict)
+    member, member_api_dict = key_balancer.acquire(model_api_dict)
+    error = None
+    try:
+        return fn(member_api_dict)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        key_balancer.release(member, model_api_dict, error)
+
+
+async def async_balanced_call(model_api_dict, fn):
+    """Async `balanced_call`; `fn(member_api_dict)` returns an awaitable."""
+    if not is_balanced(model_api_dict):
+        return await fn(model_api_dict)
+    member, member_api_dict = key_balancer.acquire(model_api_dict)
+    error = None
+    try:
+        return await fn(member_api_dict)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        key_balancer.release(member, model_api_dict, error)
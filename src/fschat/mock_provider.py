@@ -0,0 +1,276 @@
+"""Mock provider (`"api_type": "mock"`) for offline load testing.
+
+Streams canned, game-aware replies with sampled latencies and injected faults,
+so the whole FastAPI stack (retries, breakers, rate limits, caches) can be
+benchmarked without paying for a provider. An endpoint entry configures it with
+a `mock` block; every key is optional:
+
+    "mock-fast": {
+        "model_name": "mock-fast",
+        "api_type": "mock",
+        ...
+        "mock": {
+            "ttft": {"median": 0.4, "sigma": 0.5},
+            "tokens_per_second": {"median": 60, "sigma": 0.3},
+            "guess_rate": 0.2,
+            "faults": {"rate_limit": 0.02, "server_error": 0.01, "error": 0.0,
+                       "truncate": 0.02, "stall": 0.01},
+            "retry_after": 1.0,
+            "stall_seconds": 30.0,
+            "seed": null
+        }
+    }
+
+A distribution is a number (fixed), `{"median", "sigma"}` (lognormal) or
+`{"min", "max"}` (uniform). Fault rates are per request. With a `seed` the reply
+and timings only depend on the messages, so runs are repeatable.
+"""
+
+import asyncio
+import hashlib
+import math
+import random
+import re
+import time
+from types import SimpleNamespace
+
+from src.fschat.api_provider_game import completion_record, usage_record
+from src.fschat.rate_limiter import CHARS_PER_TOKEN, rate_limiter
+
+
+MOCK_DEFAULTS = {
+    "ttft": {"median": 0.4, "sigma": 0.5},
+    "tokens_per_second": {"median": 60, "sigma": 0.3},
+    "guess_rate": 0.2,
+    "faults": {},
+    "retry_after": 1.0,
+    "stall_seconds": 30.0,
+    "seed": None,
+}
+FAULTS = ("rate_limit", "server_error", "error", "truncate", "stall")
+
+OBJECTS = ["apple", "bicycle", "guitar", "umbrella", "lamp", "penguin", "clock", "rocket"]
+QUESTIONS = [
+    "Is it something you can hold in one hand?",
+    "Is it alive?",
+    "Is it usually found indoors?",
+    "Is it made of metal?",
+    "Can it be eaten?",
+    "Is it used for transportation?",
+    "Does it make a sound?",
+]
+ANSWERS = [
+    "It is something many people use every day.",
+    "You would most likely find it at home.",
+    "It is smaller than a car but bigger than a coin.",
+    "Some people collect them.",
+]
+
+
+class MockProviderError(Exception):
+    """An injected HTTP error, classified like a real provider's."""
+
+    def __init__(self, status_code, retry_after=None):
+        headers = {} if retry_after is None else {"retry-after": str(retry_after)}
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+        super().__init__(f"mock provider returned {status_code}")
+
+
+def _sample(rng, spec):
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    if "median" in spec:
+        return rng.lognormvariate(math.log(spec["median"]), spec.get("sigma", 0.0))
+    return rng.uniform(spec["min"], spec["max"])
+
+
+def _text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, dict):
+        return content.get("text", "")
+    return " ".join(_text(part) for part in content)
+
+
+# ------------------------------- canned replies ------------------------------ #
+
+def _akinator(rng, round, guess_rate, prompt):
+    if rng.random() < guess_rate:
+        return f"This is a guess: is it a {rng.choice(OBJECTS)}?"
+    return f"Question {round}: {rng.choice(QUESTIONS)}"
+
+
+def _taboo(rng, round, guess_rate, prompt):
+    if rng.random() < guess_rate:
+        return f"My guess of the word is: {rng.choice(OBJECTS)}."
+    return rng.choice(ANSWERS)
+
+
+def _bluffing(rng, round, guess_rate, prompt):
+    if rng.random() < guess_rate:
+        return f"I believe your statement is: {rng.choice(['true', 'false'])}"
+    return f"Question {round}: {rng.choice(['When did that happen?', 'Who was with you?', 'Why did you do it?'])}"
+
+
+def _story(rng, round, guess_rate, prompt):
+    return (
+        "## Scenario\nA coolant pipe bursts and fills the corridor with freezing fog.\n"
+        "## Choice A\nSeal the valve by hand.\n"
+        "## Choice B\nCrawl through the maintenance duct."
+    )
+
+
+def _character(rng, round, guess_rate, prompt):
+    # NPCs and actions are parsed out of <...> tags listed in the system prompt
+    tags = re.findall(r"<[^<>\n]+>", prompt) or ["<Nod>"]
+    return f"{rng.choice(tags)} Hello there, traveller. {rng.choice(ANSWERS)}"
+
+
+def _assistant_questions(rng, round, guess_rate, prompt):
+    first, second = rng.sample(QUESTIONS, 2)
+    return f"Question 1: {first}\nQuestion 2: {second}"
+
+
+def _assistant_answers(rng, round, guess_rate, prompt):
+    first, second = rng.sample(ANSWERS, 2)
+    return f"Answer 1: {first}\nAnswer 2: {second}"
+
+
+def _taboo_hint(rng, round, guess_rate, prompt):
+    return (
+        f"At this step, the model is thinking about: {', '.join(rng.sample(OBJECTS, 3))}. "
+        "Try asking about where it is used."
+    )
+
+
+def _bluffing_hint(rng, round, guess_rate, prompt):
+    prediction = rng.choice(["True", "Possibly true", "Unknown", "Possibly false", "False"])
+    return f"At this step, the model believe your statement is: {prediction}. Add a concrete detail."
+
+
+def _akinator_hint(rng, round, guess_rate, prompt):
+    return rng.choice(["Yes", "No", "Probably Yes", "Probably No", "Don't Know"])
+
+
+def _default(rng, round, guess_rate, prompt):
+    return rng.choice(ANSWERS)
+
+
+# first match wins; markers are looked up in the lowercased system prompt + last user turn
+REPLIES = [
+    (("answer 1:",), _assistant_answers),
+    (("question 1:", "question 2:"), _assistant_questions),
+    (("model is thinking about",), _taboo_hint),
+    (("model believe your statement",), _bluffing_hint),
+    (("answer only with yes, no",), _akinator_hint),
+    (("## choice a",), _story),
+    (("available animations",), _character),
+    (("available actions",), _character),
+    (("twenty questions",), _akinator),
+    (("word-guessing",), _taboo),
+    (("lie detection",), _bluffing),
+]
+
+
+def mock_reply(messages, rng, guess_rate=MOCK_DEFAULTS["guess_rate"]):
+    """Canned reply in the format the game behind `messages` parses."""
+    system = _text(messages[0]["content"]) if messages and messages[0]["role"] == "system" else ""
+    last_user = next((_text(m["content"]) for m in reversed(messages) if m["role"] == "user"), "")
+    prompt = f"{system}\n{last_user}"
+    lowered = prompt.lower()
+    round = sum(m["role"] == "assistant" for m in messages) + 1
+    for markers, reply in REPLIES:
+        if all(marker in lowered for marker in markers):
+            return reply(rng, round, guess_rate, prompt)
+    return _default(rng, round, guess_rate, prompt)
+
+
+# -------------------------------- streaming --------------------------------- #
+
+def _pick_fault(rng, faults):
+    roll = rng.random()
+    for fault in FAULTS:
+        roll -= faults.get(fault, 0.0)
+        if roll < 0:
+            return fault
+    return None
+
+
+def _apply_stop(text, stop):
+    """Cut `text` before the first stop sequence, as a provider would."""
+    cuts = [text.find(seq) for seq in stop or () if seq in text]
+    return text[:min(cuts)] if cuts else text
+
+
+def mock_events(messages, max_new_tokens, mock_config=None, stop=None):
+    """Yield `("sleep", seconds)`, `("observe", response)`, `("record", data)` and `("raise", error)` steps.
+
+    Shared by the sync and async streams, which only differ in how they sleep.
+    """
+    config = {**MOCK_DEFAULTS, **(mock_config or {})}
+    if config["seed"] is None:
+        rng = random.Random()
+    else:
+        digest = hashlib.sha256(repr((config["seed"], messages)).encode()).hexdigest()
+        rng = random.Random(digest)
+
+    fault = _pick_fault(rng, config["faults"])
+    if fault == "rate_limit":
+        error = MockProviderError(429, retry_after=config["retry_after"])
+        # let the shared bucket back off exactly as it would for a real 429
+        yield "observe", error.response
+        yield "raise", error
+        return
+    yield "sleep", _sample(rng, config["ttft"])
+    if fault == "server_error":
+        yield "raise", MockProviderError(503)
+        return
+    if fault == "error":
+        yield "record", {"text": "**API REQUEST ERROR** Reason: mock provider overloaded.", "error_code": 1}
+        return
+
+    reply = _apply_stop(mock_reply(messages, rng, config["guess_rate"]), stop)
+    tokens = re.findall(r"\S+\s*", reply)
+    finish_reason = "stop"
+    if max_new_tokens is not None and len(tokens) > max_new_tokens:
+        tokens, finish_reason = tokens[:max_new_tokens], "length"
+    cut = rng.randrange(len(tokens)) if fault in ("truncate", "stall") and tokens else None
+    tokens_per_second = max(_sample(rng, config["tokens_per_second"]), 1e-3)
+    for i, token in enumerate(tokens):
+        if i == cut and fault == "truncate":
+            yield "raise", ConnectionResetError("mock stream truncated: connection reset")
+            return
+        if i == cut and fault == "stall":
+            yield "sleep", config["stall_seconds"]
+        if i:
+            yield "sleep", 1 / tokens_per_second
+        yield "record", {"delta": token, "error_code": 0}
+
+    input_tokens = sum(len(_text(m["content"])) for m in messages) // CHARS_PER_TOKEN
+    yield "record", completion_record(finish_reason, usage_record(input_tokens, len(tokens)))
+
+
+def mock_api_delta_iter(messages, max_new_tokens, mock_config=None, stop=None):
+    for kind, value in mock_events(messages, max_new_tokens, mock_config, stop):
+        if kind == "sleep":
+            time.sleep(value)
+        elif kind == "observe":
+            rate_limiter.observe(value)
+        elif kind == "raise":
+            raise value
+        else:
+            yield value
+
+
+async def mock_api_async_delta_iter(messages, max_new_tokens, mock_config=None, stop=None):
+    for kind, value in mock_events(messages, max_new_tokens, mock_config, stop):
+        if kind == "sleep":
+            await asyncio.sleep(value)
+        elif kind == "observe":
+            # the rate limiter writes to sqlite; keep it off the event loop
+            await asyncio.to_thread(rate_limiter.observe, value)
+        elif kind == "raise":
+            raise value
+        else:
+            yield value
@@ -0,0 +1,248 @@
+"""Per-model circuit breakers and health-weighted model selection.
+
+Every provider request reports its outcome here. A model whose recent error rate
+or consecutive failures cross the thresholds is opened (skipped by new games)
+for a cooldown that doubles on every re-trip; after it a single probe request is
+let through (half-open) and its outcome closes or re-opens the breaker. Healthy
+models are weighted by success rate and by how their time-to-first-token
+compares to `SLOW_TTFT_SECONDS`.
+
+State is per process.
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+
+
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", 20))
+BREAKER_MIN_REQUESTS = int(os.environ.get("BREAKER_MIN_REQUESTS", 5))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", 0.5))
+BREAKER_CONSECUTIVE_FAILURES = int(os.environ.get("BREAKER_CONSECUTIVE_FAILURES", 3))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", 30.0))
+BREAKER_MAX_OPEN_SECONDS = float(os.environ.get("BREAKER_MAX_OPEN_SECONDS", 300.0))
+# a first token slower than this starts to cost the model selection weight
+SLOW_TTFT_SECONDS = float(os.environ.get("SLOW_TTFT_SECONDS", 8.0))
+HALF_OPEN_WEIGHT = 0.1
+LATENCY_EWMA_ALPHA = 0.3
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.consecutive_failures = 0
+        self.latency_ewma = None
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.opened_at = None
+        self.probe_started_at = None
+        self.trips = 0
+        self.last_error = None
+
+    def _refresh(self, now):
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self.probe_started_at = None
+
+    def _trip(self, now):
+        if self.state == HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def allow(self, now):
+        """Whether a new game may be started on this model right now."""
+        self._refresh(now)
+        if self.state == CLOSED:
+            return True
+        # a probe game that never reported back must not block the model forever
+        if self.state == HALF_OPEN and (
+            self.probe_started_at is None or now - self.probe_started_at >= self.open_seconds
+        ):
+            self.probe_started_at = now
+            return True
+        return False
+
+    def record_success(self, latency, now):
+        self._refresh(now)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        if latency is not None:
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self.open_seconds = BREAKER_OPEN_SECONDS
+            self.outcomes.clear()
+            self.outcomes.append(True)
+
+    def record_failure(self, error, now):
+        self._refresh(now)
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        self.last_error = str(error)[:200]
+        if self.state == HALF_OPEN:
+            self._trip(now)
+        elif self.state == CLOSED and (
+            self.consecutive_failures >= BREAKER_CONSECUTIVE_FAILURES
+            or (
+                len(self.outcomes) >= BREAKER_MIN_REQUESTS
+                and self.error_rate() >= BREAKER_ERROR_RATE
+            )
+        ):
+            self._trip(now)
+
+    def weight(self, now):
+        self._refresh(now)
+        if self.state == OPEN:
+            return 0.0
+        if self.state == HALF_OPEN:
+            return HALF_OPEN_WEIGHT
+        weight = 1.0 - self.error_rate()
+        if self.latency_ewma is not None and self.latency_ewma > SLOW_TTFT_SECONDS:
+            weight *= SLOW_TTFT_SECONDS / self.latency_ewma
+        return weight
+
+    def stats(self, now):
+        self._refresh(now)
+        return {
+            "state": self.state,
+            "weight": round(self.weight(now), 3),
+            "error_rate": round(self.error_rate(), 3),
+            "requests_in_window": len(self.outcomes),
+            "consecutive_failures": self.consecutive_failures,
+            "ttft_ewma": self.latency_ewma,
+            "trips": self.trips,
+            "reopens_in": (
+                max(0.0, self.opened_at + self.open_seconds - now) if self.state == OPEN else None
+            ),
+            "last_error": self.last_error,
+        }
+
+
+class ModelHealth:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def _breaker(self, model_name):
+        breaker = self._breakers.get(model_name)
+        if breaker is None:
+            breaker = self._breakers[model_name] = CircuitBreaker(model_name)
+        return breaker
+
+    def record_success(self, model_name, latency=None):
+        with self._lock:
+            self._breaker(model_name).record_success(latency, time.monotonic())
+
+    def record_failure(self, model_name, error=None):
+        with self._lock:
+            self._breaker(model_name).record_failure(error, time.monotonic())
+
+    def is_open(self, model_name):
+        """Whether the breaker of `model_name` is currently rejecting the model."""
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breaker(model_name)
+            breaker._refresh(now)
+            return breaker.state == OPEN
+
+    def choose_model(self, models):
+        """Weighted pick among `models`; open breakers are skipped.
+
+        Falls back to a uniform pick when every model is unhealthy, so starting a
+        game never fails because of the breakers.
+        """
+        now = time.monotonic()
+        with self._lock:
+            weights = [self._breaker(m).weight(now) for m in models]
+            if sum(weights) > 0:
+                choice = random.choices(models, weights=weights)[0]
+            else:
+                choice = random.choice(models)
+            # a half-open model gets one probe game at a time
+            breaker = self._breaker(choice)
+            if breaker.state == HALF_OPEN and not breaker.allow(now):
+                healthy = [m for m, w in zip(models, weights) if w > 0 and self._breaker(m).state == CLOSED]
+                if healthy:
+                    choice = random.choice(healthy)
+        return choice
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {name: breaker.stats(now) for name, breaker in sorted(self._breakers.items())}
+
+
+model_health = ModelHealth()
+
+
+# ----------------------------- request tracking ------------------------------ #
+
+def _is_failure(record):
+    return record["error_code"] != 0
+
+
+def track_stream_iter(model_name, stream_iter):
+    """Report the outcome of a sync delta stream to the breaker of `model_name`."""
+    start = time.perf_counter()
+    ttft = None
+    try:
+        for data in stream_iter:
+            if _is_failure(data):
+                model_health.record_failure(model_name, data.get("text"))
+                yield data
+                return
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            yield data
+    except GeneratorExit:
+        # the consumer stopped early (e.g. a stream watcher); once tokens were
+        # flowing that still counts as a healthy response
+        if ttft is not None:
+            model_health.record_success(model_name, ttft)
+        raise
+    except Exception as e:
+        model_health.record_failure(model_name, e)
+        raise
+    model_health.record_success(model_name, ttft)
+
+
+async def track_async_stream_iter(model_name, stream_iter):
+    """Report the outcome of an async delta stream to the breaker of `model_name`."""
+    start = time.perf_counter()
+    ttft = None
+    try:
+        async for data in stream_iter:
+            if _is_failure(data):
+                model_health.record_failure(model_name, data.get("text"))
+                yield data
+                return
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            yield data
+    except GeneratorExit:
+        if ttft is not None:
+            model_health.record_success(model_name, ttft)
+        raise
+    except Exception as e:
+        model_health.record_failure(model_name, e)
+        raise
+    finally:
+        await stream_iter.aclose()
+    model_health.record_success(model_name, ttft)
@@ -0,0 +1,294 @@
+"""Latency and throughput histograms of every provider request.
+
+Each attempt sent to a provider (after the rate limiter let it through) is
+timed here, tagged with its model, `api_type` and call type (`question`,
+`answer`, `hint`, `assistant`, `npc`, ...; set by the game around the turn):
+
+    provider_ttft_seconds                first delta of a streamed answer
+    provider_inter_chunk_seconds         gap between two deltas of a stream
+    provider_duration_seconds            whole request, streamed or not
+    provider_output_tokens_per_second    output tokens over the generation time
+    provider_requests_total              by outcome: ok, cancelled or an error class
+
+`/metrics` serves them in the Prometheus text format and
+`/monitor/provider_latency` summarizes them per model. Like the breakers, the
+numbers are per worker process.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+from src.fschat.key_balancer import provider_error_status
+from src.fschat.rate_limiter import CHARS_PER_TOKEN
+
+
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+INTER_CHUNK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DURATION_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0)
+TOKENS_PER_SECOND_BUCKETS = (5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0)
+LABEL_NAMES = ("model", "api_type", "call_type")
+
+current_call_type = contextvars.ContextVar("provider_call_type", default="other")
+
+
+@contextlib.contextmanager
+def call_type(name):
+    """Tag the provider requests made in the body of the `with` as `name` calls."""
+    token = current_call_type.set(name)
+    try:
+        yield
+    finally:
+        current_call_type.reset(token)
+
+
+def error_class(error):
+    """Short label of a provider exception or error record."""
+    status = provider_error_status(error)
+    if status is not None:
+        return f"http_{status}"
+    if isinstance(error, dict):
+        return "error_record"
+    name = type(error).__name__
+    if isinstance(error, TimeoutError) or "Timeout" in name:
+        return "timeout"
+    if isinstance(error, ConnectionError) or "Connect" in name or name in ("TransportError", "RemoteProtocolError"):
+        return "connection"
+    return name
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        # `le` buckets: the first bound >= value
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, labels_list, q):
+        """Estimate of the `q` quantile over the series of `labels_list`, as Prometheus does."""
+        counts = [0] * (len(self.buckets) + 1)
+        for labels in labels_list:
+            series = self.series.get(labels)
+            if series is not None:
+                counts = [total + count for total, count in zip(counts, series[0])]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    # in +Inf: the highest finite bound is all that can be said
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _label_text(names, values):
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class ProviderMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ttft = Histogram(
+            "provider_ttft_seconds", "Time to the first delta of a streamed provider answer.", TTFT_BUCKETS
+        )
+        self.inter_chunk = Histogram(
+            "provider_inter_chunk_seconds", "Gap between two deltas of a provider stream.", INTER_CHUNK_BUCKETS
+        )
+        self.duration = Histogram(
+            "provider_duration_seconds", "Duration of a provider request.", DURATION_BUCKETS
+        )
+        self.tokens_per_second = Histogram(
+            "provider_output_tokens_per_second",
+            "Output tokens per second of generation (after the first delta when streamed).",
+            TOKENS_PER_SECOND_BUCKETS,
+        )
+        self._requests = defaultdict(int)
+
+    def record(self, model_name, api_type, outcome, ttft=None, gaps=(), duration=None, output_tokens=None):
+        labels = (model_name, api_type, current_call_type.get())
+        with self._lock:
+            self._requests[labels + (outcome,)] += 1
+            if ttft is not None:
+                self.ttft.observe(labels, ttft)
+            for gap in gaps:
+                self.inter_chunk.observe(labels, gap)
+            if duration is None:
+                return
+            self.duration.observe(labels, duration)
+            generation = duration - (ttft or 0.0)
+            if output_tokens and generation > 0:
+                self.tokens_per_second.observe(labels, output_tokens / generation)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for histogram in (self.ttft, self.inter_chunk, self.duration, self.tokens_per_second):
+                lines.append(f"# HELP {histogram.name} {histogram.help}")
+                lines.append(f"# TYPE {histogram.name} histogram")
+                for labels, (counts, total, count) in sorted(histogram.series.items()):
+                    label_text = _label_text(LABEL_NAMES, labels)
+                    cumulative = 0
+                    for bound, bucket_count in zip(histogram.buckets + ("+Inf",), counts):
+                        cumulative += bucket_count
+                        lines.append(f'{histogram.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                    lines.append(f"{histogram.name}_sum{{{label_text}}} {total}")
+                    lines.append(f"{histogram.name}_count{{{label_text}}} {count}")
+            lines.append("# HELP provider_requests_total Provider requests by outcome.")
+            lines.append("# TYPE provider_requests_total counter")
+            for labels, count in sorted(self._requests.items()):
+                lines.append(f"provider_requests_total{{{_label_text(LABEL_NAMES + ('outcome',), labels)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Per model: request outcomes and p50/p95 of the histograms over every call type."""
+        with self._lock:
+            by_model = defaultdict(lambda: {"requests": 0, "outcomes": defaultdict(int), "call_types": set()})
+            for (model_name, api_type, call_type_name, outcome), count in self._requests.items():
+                stats = by_model[model_name]
+                stats["requests"] += count
+                stats["outcomes"][outcome] += count
+                stats["call_types"].add((model_name, api_type, call_type_name))
+            summary = {}
+            for model_name, stats in by_model.items():
+                labels_list = sorted(stats["call_types"])
+                summary[model_name] = {
+                    "requests": stats["requests"],
+                    "outcomes": dict(stats["outcomes"]),
+                    "call_types": sorted({labels[2] for labels in labels_list}),
+                    **{
+                        f"{name}_p{int(q * 100)}": histogram.quantile(labels_list, q)
+                        for name, histogram in (
+                            ("ttft", self.ttft),
+                            ("inter_chunk", self.inter_chunk),
+                            ("duration", self.duration),
+                            ("tokens_per_second", self.tokens_per_second),
+                        )
+                        for q in (0.5, 0.95)
+                    },
+                }
+            return summary
+
+
+provider_metrics = ProviderMetrics()
+
+
+class _StreamTimer:
+    """Timings of one provider stream, started when its first record is asked for."""
+
+    def __init__(self, model_name, api_type):
+        self.model_name = model_name
+        self.api_type = api_type
+        self.start = time.perf_counter()
+        self.last = None
+        self.ttft = None
+        self.gaps = []
+        self.output_chars = 0
+        self.output_tokens = None
+        self.finished = False
+
+    def observe(self, data):
+        if data.get("final"):
+            self.finished = True
+            self.output_tokens = (data.get("usage") or {}).get("output_tokens")
+        if not data.get("delta"):
+            return
+        now = time.perf_counter()
+        if self.last is None:
+            self.ttft = now - self.start
+        else:
+            self.gaps.append(now - self.last)
+        self.last = now
+        self.output_chars += len(data["delta"])
+
+    def record(self, error=None):
+        if error is not None:
+            outcome = error_class(error)
+        elif not self.finished:
+            # closed early by a hedge, a stream watcher or a disconnect: no full duration
+            provider_metrics.record(self.model_name, self.api_type, "cancelled", self.ttft, self.gaps)
+            return
+        else:
+            outcome = "ok"
+        provider_metrics.record(
+            self.model_name,
+            self.api_type,
+            outcome,
+            self.ttft,
+            self.gaps,
+            time.perf_counter() - self.start,
+            self.output_tokens or self.output_chars // CHARS_PER_TOKEN,
+        )
+
+
+def timed_stream_iter(model_name, model_api_dict, stream_iter):
+    """Time a sync delta stream of one provider request."""
+    timer = _StreamTimer(model_name, model_api_dict["api_type"])
+    error = None
+    try:
+        for data in stream_iter:
+            if data["error_code"] != 0:
+                error = data
+            else:
+                timer.observe(data)
+            yield data
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        timer.record(error)
+
+
+async def timed_async_stream_iter(model_name, model_api_dict, stream_iter):
+    """Time an async delta stream of one provider request."""
+    timer = _StreamTimer(model_name, model_api_dict["api_type"])
+    error = None
+    try:
+        async for data in stream_iter:
+            if data["error_code"] != 0:
+                error = data
+            else:
+                timer.observe(data)
+            yield data
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        try:
+            await stream_iter.aclose()
+        finally:
+            timer.record(error)
+
+
+def record_complete(model_name, model_api_dict, start, result=None, error=None):
+    """Time a non-streaming provider request that began at `start`."""
+    output_tokens = None
+    if result is not None:
+        output_tokens = (result.usage or {}).get("output_tokens") or len(result.text) // CHARS_PER_TOKEN
+    provider_metrics.record(
+        model_name,
+        model_api_dict["api_type"],
+        "ok" if error is None else error_class(error),
+        duration=time.perf_counter() - start,
+        output_tokens=output_tokens,
+    )
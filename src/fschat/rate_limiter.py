@@ -0,0 +1,503 @@
+"""Token-bucket rate limiter shared by every worker process.
+
+`gunicorn -w 4` runs four independent copies of the app, so the buckets live in a
+small sqlite database (`RATE_LIMIT_DB`) instead of process memory. There is one
+bucket per (api_type, model, api key) holding a requests-per-minute and a
+tokens-per-minute budget:
+
+    "gpt-4o-2024-11-20": {
+        ...
+        "rate_limit": {"rpm": 500, "tpm": 30000}
+    }
+
+The limits tighten themselves from the `x-ratelimit-*` / `anthropic-ratelimit-*`
+headers providers return, and a 429 blocks the bucket for its `retry-after`.
+Callers over budget are queued: they reserve their share (the bucket goes into
+debt) and sleep until it is theirs, so waiting requests are served in order
+instead of failing. A caller never waits past the point where its turn's retry
+deadline leaves no time for the request itself (`RetryPolicy.latest_start`).
+A call that is cancelled, fails or is closed early gives back the part of its
+reservation it did not use.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from fastchat.utils import build_logger
+
+
+logger = build_logger("web_server", "web_server.log")
+
+RATE_LIMIT_DB = os.environ.get(
+    "RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "ai_space_escape_rate_limits.sqlite")
+)
+# longest wait of a call made outside a retry loop (one inside waits at most
+# until its `current_start_deadline`); past it the provider gets to decide
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 20.0))
+# rough prompt-size estimate until the provider reports real usage
+CHARS_PER_TOKEN = 4
+
+RateLimitBucket = namedtuple("RateLimitBucket", ["key", "rpm", "tpm"])
+
+# bucket of the provider call in flight, for the HTTP response hook
+current_bucket = contextvars.ContextVar("rate_limit_bucket", default=None)
+# latest `time.monotonic()` at which the call in flight may still send its request
+current_start_deadline = contextvars.ContextVar("rate_limit_start_deadline", default=None)
+# called once an async call in flight got through its bucket and sends its request
+current_on_sent = contextvars.ContextVar("rate_limit_on_sent", default=None)
+
+_HEADER_NAMES = {
+    "limit_requests": ("x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit"),
+    "remaining_requests": ("x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining"),
+    "limit_tokens": ("x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit"),
+    "remaining_tokens": ("x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining"),
+}
+
+
+def _header_number(headers, name):
+    for header in _HEADER_NAMES[name]:
+        value = headers.get(header)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+@contextlib.contextmanager
+def start_deadline(deadline):
+    """Queue the provider requests made in the body of the `with` until `deadline` at most."""
+    token = current_start_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        current_start_deadline.reset(token)
+
+
+def deadline_stream_iter(deadline, stream_iter):
+    """`stream_iter`, its request queued until `deadline` at most.
+
+    The rate limiter waits while the first record is produced; the deadline is
+    only set around that step, so it never leaks into the consumer's context.
+    """
+    with start_deadline(deadline):
+        first = list(itertools.islice(stream_iter, 1))
+    yield from first
+    yield from stream_iter
+
+
+async def async_deadline_stream_iter(deadline, stream_iter):
+    """Async `deadline_stream_iter`."""
+    try:
+        with start_deadline(deadline):
+            try:
+                first = await stream_iter.__anext__()
+            except StopAsyncIteration:
+                return
+        yield first
+        async for data in stream_iter:
+            yield data
+    finally:
+        await stream_iter.aclose()
+
+
+def _notify_sent():
+    on_sent = current_on_sent.get()
+    if on_sent is not None:
+        on_sent()
+
+
+def bucket_for(model_api_dict):
+    api_key = model_api_dict.get("api_key")
+    fingerprint = hashlib.sha256(api_key.encode()).hexdigest()[:12] if api_key else "none"
+    limits = model_api_dict.get("rate_limit", {})
+    return RateLimitBucket(
+        f'{model_api_dict["api_type"]}/{model_api_dict["model_name"]}/{fingerprint}',
+        limits.get("rpm"),
+        limits.get("tpm"),
+    )
+
+
+def estimate_tokens(conv, max_new_tokens):
+    """Prompt plus completion budget, the way providers count a request against TPM."""
+    chars = sum(
+        len(m["content"]) if isinstance(m["content"], str) else 0
+        for m in conv.to_openai_api_messages()
+    )
+    return chars // CHARS_PER_TOKEN + (max_new_tokens or 0)
+
+
+def _effective(configured, learned):
+    limits = [limit for limit in (configured, learned) if limit]
+    return min(limits) if limits else None
+
+
+def _refill(level, limit, elapsed):
+    if limit is None:
+        return None
+    if level is None:
+        return limit
+    return min(limit, level + limit * elapsed / 60)
+
+
+class RateLimiter:
+    def __init__(self, path=RATE_LIMIT_DB):
+        self.path = path
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(
+            lambda: {"requests": 0, "queued": 0, "wait_seconds": 0.0, "max_wait": 0.0, "throttled": 0}
+        )
+
+    def _conn(self):
+        # sqlite connections must not cross threads or a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    requests REAL,
+                    tokens REAL,
+                    learned_rpm REAL,
+                    learned_tpm REAL,
+                    blocked_until REAL NOT NULL DEFAULT 0,
+                    updated REAL NOT NULL
+                )"""
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self, key):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT requests, tokens, learned_rpm, learned_tpm, blocked_until, updated FROM buckets WHERE key = ?",
+                (key,),
+            ).fetchone()
+            now = time.time()
+            if row is None:
+                conn.execute("INSERT INTO buckets (key, updated) VALUES (?, ?)", (key, now))
+                row = (None, None, None, None, 0.0, now)
+            state = dict(zip(("requests", "tokens", "learned_rpm", "learned_tpm", "blocked_until", "updated"), row))
+            yield state, now
+            conn.execute(
+                "UPDATE buckets SET requests = ?, tokens = ?, learned_rpm = ?, learned_tpm = ?, blocked_until = ?, updated = ? WHERE key = ?",
+                (
+                    state["requests"],
+                    state["tokens"],
+                    state["learned_rpm"],
+                    state["learned_tpm"],
+                    state["blocked_until"],
+                    state["updated"],
+                    key,
+                ),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _unlimited_wait(self, bucket):
+        """Seconds to wait on a bucket with no limit configured or learned; None if it has one.
+
+        Most endpoints configure no limit, so this only reads, without the write lock.
+        """
+        if bucket.rpm or bucket.tpm:
+            return None
+        row = self._conn().execute(
+            "SELECT learned_rpm, learned_tpm, blocked_until FROM buckets WHERE key = ?", (bucket.key,)
+        ).fetchone()
+        if row is None:
+            return 0.0
+        learned_rpm, learned_tpm, blocked_until = row
+        if learned_rpm or learned_tpm:
+            return None
+        # a 429 still holds the bucket
+        return max(0.0, blocked_until - time.time())
+
+    def reserve(self, bucket, tokens):
+        """Take one request and `tokens` from the bucket; return the seconds to wait."""
+        wait = self._unlimited_wait(bucket)
+        if wait is not None:
+            return wait
+        with self._transaction(bucket.key) as (state, now):
+            rpm = _effective(bucket.rpm, state["learned_rpm"])
+            tpm = _effective(bucket.tpm, state["learned_tpm"])
+            elapsed = max(0.0, now - state["updated"])
+            state["requests"] = _refill(state["requests"], rpm, elapsed)
+            state["tokens"] = _refill(state["tokens"], tpm, elapsed)
+            state["updated"] = now
+
+            wait = max(0.0, state["blocked_until"] - now)
+            if rpm:
+                state["requests"] -= 1
+                if state["requests"] < 0:
+                    wait = max(wait, -state["requests"] * 60 / rpm)
+            if tpm:
+                state["tokens"] -= tokens
+                if state["tokens"] < 0:
+                    wait = max(wait, -state["tokens"] * 60 / tpm)
+        return wait
+
+    def settle(self, bucket, estimated, actual):
+        """Give back (or charge) the difference between the estimated and real token count."""
+        if actual is None or estimated == actual or self._unlimited_wait(bucket) is not None:
+            return
+        with self._transaction(bucket.key) as (state, now):
+            tpm = _effective(bucket.tpm, state["learned_tpm"])
+            if state["tokens"] is not None and tpm:
+                state["tokens"] = min(tpm, state["tokens"] + estimated - actual)
+
+    def learn(self, key, status_code, headers):
+        """Tighten the bucket from a provider response's rate-limit headers."""
+        limit_requests = _header_number(headers, "limit_requests")
+        remaining_requests = _header_number(headers, "remaining_requests")
+        limit_tokens = _header_number(headers, "limit_tokens")
+        remaining_tokens = _header_number(headers, "remaining_tokens")
+        retry_after = None
+        if status_code == 429:
+            try:
+                retry_after = float(headers.get("retry-after", 1.0))
+            except ValueError:
+                retry_after = 1.0
+        if retry_after is None and limit_requests is None and limit_tokens is None:
+            return
+
+        with self._transaction(key) as (state, now):
+            if limit_requests:
+                state["learned_rpm"] = limit_requests
+            if limit_tokens:
+                state["learned_tpm"] = limit_tokens
+            # the provider also counts traffic we cannot see (other servers, scripts)
+            if remaining_requests is not None:
+                state["requests"] = min(
+                    remaining_requests,
+                    state["requests"] if state["requests"] is not None else remaining_requests,
+                )
+            if remaining_tokens is not None:
+                state["tokens"] = min(
+                    remaining_tokens,
+                    state["tokens"] if state["tokens"] is not None else remaining_tokens,
+                )
+            if retry_after is not None:
+                state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+        if retry_after is not None:
+            self._count(key, "throttled")
+            logger.warning(f"rate limit hit for {key}, holding the bucket for {retry_after:.1f}s")
+
+    def observe(self, response):
+        """httpx response hook: learn from the response to the call in flight, if any."""
+        key = current_bucket.get()
+        if key is None:
+            return
+        try:
+            self.learn(key, response.status_code, response.headers)
+        except sqlite3.Error as e:
+            logger.warning(f"rate limiter could not learn from {key}: {e}")
+
+    def _count(self, key, name, wait=0.0):
+        with self._stats_lock:
+            stats = self._stats[key]
+            stats[name] += 1
+            if wait:
+                stats["wait_seconds"] += wait
+                stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def _wait_for(self, bucket, tokens):
+        deadline = current_start_deadline.get()
+        max_wait = RATE_LIMIT_MAX_WAIT if deadline is None else max(0.0, deadline - time.monotonic())
+        wait = min(self.reserve(bucket, tokens), max_wait)
+        self._count(bucket.key, "requests")
+        if wait > 0:
+            self._count(bucket.key, "queued", wait)
+            logger.info(f"rate limiter: queuing {bucket.key} for {wait:.2f}s")
+        return wait
+
+    def acquire(self, bucket, tokens):
+        wait = self._wait_for(bucket, tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self, bucket, tokens):
+        # sqlite may block on another worker's write lock; keep it off the event loop
+        wait = await asyncio.to_thread(self._wait_for, bucket, tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        rows = self._conn().execute(
+            "SELECT key, requests, tokens, learned_rpm, learned_tpm, blocked_until FROM buckets ORDER BY key"
+        ).fetchall()
+        with self._stats_lock:
+            local = {key: dict(stats) for key, stats in self._stats.items()}
+        now = time.time()
+        return {
+            "db": self.path,
+            "buckets": {
+                key: {
+                    "requests_available": requests,
+                    "tokens_available": tokens,
+                    "learned_rpm": learned_rpm,
+                    "learned_tpm": learned_tpm,
+                    "blocked_for": max(0.0, blocked_until - now),
+                    "this_worker": local.get(key),
+                }
+                for key, requests, tokens, learned_rpm, learned_tpm, blocked_until in rows
+            },
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+def _actual_tokens(usage):
+    if not usage or usage.get("input_tokens") is None or usage.get("output_tokens") is None:
+        return None
+    return usage["input_tokens"] + usage["output_tokens"]
+
+
+def _spent_tokens(prompt_tokens, sent, output_chars):
+    """Best guess of what an unfinished call used: nothing if its request never went out."""
+    return prompt_tokens + output_chars // CHARS_PER_TOKEN if sent else 0
+
+
+def _settle_unfinished(bucket, tokens, spent):
+    try:
+        rate_limiter.settle(bucket, tokens, spent)
+    except sqlite3.Error as e:
+        logger.warning(f"rate limiter could not settle {bucket.key}: {e}")
+
+
+def rate_limited_stream_iter(model_api_dict, conv, max_new_tokens, stream_iter):
+    """Queue `stream_iter` behind its bucket and settle the token estimate at the end."""
+    bucket = bucket_for(model_api_dict)
+    prompt_tokens = estimate_tokens(conv, None)
+    tokens = prompt_tokens + (max_new_tokens or 0)
+    sent = settled = False
+    output_chars = 0
+    try:
+        rate_limiter.acquire(bucket, tokens)
+        # the request goes out while the first record is produced
+        sent = True
+        scope = current_bucket.set(bucket.key)
+        try:
+            first = next(stream_iter, None)
+        finally:
+            current_bucket.reset(scope)
+        if first is None:
+            return
+        for data in itertools.chain([first], stream_iter):
+            if data.get("final"):
+                settled = True
+                rate_limiter.settle(bucket, tokens, _actual_tokens(data.get("usage")))
+            elif data.get("delta"):
+                output_chars += len(data["delta"])
+            yield data
+    finally:
+        if not settled:
+            # cancelled, failed or closed early: give back what it did not use
+            _settle_unfinished(bucket, tokens, _spent_tokens(prompt_tokens, sent, output_chars))
+
+
+async def async_rate_limited_stream_iter(model_api_dict, conv, max_new_tokens, stream_iter):
+    """Async `rate_limited_stream_iter`."""
+    bucket = bucket_for(model_api_dict)
+    prompt_tokens = estimate_tokens(conv, None)
+    tokens = prompt_tokens + (max_new_tokens or 0)
+    sent = settled = False
+    output_chars = 0
+    try:
+        await rate_limiter.async_acquire(bucket, tokens)
+        sent = True
+        _notify_sent()
+        scope = current_bucket.set(bucket.key)
+        try:
+            first = await stream_iter.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            current_bucket.reset(scope)
+        data = first
+        while True:
+            if data.get("final"):
+                settled = True
+                await asyncio.to_thread(
+                    rate_limiter.settle, bucket, tokens, _actual_tokens(data.get("usage"))
+                )
+            elif data.get("delta"):
+                output_chars += len(data["delta"])
+            yield data
+            try:
+                data = await stream_iter.__anext__()
+            except StopAsyncIteration:
+                return
+    finally:
+        try:
+            await stream_iter.aclose()
+        finally:
+            if not settled:
+                await asyncio.to_thread(
+                    _settle_unfinished, bucket, tokens, _spent_tokens(prompt_tokens, sent, output_chars)
+                )
+
+
+def rate_limited_call(model_api_dict, conv, max_new_tokens, fn):
+    """Queue the non-streaming call `fn()` behind its bucket."""
+    bucket = bucket_for(model_api_dict)
+    prompt_tokens = estimate_tokens(conv, None)
+    tokens = prompt_tokens + (max_new_tokens or 0)
+    sent = False
+    result = None
+    try:
+        rate_limiter.acquire(bucket, tokens)
+        sent = True
+        scope = current_bucket.set(bucket.key)
+        try:
+            result = fn()
+        finally:
+            current_bucket.reset(scope)
+    finally:
+        if result is None:
+            # cancelled or failed: give back what it did not use
+            _settle_unfinished(bucket, tokens, _spent_tokens(prompt_tokens, sent, 0))
+    rate_limiter.settle(bucket, tokens, _actual_tokens(result.usage))
+    return result
+
+
+async def async_rate_limited_call(model_api_dict, conv, max_new_tokens, fn):
+    """Async `rate_limited_call`; `fn()` returns an awaitable."""
+    bucket = bucket_for(model_api_dict)
+    prompt_tokens = estimate_tokens(conv, None)
+    tokens = prompt_tokens + (max_new_tokens or 0)
+    sent = False
+    result = None
+    try:
+        await rate_limiter.async_acquire(bucket, tokens)
+        sent = True
+        _notify_sent()
+        scope = current_bucket.set(bucket.key)
+        try:
+            result = await fn()
+        finally:
+            current_bucket.reset(scope)
+    finally:
+        if result is None:
+            # cancelled or failed: give back what it did not use
+            await asyncio.to_thread(_settle_unfinished, bucket, tokens, _spent_tokens(prompt_tokens, sent, 0))
+    await asyncio.to_thread(rate_limiter.settle, bucket, tokens, _actual_tokens(result.usage))
+    return result
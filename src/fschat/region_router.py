@@ -0,0 +1,277 @@
+"""Route an endpoint to the fastest healthy of its regional bases.
+
+An endpoint entry in `src/config/api_endpoint*.json` can list regional bases
+instead of a single `api_base`, in order of preference:
+
+    "gpt-4o-2024-11-20": {
+        "model_name": "gpt-4o-2024-11-20",
+        "api_type": "openai",
+        "api_key": "sk-...",
+        "regions": {
+            "us-east": "https://us-east.example.com/v1",
+            "eu-west": "https://eu-west.example.com/v1"
+        },
+        "region_routing": {"probe_interval_seconds": 30}
+    }
+
+A background prober (started with the app) measures every region each
+`probe_interval_seconds`: the round trip of a `HEAD` to its base on the pooled
+client, and, for OpenAI-style bases with `"ttft_probe": true`, the time to the
+first event of a one-token streamed completion. The TTFT probe is opt-in, as
+each one is a billed request sent with the entry's `api_key`. Requests go to
+the region with the lowest smoothed time to first token (round trip when there
+is none). To keep traffic from flapping, a faster region only takes over once
+it has beaten the current one by `switch_margin` for `switch_after` probe
+rounds in a row; a region that failed `unhealthy_after` probes in a row is
+left at once. Before the first probe, and when no region is healthy, the first
+region listed is used. State is per worker process, like the breakers.
+"""
+
+import asyncio
+import threading
+import time
+
+from fastchat.utils import build_logger
+from src.fschat.client_pool import client_pool
+from src.fschat.sse import aiter_sse_data
+
+
+logger = build_logger("web_server", "web_server.log")
+
+DEFAULT_REGION_ROUTING_CONFIG = {
+    "probe_interval_seconds": 30.0,
+    "probe_timeout_seconds": 10.0,
+    # opt-in: a billed one-token completion per region and probe round
+    "ttft_probe": False,
+    # a challenger must be this much faster than the current region ...
+    "switch_margin": 0.2,
+    # ... for this many probe rounds in a row
+    "switch_after": 3,
+    "unhealthy_after": 2,
+}
+# api types whose base serves `/chat/completions`, for the TTFT probe
+TTFT_PROBE_API_TYPES = {"openai", "xai", "dashscope", "yi", "deepseek"}
+LATENCY_EWMA_ALPHA = 0.3
+
+
+def has_regions(model_api_dict):
+    return "regions" in model_api_dict
+
+
+def region_bases(model_api_dict):
+    """`{region: api_base}` of an entry; a list of bases is named by the bases themselves."""
+    regions = model_api_dict["regions"]
+    # the regions are probed and called with the entry's single `api_key`
+    if any(name in model_api_dict for name in ("api_keys", "api_bases", "upstreams")):
+        raise ValueError(
+            f'{model_api_dict["model_name"]}: regions cannot be combined with api_keys, api_bases or upstreams'
+        )
+    if isinstance(regions, dict):
+        return dict(regions)
+    return {api_base: api_base for api_base in regions}
+
+
+def region_routing_config(model_api_dict):
+    return {**DEFAULT_REGION_ROUTING_CONFIG, **model_api_dict.get("region_routing", {})}
+
+
+def _ewma(previous, value):
+    return value if previous is None else LATENCY_EWMA_ALPHA * value + (1 - LATENCY_EWMA_ALPHA) * previous
+
+
+class RegionRouter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # per entry: current region, pending challenger and per-region probe state
+        self._entries = {}
+        self._task = None
+
+    def _entry(self, model_api_dict):
+        name = model_api_dict["model_name"]
+        bases = region_bases(model_api_dict)
+        entry = self._entries.get(name)
+        if entry is None or entry["bases"] != bases:
+            entry = self._entries[name] = {
+                "bases": bases,
+                "current": next(iter(bases)),
+                "challenger": None,
+                "challenger_rounds": 0,
+                "switches": 0,
+                "regions": {
+                    region: {
+                        "rtt": None,
+                        "ttft": None,
+                        "healthy": True,
+                        "consecutive_failures": 0,
+                        "probes": 0,
+                        "failures": 0,
+                        "last_error": None,
+                    }
+                    for region in bases
+                },
+            }
+        return entry
+
+    def current_region(self, model_api_dict):
+        with self._lock:
+            return self._entry(model_api_dict)["current"]
+
+    def route(self, model_api_dict):
+        """`model_api_dict` with the `api_base` of its current region; as is without `regions`."""
+        if not has_regions(model_api_dict):
+            return model_api_dict
+        with self._lock:
+            entry = self._entry(model_api_dict)
+            api_base = entry["bases"][entry["current"]]
+        routed = {
+            name: value for name, value in model_api_dict.items() if name not in ("regions", "region_routing")
+        }
+        routed["api_base"] = api_base
+        return routed
+
+    # ------------------------------- probing -------------------------------- #
+
+    async def _probe_rtt(self, api_base, timeout):
+        client = client_pool.get_http_client("region_probe", api_base, is_async=True)
+        start = time.perf_counter()
+        # any HTTP answer means the region is reachable
+        await client.head(api_base, timeout=timeout)
+        return time.perf_counter() - start
+
+    async def _probe_ttft(self, model_api_dict, api_base, timeout):
+        client = client_pool.get_http_client("region_probe", api_base, is_async=True)
+        start = time.perf_counter()
+        async with client.stream(
+            "POST",
+            f"{api_base.rstrip('/')}/chat/completions",
+            headers={"Authorization": f'Bearer {model_api_dict.get("api_key")}'},
+            json={
+                "model": model_api_dict["model_name"],
+                "messages": [{"role": "user", "content": "ping"}],
+                "max_tokens": 1,
+                "stream": True,
+            },
+            timeout=timeout,
+        ) as response:
+            response.raise_for_status()
+            async for _ in aiter_sse_data(response.aiter_bytes()):
+                return time.perf_counter() - start
+        raise ValueError("stream ended without an event")
+
+    async def _probe_region(self, model_api_dict, config, api_base):
+        """`(rtt, ttft, error)` of one region."""
+        timeout = config["probe_timeout_seconds"]
+        try:
+            rtt = await self._probe_rtt(api_base, timeout)
+            ttft = None
+            if config["ttft_probe"] and model_api_dict["api_type"] in TTFT_PROBE_API_TYPES:
+                ttft = await self._probe_ttft(model_api_dict, api_base, timeout)
+        except Exception as e:
+            return None, None, e
+        return rtt, ttft, None
+
+    async def probe(self, model_api_dict):
+        """Probe every region of the entry once, then pick the region to route to."""
+        config = region_routing_config(model_api_dict)
+        with self._lock:
+            bases = dict(self._entry(model_api_dict)["bases"])
+        results = await asyncio.gather(
+            *(self._probe_region(model_api_dict, config, api_base) for api_base in bases.values())
+        )
+        with self._lock:
+            entry = self._entry(model_api_dict)
+            for region, (rtt, ttft, error) in zip(bases, results):
+                self._record(entry["regions"][region], config, rtt, ttft, error)
+            self._decide(model_api_dict["model_name"], entry, config)
+
+    @staticmethod
+    def _record(state, config, rtt, ttft, error):
+        state["probes"] += 1
+        if error is not None:
+            state["failures"] += 1
+            state["consecutive_failures"] += 1
+            state["last_error"] = repr(error)
+            if state["consecutive_failures"] >= config["unhealthy_after"]:
+                state["healthy"] = False
+            return
+        state["consecutive_failures"] = 0
+        state["healthy"] = True
+        state["rtt"] = _ewma(state["rtt"], rtt)
+        if ttft is not None:
+            state["ttft"] = _ewma(state["ttft"], ttft)
+
+    @staticmethod
+    def _score(state):
+        return state["ttft"] if state["ttft"] is not None else state["rtt"]
+
+    def _decide(self, name, entry, config):
+        regions = entry["regions"]
+        healthy = [r for r, state in regions.items() if state["healthy"] and self._score(state) is not None]
+        if not healthy:
+            return
+        best = min(healthy, key=lambda r: self._score(regions[r]))
+        current = entry["current"]
+        if not regions[current]["healthy"]:
+            # failing over is never delayed
+            self._switch(name, entry, best, "unhealthy")
+            return
+        current_score = self._score(regions[current])
+        if best == current or (
+            current_score is not None and self._score(regions[best]) >= current_score * (1 - config["switch_margin"])
+        ):
+            entry["challenger"], entry["challenger_rounds"] = None, 0
+            return
+        if entry["challenger"] != best:
+            entry["challenger"], entry["challenger_rounds"] = best, 0
+        entry["challenger_rounds"] += 1
+        if entry["challenger_rounds"] >= config["switch_after"]:
+            self._switch(name, entry, best, "faster")
+
+    @staticmethod
+    def _switch(name, entry, region, reason):
+        logger.info(f'{name}: routing to region {region} instead of {entry["current"]} ({reason})')
+        entry["current"] = region
+        entry["challenger"], entry["challenger_rounds"] = None, 0
+        entry["switches"] += 1
+
+    async def _probe_loop(self, model_api_dict):
+        interval = region_routing_config(model_api_dict)["probe_interval_seconds"]
+        while True:
+            try:
+                await self.probe(model_api_dict)
+            except Exception as e:
+                logger.error(f'region probe of {model_api_dict["model_name"]} failed: {e!r}')
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        # late import: warmup imports the provider modules, which import this one
+        from src.fschat.warmup import endpoint_entries
+
+        entries = [entry for entry in endpoint_entries().values() if has_regions(entry)]
+        if entries:
+            logger.info(f"probing the regions of {len(entries)} endpoints")
+        await asyncio.gather(*(self._probe_loop(entry) for entry in entries))
+
+    def start(self):
+        """Schedule the probe loops on the running event loop (call from the app's startup)."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    "current": entry["current"],
+                    "challenger": entry["challenger"],
+                    "challenger_rounds": entry["challenger_rounds"],
+                    "switches": entry["switches"],
+                    "regions": {
+                        region: {"api_base": entry["bases"][region], **state}
+                        for region, state in entry["regions"].items()
+                    },
+                }
+                for name, entry in self._entries.items()
+            }
+
+
+region_router = RegionRouter()
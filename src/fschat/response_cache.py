@@ -0,0 +1,195 @@
+"""LRU/TTL cache of provider responses.
+
+Players spam the hint button and the assistant suggestions are asked for again
+on an unchanged game history, so those calls are answered from memory when the
+model, rendered messages and sampling params are the same as a recent request.
+Only call types listed in `RESPONSE_CACHE_CALL_TYPES` (comma separated, default
+"assistant,hint") are cached; game turns are sampled and stay uncached.
+
+State is per process.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from src.fschat.api_provider_game import CompletionResult, NON_IDEMPOTENT_API_TYPES
+
+
+RESPONSE_CACHE_CALL_TYPES = {
+    t.strip() for t in os.environ.get("RESPONSE_CACHE_CALL_TYPES", "assistant,hint").split(",") if t.strip()
+}
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 600))
+
+
+def request_key(conv, model_api_dict, temperature, top_p, max_new_tokens):
+    """Hash of everything that determines the provider's answer."""
+    messages = [
+        {"role": m["role"], "content": m["content"].strip() if isinstance(m["content"], str) else m["content"]}
+        for m in conv.to_openai_api_messages()
+    ]
+    payload = {
+        "api_type": model_api_dict["api_type"],
+        "api_base": model_api_dict.get("api_base"),
+        "model": model_api_dict["model_name"],
+        "messages": messages,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+        "stop": model_api_dict.get("stop"),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, CompletionResult)
+        self._stats = defaultdict(
+            lambda: {"hits": 0, "misses": 0, "stores": 0, "saved_input_tokens": 0, "saved_output_tokens": 0}
+        )
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key, call_type):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                self._expirations += 1
+                entry = None
+            stats = self._stats[call_type]
+            if entry is None:
+                stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            stats["hits"] += 1
+            result = entry[1]
+            if result.usage:
+                stats["saved_input_tokens"] += result.usage.get("input_tokens") or 0
+                stats["saved_output_tokens"] += result.usage.get("output_tokens") or 0
+        return CompletionResult(
+            result.text, result.finish_reason, result.usage, latency=0.0, attempts=0, cached=True
+        )
+
+    def put(self, key, call_type, result):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            self._stats[call_type]["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            by_call_type = {name: dict(counts) for name, counts in self._stats.items()}
+            size = len(self._entries)
+        for counts in by_call_type.values():
+            lookups = counts["hits"] + counts["misses"]
+            counts["hit_rate"] = counts["hits"] / lookups if lookups else None
+        return {
+            "enabled_call_types": sorted(RESPONSE_CACHE_CALL_TYPES),
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+            "by_call_type": by_call_type,
+        }
+
+
+response_cache = ResponseCache()
+
+
+def _result_from_final(text, final):
+    return CompletionResult(text, final.get("finish_reason"), final.get("usage"))
+
+
+def _store_stream_iter(key, call_type, stream_iter):
+    parts = []
+    try:
+        for data in stream_iter:
+            if data["error_code"] == 0 and "delta" in data:
+                if data.get("final"):
+                    response_cache.put(key, call_type, _result_from_final("".join(parts), data))
+                else:
+                    if data.get("reset"):
+                        parts = []
+                    parts.append(data["delta"])
+            yield data
+    finally:
+        # a consumer that stops early (a stream watcher) must not leave the provider stream open
+        stream_iter.close()
+
+
+async def _store_async_stream_iter(key, call_type, stream_iter):
+    parts = []
+    try:
+        async for data in stream_iter:
+            if data["error_code"] == 0 and "delta" in data:
+                if data.get("final"):
+                    response_cache.put(key, call_type, _result_from_final("".join(parts), data))
+                else:
+                    if data.get("reset"):
+                        parts = []
+                    parts.append(data["delta"])
+            yield data
+    finally:
+        await stream_iter.aclose()
+
+
+async def _store_awaitable(key, call_type, awaitable):
+    result = await awaitable
+    response_cache.put(key, call_type, result)
+    return result
+
+
+def cached(stream_iter_fn, call_type):
+    """Put the response cache in front of `stream_iter_fn` for `call_type`.
+
+    `stream_iter_fn` may be any provider entry point the game classes accept
+    (sync or async delta dispatcher, `complete`, `async_complete`). A hit is
+    returned as a `CompletionResult`, which every collector understands.
+    """
+    if call_type not in RESPONSE_CACHE_CALL_TYPES:
+        return stream_iter_fn
+
+    @functools.wraps(stream_iter_fn)
+    def cached_stream_iter_fn(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        if model_api_dict["api_type"] in NON_IDEMPOTENT_API_TYPES:
+            return stream_iter_fn(
+                conv, model_name, model_api_dict,
+                temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens, state=state,
+            )
+        key = request_key(conv, model_api_dict, temperature, top_p, max_new_tokens)
+        hit = response_cache.get(key, call_type)
+        if hit is not None:
+            return hit
+        result = stream_iter_fn(
+            conv, model_name, model_api_dict,
+            temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens, state=state,
+        )
+        if isinstance(result, CompletionResult):
+            response_cache.put(key, call_type, result)
+            return result
+        if inspect.isawaitable(result):
+            return _store_awaitable(key, call_type, result)
+        if hasattr(result, "__aiter__"):
+            return _store_async_stream_iter(key, call_type, result)
+        return _store_stream_iter(key, call_type, result)
+
+    return cached_stream_iter_fn
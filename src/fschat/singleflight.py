@@ -0,0 +1,301 @@
+"""Coalesce identical in-flight provider calls.
+
+Roblox clients retry and players double-tap `/regenerate` and `/hint`, which puts
+several identical requests in flight at once. While a call is in flight, another
+call with the same key (scope, entry point and normalized request, see
+`response_cache.request_key`) does not go upstream: it subscribes to the running
+one and replays its records from the start. What a follower gets is marked
+`coalesced` (the closing record, or the `CompletionResult`), so its usage is
+not billed a second time.
+
+Async callers share one upstream task, which is cancelled once every caller
+waiting on it has gone away; sync callers (threadpool routes) share the stream
+driven by the first caller. State is per process.
+"""
+
+import asyncio
+import dataclasses
+import functools
+import inspect
+import os
+import threading
+from collections import defaultdict
+
+from fastchat.utils import build_logger
+from src.fschat.api_provider_game import CompletionResult, NON_IDEMPOTENT_API_TYPES
+from src.fschat.response_cache import request_key
+
+
+logger = build_logger("web_server", "web_server.log")
+
+SINGLEFLIGHT = os.environ.get("SINGLEFLIGHT", "1") == "1"
+
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {"calls": 0, "upstream": 0, "coalesced": 0})
+_async_flights = {}
+_thread_flights = {}
+_thread_flights_lock = threading.Lock()
+
+
+def _count(call_type, leader):
+    with _stats_lock:
+        stats = _stats[call_type]
+        stats["calls"] += 1
+        stats["upstream" if leader else "coalesced"] += 1
+    if not leader:
+        logger.info(f"singleflight: {call_type} call joined an identical one in flight")
+
+
+def singleflight_stats():
+    with _stats_lock:
+        by_call_type = {name: dict(counts) for name, counts in _stats.items()}
+    return {
+        "enabled": SINGLEFLIGHT,
+        "in_flight": len(_async_flights) + len(_thread_flights),
+        "by_call_type": by_call_type,
+    }
+
+
+# ---------------------------------- async ---------------------------------- #
+
+def _forget(key, flight):
+    if _async_flights.get(key) is flight:
+        del _async_flights[key]
+
+
+class _AsyncCall:
+    """A shared non-streaming call and the callers waiting on it."""
+
+    def __init__(self, key, task):
+        self.key = key
+        self.task = task
+        self.waiters = 0
+
+
+class _AsyncFlight:
+    def __init__(self, key):
+        self.key = key
+        self.records = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+async def _pump(key, flight, stream_iter):
+    try:
+        async for data in stream_iter:
+            flight.records.append(data)
+            flight.notify()
+    except Exception as e:
+        flight.error = e
+    finally:
+        flight.done = True
+        flight.notify()
+        _forget(key, flight)
+        await stream_iter.aclose()
+
+
+def _follower_record(data):
+    return {**data, "coalesced": True} if data.get("final") else data
+
+
+async def _subscribe(flight, leader):
+    i = 0
+    try:
+        while True:
+            while i < len(flight.records):
+                data = flight.records[i]
+                yield data if leader else _follower_record(data)
+                i += 1
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+            await flight.changed.wait()
+    finally:
+        flight.subscribers -= 1
+        # nobody is listening any more; stop paying for the upstream stream
+        if flight.subscribers == 0 and not flight.done:
+            # a later identical call starts afresh instead of joining a cancelled one
+            _forget(flight.key, flight)
+            flight.task.cancel()
+
+
+async def _await_shared(flight, leader):
+    try:
+        # unlike awaiting the task, this leaves it running when this caller is cancelled
+        await asyncio.wait((flight.task,))
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # nobody is waiting any more; stop paying for the upstream call
+            _forget(flight.key, flight)
+            flight.task.cancel()
+    result = flight.task.result()
+    return result if leader else dataclasses.replace(result, coalesced=True)
+
+
+def _async_call(key, call_type, make_call):
+    flight = _async_flights.get(key)
+    leader = flight is None
+    _count(call_type, leader)
+    if leader:
+        call = make_call()
+        if isinstance(call, CompletionResult):
+            return call
+        if inspect.isawaitable(call):
+            flight = _AsyncCall(key, asyncio.ensure_future(call))
+            flight.task.add_done_callback(lambda task: _forget(key, flight))
+        else:
+            flight = _AsyncFlight(key)
+            flight.task = asyncio.ensure_future(_pump(key, flight, call))
+        _async_flights[key] = flight
+    if isinstance(flight, _AsyncCall):
+        # counted now, not once awaited, so a follower that leaves before the
+        # leader starts waiting does not cancel the call under it
+        flight.waiters += 1
+        return _await_shared(flight, leader)
+    flight.subscribers += 1
+    return _subscribe(flight, leader)
+
+
+# ---------------------------------- threads --------------------------------- #
+
+class _ThreadFlight:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.kind = None  # "stream" or "result", once the leader knows
+        self.records = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.followers = 0
+
+    def publish(self, **changes):
+        with self.cond:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.cond.notify_all()
+
+
+def _finish_thread_flight(key, flight, **changes):
+    changes["done"] = True
+    flight.publish(**changes)
+    with _thread_flights_lock:
+        if _thread_flights.get(key) is flight:
+            del _thread_flights[key]
+
+
+def _lead_stream(key, flight, stream_iter):
+    completed = False
+    try:
+        for data in stream_iter:
+            with flight.cond:
+                flight.records.append(data)
+                flight.cond.notify_all()
+            yield data
+        completed = True
+    except Exception as e:
+        _finish_thread_flight(key, flight, error=e)
+        raise
+    finally:
+        if not completed and not flight.done and flight.followers:
+            # the first caller went away; finish the stream for the others
+            try:
+                for data in stream_iter:
+                    with flight.cond:
+                        flight.records.append(data)
+                        flight.cond.notify_all()
+            except Exception as e:
+                _finish_thread_flight(key, flight, error=e)
+        if not flight.done:
+            _finish_thread_flight(key, flight)
+
+
+def _follow_stream(flight):
+    i = 0
+    while True:
+        with flight.cond:
+            flight.cond.wait_for(lambda: i < len(flight.records) or flight.done)
+            records = flight.records[i:]
+            done, error = flight.done, flight.error
+        for data in records:
+            yield _follower_record(data)
+        i += len(records)
+        if done and i == len(flight.records):
+            if error is not None:
+                raise error
+            return
+
+
+def _thread_call(key, call_type, make_call):
+    with _thread_flights_lock:
+        flight = _thread_flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _thread_flights[key] = _ThreadFlight()
+        else:
+            flight.followers += 1
+    _count(call_type, leader)
+
+    if leader:
+        try:
+            call = make_call()
+        except Exception as e:
+            _finish_thread_flight(key, flight, error=e)
+            raise
+        if isinstance(call, CompletionResult):
+            _finish_thread_flight(key, flight, kind="result", result=call)
+            return call
+        flight.publish(kind="stream")
+        return _lead_stream(key, flight, call)
+
+    with flight.cond:
+        flight.cond.wait_for(lambda: flight.kind is not None or flight.done)
+        kind = flight.kind
+    if kind == "stream":
+        return _follow_stream(flight)
+    with flight.cond:
+        flight.cond.wait_for(lambda: flight.done)
+    if flight.error is not None:
+        raise flight.error
+    return dataclasses.replace(flight.result, coalesced=True)
+
+
+def coalesced(stream_iter_fn, call_type, scope=None):
+    """Share one upstream call among identical concurrent calls of `stream_iter_fn`.
+
+    `scope` keeps unrelated callers apart (the game session), so two players whose
+    conversations happen to match still get their own samples. Calls without a
+    scope are never coalesced.
+    """
+    if not SINGLEFLIGHT or scope is None:
+        return stream_iter_fn
+    fn_name = f"{getattr(stream_iter_fn, '__module__', '')}.{getattr(stream_iter_fn, '__qualname__', repr(stream_iter_fn))}"
+
+    @functools.wraps(stream_iter_fn)
+    def coalesced_stream_iter_fn(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        def make_call():
+            return stream_iter_fn(
+                conv, model_name, model_api_dict,
+                temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens, state=state,
+            )
+
+        if model_api_dict["api_type"] in NON_IDEMPOTENT_API_TYPES:
+            return make_call()
+        key = (scope, fn_name, request_key(conv, model_api_dict, temperature, top_p, max_new_tokens))
+        # async entry points are only ever called on the event loop, sync ones
+        # from threadpool workers
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return _thread_call(key, call_type, make_call)
+        return _async_call(key, call_type, make_call)
+
+    return coalesced_stream_iter_fn
@@ -0,0 +1,132 @@
+"""Decode the raw HTTP bodies of the providers called without an SDK.
+
+The nvidia and sambanova streams are server-sent events and are read as raw
+byte chunks (`iter_bytes()` / `aiter_bytes()`) instead of one decoded `str` per
+line. Lines are split on the bytes, an event ends at a blank line, the `data:`
+lines of one event are joined with `\\n` as the SSE spec says, and the payload
+goes straight from bytes to a `msgspec.Struct` that only holds the fields the
+delta records need; everything else in a chunk is skipped while decoding.
+ai2's InferD streams newline-delimited JSON and shares the line splitter.
+
+`benchmarks/bench_sse.py` compares this with the per-line `json.loads` parsing
+it replaced.
+"""
+
+from typing import Any, List, Optional
+
+import msgspec
+
+
+SSE_DONE = b"[DONE]"
+
+
+class LineDecoder:
+    """Split a stream of byte chunks into lines (`\\n` or `\\r\\n`), without the line ends."""
+
+    def __init__(self):
+        self._buffer = b""
+
+    def feed(self, chunk):
+        if b"\n" not in chunk:
+            self._buffer += chunk
+            return []
+        lines = (self._buffer + chunk).split(b"\n") if self._buffer else chunk.split(b"\n")
+        self._buffer = lines.pop()
+        return [line[:-1] if line.endswith(b"\r") else line for line in lines]
+
+    def flush(self):
+        """The last line, if the body did not end with a line break."""
+        line, self._buffer = self._buffer, b""
+        return [line.rstrip(b"\r")] if line else []
+
+
+class SSEDecoder:
+    """Turn byte chunks of an SSE body into the `data` of its events, as bytes."""
+
+    def __init__(self):
+        self._lines = LineDecoder()
+        self._data = []
+
+    def _events(self, lines):
+        events = []
+        for line in lines:
+            if not line:
+                if self._data:
+                    events.append(self._data[0] if len(self._data) == 1 else b"\n".join(self._data))
+                    self._data = []
+            elif line.startswith(b"data:"):
+                self._data.append(line[6:] if line[5:6] == b" " else line[5:])
+            # comments (`:`) and the event, id and retry fields are not used by these providers
+        return events
+
+    def feed(self, chunk):
+        return self._events(self._lines.feed(chunk))
+
+    def flush(self):
+        """Events left when the body ends without the final blank line."""
+        return self._events(self._lines.flush() + [b""])
+
+
+def iter_sse_data(byte_chunks):
+    """`data` of every event in an SSE body given as byte chunks."""
+    decoder = SSEDecoder()
+    for chunk in byte_chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_sse_data(byte_chunks):
+    """Async `iter_sse_data`."""
+    decoder = SSEDecoder()
+    async for chunk in byte_chunks:
+        for data in decoder.feed(chunk):
+            yield data
+    for data in decoder.flush():
+        yield data
+
+
+def iter_json_lines(byte_chunks):
+    """Decoded objects of a newline-delimited JSON body given as byte chunks."""
+    decoder = LineDecoder()
+    for chunk in byte_chunks:
+        for line in decoder.feed(chunk):
+            if line:
+                yield msgspec.json.decode(line)
+    for line in decoder.flush():
+        yield msgspec.json.decode(line)
+
+
+async def aiter_json_lines(byte_chunks):
+    """Async `iter_json_lines`."""
+    decoder = LineDecoder()
+    async for chunk in byte_chunks:
+        for line in decoder.feed(chunk):
+            if line:
+                yield msgspec.json.decode(line)
+    for line in decoder.flush():
+        yield msgspec.json.decode(line)
+
+
+class ChatDelta(msgspec.Struct):
+    content: Optional[str] = None
+
+
+class ChatChoice(msgspec.Struct):
+    delta: Optional[ChatDelta] = None
+    finish_reason: Optional[str] = None
+
+
+class ChatChunk(msgspec.Struct):
+    """The parts of an OpenAI-style `chat.completion.chunk` the delta records use."""
+
+    choices: List[ChatChoice] = msgspec.field(default_factory=list)
+    usage: Optional[dict] = None
+    # some servers report a failure mid-stream as `data: {"error": ...}`
+    error: Optional[Any] = None
+
+
+_chat_chunk_decoder = msgspec.json.Decoder(ChatChunk)
+
+
+def decode_chat_chunk(data):
+    return _chat_chunk_decoder.decode(data)
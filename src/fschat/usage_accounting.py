@@ -0,0 +1,64 @@
+"""Token usage and cost of provider calls, for the session and per-model/day rollups.
+
+Every generation appends one entry from `call_usage` to its game/NPC/action
+object; the page adds them to the session row it commits (see
+`database.add_session_usage`). Tokens come from the provider's usage fields, or
+are estimated from the text when the provider reported none (early stops,
+cumulative streams). Cost uses the endpoint's optional `pricing` block, in USD
+per million tokens:
+
+    "pricing": {"input": 2.5, "cached_input": 1.25, "output": 10.0}
+"""
+
+from src.fschat.rate_limiter import CHARS_PER_TOKEN
+
+
+def _text_tokens(text):
+    return len(text or "") // CHARS_PER_TOKEN
+
+
+def _prompt_tokens(conv):
+    return sum(
+        _text_tokens(m["content"]) if isinstance(m["content"], str) else 0
+        for m in conv.to_openai_api_messages()
+    )
+
+
+def call_cost(pricing, input_tokens, output_tokens, cached_input_tokens=0):
+    """USD for one call, or None when the endpoint has no `pricing`."""
+    if not pricing:
+        return None
+    cached_input_tokens = cached_input_tokens or 0
+    cached_price = pricing.get("cached_input", pricing["input"])
+    return (
+        (input_tokens - cached_input_tokens) * pricing["input"]
+        + cached_input_tokens * cached_price
+        + output_tokens * pricing["output"]
+    ) / 1e6
+
+
+def call_usage(model_name, model_api_info, conv, output, final):
+    """Usage entry of one generation, or None if it was served from the response cache
+    or shared with an identical call in flight, which is billed to that call.
+    """
+    if final and (final.get("cached") or final.get("coalesced")):
+        return None
+    usage = (final or {}).get("usage") or {}
+    estimated = usage.get("input_tokens") is None or usage.get("output_tokens") is None
+    input_tokens = usage.get("input_tokens")
+    if input_tokens is None:
+        input_tokens = _prompt_tokens(conv)
+    output_tokens = usage.get("output_tokens")
+    if output_tokens is None:
+        output_tokens = _text_tokens(output)
+    cached_input_tokens = usage.get("cached_input_tokens") or 0
+    return {
+        "model": model_name,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "estimated": estimated,
+        "cost_usd": call_cost(
+            (model_api_info or {}).get("pricing"), input_tokens, output_tokens, cached_input_tokens
+        ),
+    }
@@ -0,0 +1,236 @@
+"""Warm up provider SDKs and connections when a worker starts.
+
+A fresh worker would make the first turn on each provider pay for the lazy SDK
+import (`anthropic`, `google.generativeai`, `vertexai`, ...) and for DNS, TCP
+and TLS setup. On startup the app runs `warmup.run()` in the background, which
+for every entry of the endpoint configs:
+
+1. imports the SDK modules of its `api_type`,
+2. opens a keep-alive connection on the pooled async client the turns will use
+   (a `HEAD` to the provider's base URL; any HTTP answer will do),
+3. with `WARMUP_PROBE=1`, sends a one-line request through the regular call path.
+
+Entries that could not send a request at all (a gemini entry with no key) are
+reported under `config` before any of that.
+
+Failures are reported, never raised. `/health` answers 503 until the warm-up
+is done, then 200; its body has the timings and errors of every step.
+"""
+
+import asyncio
+import hashlib
+import importlib
+import os
+import time
+
+from fastchat.utils import build_logger
+from src.fschat.api_provider_async import async_complete
+from src.fschat.api_provider_game import OPENAI_COMPATIBLE_APIS
+from src.fschat.client_pool import (
+    client_pool,
+    get_anthropic_client,
+    get_mistral_client,
+    get_openai_client,
+)
+from src.fschat.key_balancer import is_balanced, upstream_members
+from src.fschat.region_router import has_regions, region_bases
+from src.fschat.model_adapter import get_conversation_template
+from utils import API_ENDPOINT_FILES, load_api_endpoint_file
+
+
+logger = build_logger("web_server", "web_server.log")
+
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+WARMUP_PROBE = os.environ.get("WARMUP_PROBE", "0") == "1"
+# per connection and per probe
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", 10.0))
+WARMUP_PROBE_MAX_TOKENS = 16
+
+# SDK modules each api_type imports lazily on its first call
+API_TYPE_MODULES = {
+    "openai": ("openai",),
+    "openai_assistant": ("openai",),
+    **{api_type: ("openai",) for api_type in OPENAI_COMPATIBLE_APIS},
+    "anthropic": ("anthropic",),
+    "anthropic_message": ("anthropic",),
+    "gemini": ("google.generativeai",),
+    "vertex": ("vertexai", "vertexai.generative_models"),
+    "cohere": ("cohere",),
+    "mistral": ("mistralai",),
+    "replicate": ("replicate",),
+}
+# api types that never leave the process
+OFFLINE_API_TYPES = {"mock", "replay"}
+
+
+def _fingerprint(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12] if api_key else "none"
+
+
+def endpoint_entries():
+    """`{model_name: model_api_dict}` over every endpoint config, first file wins."""
+    entries = {}
+    for endpoint_file in API_ENDPOINT_FILES:
+        try:
+            api_endpoint_info = load_api_endpoint_file(endpoint_file)
+        except FileNotFoundError:
+            continue
+        for model_name, model_api_dict in api_endpoint_info.items():
+            entries.setdefault(model_name, model_api_dict)
+    return entries
+
+
+def _credentials(model_api_dict):
+    """`[(api_key, api_base), ...]` the entry sends requests with."""
+    if has_regions(model_api_dict):
+        return [(model_api_dict.get("api_key"), api_base) for api_base in region_bases(model_api_dict).values()]
+    if is_balanced(model_api_dict):
+        return [(api_key, api_base) for api_key, api_base, _ in upstream_members(model_api_dict)]
+    return [(model_api_dict.get("api_key"), model_api_dict.get("api_base"))]
+
+
+def _config_error(model_api_dict):
+    """Why the entry cannot send any request, or None."""
+    if model_api_dict["api_type"] == "gemini" and not os.environ.get("GEMINI_API_KEY"):
+        if not all(api_key for api_key, _ in _credentials(model_api_dict)):
+            return "no api_key and GEMINI_API_KEY is not set"
+    return None
+
+
+def _pooled_client(api_type, api_key, api_base):
+    """Create the async client a turn of `api_type` would use; returns `(pool key args, url)`."""
+    if api_type == "openai":
+        api_base = api_base or "https://api.openai.com/v1"
+        get_openai_client("openai", api_base, api_key, is_async=True)
+        return ("openai", api_base, api_key), api_base
+    if api_type in OPENAI_COMPATIBLE_APIS:
+        default_api_base, api_key_env = OPENAI_COMPATIBLE_APIS[api_type]
+        api_base = api_base or default_api_base
+        api_key = api_key or os.environ.get(api_key_env)
+        get_openai_client(api_type, api_base, api_key, is_async=True)
+        return (api_type, api_base, api_key), api_base
+    if api_type in ("anthropic", "anthropic_message") and (api_key or os.environ.get("ANTHROPIC_API_KEY")):
+        api_key = api_key or os.environ["ANTHROPIC_API_KEY"]
+        get_anthropic_client(api_key, is_async=True)
+        return ("anthropic", None, api_key), "https://api.anthropic.com"
+    if api_type == "mistral":
+        get_mistral_client(api_key, is_async=True)
+        return ("mistral", None, api_key), "https://api.mistral.ai"
+    if api_type == "sambanova":
+        url = "https://api.sambanova.ai/v1/chat/completions"
+        client_pool.get_http_client("sambanova", url, is_async=True)
+        return ("sambanova", url, None), url
+    if api_type == "nvidia" and api_base:
+        client_pool.get_http_client("nvidia", api_base, is_async=True)
+        return ("nvidia", api_base, None), api_base
+    # gemini/vertex/cohere/replicate: the SDK owns its transport; importing is all we can do
+    return None, None
+
+
+class Warmup:
+    def __init__(self):
+        self.status = "disabled" if not WARMUP_ENABLED else "pending"
+        self.started_at = None
+        self.finished_at = None
+        self.config = {}
+        self.imports = {}
+        self.connections = {}
+        self.probes = {}
+        self._task = None
+
+    @property
+    def ready(self):
+        return self.status in ("ready", "disabled")
+
+    def start(self):
+        """Schedule `run()` on the running event loop (call from the app's startup)."""
+        if WARMUP_ENABLED and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def _import(self, module):
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(importlib.import_module, module)
+        except Exception as e:
+            self.imports[module] = {"error": repr(e)}
+            return
+        self.imports[module] = {"seconds": round(time.perf_counter() - start, 3)}
+
+    async def _connect(self, api_type, api_key, api_base):
+        start = time.perf_counter()
+        name = f"{api_type} {api_base}"
+        try:
+            pool_key, url = _pooled_client(api_type, api_key, api_base)
+            if pool_key is None:
+                return
+            name = f"{api_type} {url} {_fingerprint(pool_key[2])}"
+            status = await client_pool.preconnect(*pool_key, url, timeout=WARMUP_TIMEOUT)
+        except Exception as e:
+            self.connections[name] = {"error": repr(e)}
+            return
+        self.connections[name] = {"status": status, "seconds": round(time.perf_counter() - start, 3)}
+
+    async def _probe(self, model_name, model_api_dict):
+        conv = get_conversation_template(model_name)
+        conv.append_message(conv.roles[0], "Reply with one word: ready")
+        conv.append_message(conv.roles[1], None)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                async_complete(conv, model_name, model_api_dict, 0.0, 1.0, WARMUP_PROBE_MAX_TOKENS),
+                WARMUP_TIMEOUT,
+            )
+        except Exception as e:
+            self.probes[model_name] = {"error": repr(e)}
+            return
+        self.probes[model_name] = {"seconds": round(time.perf_counter() - start, 3)}
+
+    async def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        start = time.perf_counter()
+        entries = {
+            name: entry for name, entry in endpoint_entries().items()
+            if entry.get("api_type") not in OFFLINE_API_TYPES
+        }
+        try:
+            for name, entry in entries.items():
+                error = _config_error(entry)
+                if error is not None:
+                    logger.error(f"warm-up: {name}: {error}")
+                    self.config[name] = {"error": error}
+            modules = {m for entry in entries.values() for m in API_TYPE_MODULES.get(entry["api_type"], ())}
+            # one at a time: imports serialize on the import lock anyway
+            for module in sorted(modules):
+                await self._import(module)
+            targets = {
+                (entry["api_type"], api_key, api_base)
+                for entry in entries.values()
+                for api_key, api_base in _credentials(entry)
+            }
+            await asyncio.gather(*(self._connect(*target) for target in targets))
+            if WARMUP_PROBE:
+                await asyncio.gather(*(self._probe(name, entry) for name, entry in entries.items()))
+        except Exception as e:
+            logger.error(f"warm-up failed: {e!r}")
+        self.status = "ready"
+        self.finished_at = time.time()
+        logger.info(
+            f"warm-up done in {time.perf_counter() - start:.1f}s: {len(self.imports)} SDK modules, "
+            f"{len(self.connections)} connections, {len(self.probes)} probes"
+        )
+
+    def report(self):
+        return {
+            "status": self.status,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "probe": WARMUP_PROBE,
+            "config": self.config,
+            "imports": self.imports,
+            "connections": self.connections,
+            "probes": self.probes,
+        }
+
+
+warmup = Warmup()
@@ -18,6 +18,7 @@ def load_prompts(prompt_file_path):
         return json.load(f)
 
 class AkinatorGame(BaseGame):
+    game_name = "Akinator"
 
     def __init__(
         self,
@@ -119,6 +120,15 @@ class AkinatorGame(BaseGame):
         pattern = self.game_secret.lower()
         return len(re.findall(pattern, s.lower())) != 0
 
+    def made_correct_guess(self, s):
+        return self.check_akinator_valid_guess(s) and self.guessed_word_correctly(s)
+
+    def stream_watchers(self, type):
+        # a wrong guess may still name the object further on, so only a correct one stops early
+        if type == 'question':
+            return [self.made_correct_guess]
+        return []
+
     def parse_game_history(self, game_history):
         parsed_history = []
 
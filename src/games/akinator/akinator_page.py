@@ -1,14 +1,16 @@
 from fastapi import APIRouter, HTTPException, Query  # Original imports
-from fastapi import APIRouter, HTTPException, Query, Depends  # Added 'Depends' for dependency injection
+from fastapi import APIRouter, HTTPException, Query, Depends, Request  # Added 'Depends' for dependency injection
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Optional
 import uuid
 
 from src.games.akinator.akinator_game import AkinatorGame
 # from src.games.game_sessions import games  # Commented out; no longer using in-memory game sessions
-from src.fschat.api_provider_game import get_api_provider_stream_iter
+from src.fschat.api_provider_async import async_complete, get_api_provider_async_delta_iter
+from src.fschat.disconnect import cancel_on_disconnect
 
 # Added imports for database usage
-from src.database import get_db, GameSession, GameState, UserStars # Importing database session and models
+from src.database import get_db, find_session, add_session_usage, add_turn_models, GameSession, GameState, UserStars # Importing database session and models
 from sqlalchemy.orm import Session  # Importing Session for type hinting
 from src.fschat.conversation_game import Conversation  # Importing Conversation class
 from src.users.user_utilities import update_user_db, ensure_user_exists, extract_difficulty
@@ -21,7 +23,8 @@ router = APIRouter()
 
 
 @router.post("/start")
-def akinator_start(
+async def akinator_start(
+    request: Request,
     use_secret_word: str = Query(default="false", description="Whether to use (user-)provided secret word"),
     ingame_id: str = Query(default="null-id", description="Specify the in game: gameState.aiEscapeRoomID"),
     secret_word: Optional[str] = Query(default="apple", description="Specify the username"),
@@ -70,33 +73,38 @@ def akinator_start(
     next_llm_query_type = "question"
     game.update_AI_conversation(game.conversation, None)
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # Update conversation with AI message
-    ensure_user_exists(user_id=user_id, username=username, db=db)
-
-    # Create a new GameSession in the database
-    new_session = GameSession(
-        session_id=session_id,
-        user_id=user_id,
-        username=username,
-        game_name="Akinator",
-        state=GameState.PLAYING,
-        target_phrase=game.game_secret,
-        model=game.model_name,
-        history=game.conversation.messages,
-        round=game.round,
-        game_over=game.game_over,
-        game_status=game.game_status,
-        level=level,
-        system_prompt=game.system_prompt  # Storing system_prompt
-    )  # Added code to create a new GameSession
-    db.add(new_session)  # Add the session to the database
-    db.commit()  # Commit the transaction
+    def save_session():
+        ensure_user_exists(user_id=user_id, username=username, db=db)
+
+        # Create a new GameSession in the database
+        new_session = GameSession(
+            session_id=session_id,
+            user_id=user_id,
+            username=username,
+            game_name="Akinator",
+            state=GameState.PLAYING,
+            target_phrase=game.game_secret,
+            model=game.model_name,
+            history=game.conversation.messages,
+            round=game.round,
+            game_over=game.game_over,
+            game_status=game.game_status,
+            level=level,
+            system_prompt=game.system_prompt  # Storing system_prompt
+        )  # Added code to create a new GameSession
+        add_session_usage(db, new_session, game.pending_usage)
+        add_turn_models(new_session, game.pending_turns)
+        db.add(new_session)  # Add the session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     return {
         "message": "Akinator game started at level {}".format(level),
@@ -107,12 +115,12 @@ def akinator_start(
     }
 
 @router.post("/ask_question")
-def akinator_ask_question(session_id: str, 
+async def akinator_ask_question(request: Request, session_id: str, 
                           user_response: Dict[str, str],  
                           db: Session = Depends(get_db)):  # Added 'db' parameter
 
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Akinator").first()  # Fetch game session
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Akinator")  # Fetch game session
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -134,17 +142,22 @@ def akinator_ask_question(session_id: str,
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
 
     if game.reach_max_round():  # Max rounds reached
         game.set_game_status('PLAYER_LOSE')
-        # Update UserState in the database
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
 
-        # Update the game session in the database
-        game_session.game_over = game.game_over
-        game_session.game_status = game.game_status
-        db.add(game_session)
-        db.commit()
+        def save_game_over():
+            # Update UserState in the database
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
+
+            # Update the game session in the database
+            game_session.game_over = game.game_over
+            game_session.game_status = game.game_status
+            db.add(game_session)
+            db.commit()
+
+        await run_in_threadpool(save_game_over)
 
         return {
             "message": "Game over.",
@@ -165,31 +178,40 @@ def akinator_ask_question(session_id: str,
 
     game.update_AI_conversation(game.conversation, None)
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # Update conversation with AI message
     # game.update_AI_conversation(game.conversation, ai_message)
 
     # Check if game is over:
+    player_won = False
     if game.check_akinator_valid_guess(ai_message):  # LLM guessed the word
         if game.guessed_word_correctly(ai_message):
             game.set_game_status('PLAYER_WIN')
+            player_won = True
+
+    def save_session():
+        if player_won:
             # Update User State in the database
-            user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+
+        # Update the game session in the database
+        game_session.history = game.conversation.messages
 
-    # Update the game session in the database
-    game_session.history = game.conversation.messages
+        game_session.round = game.round
+        print("INSERT ROUND: " + str(game_session.round))
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
 
-    game_session.round = game.round
-    print("INSERT ROUND: " + str(game_session.round))
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+    await run_in_threadpool(save_session)
     
     return {
         "ai_message": ai_message,
@@ -199,9 +221,9 @@ def akinator_ask_question(session_id: str,
     }
 
 @router.post("/regenerate")
-def akinator_regenerate(session_id: str, db: Session = Depends(get_db)):
+async def akinator_regenerate(request: Request, session_id: str, db: Session = Depends(get_db)):
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Akinator").first()  # Fetch game session
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Akinator")  # Fetch game session
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -223,17 +245,22 @@ def akinator_regenerate(session_id: str, db: Session = Depends(get_db)):
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
 
     if game.reach_max_round():  # Max rounds reached
         game.set_game_status('PLAYER_LOSE')
-        # Update UserState in the database
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
 
-        # Update the game session in the database
-        game_session.game_over = game.game_over
-        game_session.game_status = game.game_status
-        db.add(game_session)
-        db.commit()
+        def save_game_over():
+            # Update UserState in the database
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
+
+            # Update the game session in the database
+            game_session.game_over = game.game_over
+            game_session.game_status = game.game_status
+            db.add(game_session)
+            db.commit()
+
+        await run_in_threadpool(save_game_over)
 
         return {
             "message": "Game over.",
@@ -247,28 +274,37 @@ def akinator_regenerate(session_id: str, db: Session = Depends(get_db)):
 
     next_llm_query_type = "question"
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # Check if game is over:
+    player_won = False
     if game.check_akinator_valid_guess(ai_message):  # LLM guessed the word
         if game.guessed_word_correctly(ai_message):
             game.set_game_status('PLAYER_WIN')
+            player_won = True
+
+    def save_session():
+        if player_won:
             # Update User State in the database
-            user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+
+        # Update the game session in the database
+        game_session.history = game.conversation.messages
 
-    # Update the game session in the database
-    game_session.history = game.conversation.messages
+        game_session.round = game.round
 
-    game_session.round = game.round
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
 
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+    await run_in_threadpool(save_session)
     
     return {
         "ai_message": ai_message,
@@ -277,9 +313,9 @@ def akinator_regenerate(session_id: str, db: Session = Depends(get_db)):
     }
 
 @router.post("/hint")
-def akinator_hint(use_secret_word: bool, session_id: str, db: Session = Depends(get_db)):
+async def akinator_hint(request: Request, use_secret_word: bool, session_id: str, db: Session = Depends(get_db)):
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Akinator").first()  # Fetch game session
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Akinator")  # Fetch game session
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -301,6 +337,7 @@ def akinator_hint(use_secret_word: bool, session_id: str, db: Session = Depends(
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
 
     if use_secret_word:
         if game.round == 1:
@@ -318,16 +355,24 @@ def akinator_hint(use_secret_word: bool, session_id: str, db: Session = Depends(
                 messages=new_message,
             )
 
-            hint_message = game.generation_assistant_response(
+            hint_message = await cancel_on_disconnect(request, game.async_generation_assistant_response(
                 "hint",
-                get_api_provider_stream_iter,
+                async_complete,
                 new_conversation,
-            )
+            ))
     else:
         game_secret_file = os.path.join(os.path.dirname(__file__), 'akinator.json')
         with open(game_secret_file, 'r') as f:
             game_secrets = json.load(f)
         hint_message = game_secrets[game.game_secret]
+
+    def save_session():
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
     
     return {
         "session_id": session_id,
@@ -1,12 +1,22 @@
-import random
 from abc import ABC, abstractmethod
 from typing import Callable, Optional, Any, Dict
 import re
 import os
 import hashlib
 
+from src.fschat.api_provider_async import async_collect_stream
+from src.fschat.api_provider_game import collect_stream
+from src.fschat.call_scheduler import call_scheduler
 from src.fschat.conversation_game import Conversation
+from src.fschat.disconnect import bill_if_abandoned
+from src.fschat.fallback import async_collect_with_fallback, collect_with_fallback, turn_record
+from src.fschat.generation_profiles import generation_profile, profile_outcomes
 from src.fschat.model_adapter import get_conversation_template
+from src.fschat.model_health import model_health
+from src.fschat.provider_metrics import call_type
+from src.fschat.response_cache import cached
+from src.fschat.singleflight import coalesced
+from src.fschat.usage_accounting import call_usage
 from utils import get_model_list
 
 def generate_hash(text: str) -> str:
@@ -43,6 +53,11 @@ def guess_in_output_stream(s):
         return False
 
 class BaseGame(ABC):
+    # name of the game in the generation profiles (and the GameSession table)
+    game_name = None
+    # table of the session row the game's usage is billed to
+    session_table = "game_sessions"
+
     def __init__(
         self,
         difficulty: str,
@@ -75,7 +90,8 @@ class BaseGame(ABC):
                     'src/config/api_endpoint.json', multimodal=False
                 )
             if model_name is None:
-                self.model_name = random.choice(models)
+                # weighted by provider health; models with an open breaker are skipped
+                self.model_name = model_health.choose_model(models)
             else:
                 self.model_name = model_name  # Use provided model_name
             
@@ -115,6 +131,9 @@ class BaseGame(ABC):
         self.game_status = None
         self.user_id = user_id
         self.username = username
+        # set by the routes once the game belongs to a stored session; identical
+        # calls are only coalesced within one session
+        self.session_id = None
 
         # self.game_name = ""
         # self.game_rule = ""
@@ -130,6 +149,13 @@ class BaseGame(ABC):
             'src/config/api_endpoint.json', multimodal=False)
         self.assistant_model_api_info = api_endpoint_info[self.assistant_model_name]
 
+        # closing record (finish reason, usage) of the last delta stream, if any
+        self.last_completion = None
+        # usage of the calls made since the page last saved it to the session row
+        self.pending_usage = []
+        # model that served each of those calls, for the session row's `turn_models`
+        self.pending_turns = []
+
         self.first_user_message = None  # The user's initial statement
         self.secret_system_message = None # FIXME (lanxiang): currently only used for Taboo. make configurable and elegant later
 
@@ -139,18 +165,8 @@ class BaseGame(ABC):
         else:
             conversation.append_message(conversation.roles[0], self.system_prompt + "\n\n" + self.first_user_message)
 
-    def generation_response(
-        self,
-        type: str,
-        stream_iter_fn: Callable,
-        conversation: Conversation,
-        temperature: float = 0.0,
-        top_p: float = 1.0,
-        max_new_tokens: int = 1024,
-        state=None,
-        use_recommended_config: bool = True,
-    ) -> str:
-        print("starting response generation...")
+    def _prepare_generation(self, type, temperature, top_p, use_recommended_config):
+        """Resolve sampling params and the expected output prefix for a turn."""
         if use_recommended_config:
             print("extracting recommended config...")
             recommended_config = self.model_api_info.get("recommended_config", None)
@@ -180,21 +196,78 @@ class BaseGame(ABC):
         #         conversation.roles[1], None
         #     )
 
-        stream_iter = stream_iter_fn(
-            conversation,
-            self.model_name,
-            self.model_api_info,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            state=state,
+        return prefix, temperature, top_p
+
+    def _apply_generation_profile(self, type, model_name, model_api_info, max_new_tokens):
+        """Token cap and endpoint info (with stop sequences) from the game's profile for `type`.
+
+        An explicit `max_new_tokens` from the caller wins over the profile.
+        """
+        profile = generation_profile(self.game_name, type, model_name)
+        if max_new_tokens is None:
+            max_new_tokens = profile["max_new_tokens"]
+        if profile["stop"]:
+            model_api_info = dict(model_api_info, stop=profile["stop"])
+        return max_new_tokens, model_api_info
+
+    def _run_turn(self, type, stream_iter_fn, temperature, top_p, max_new_tokens, state, watchers=()):
+        """`run` callable for `collect_with_fallback`: one `type` turn on a given model."""
+        def run(model_name, model_api_info, conversation):
+            tokens, model_api_info = self._apply_generation_profile(
+                type, model_name, model_api_info, max_new_tokens
+            )
+            with call_type(type):
+                stream_iter = cached(coalesced(stream_iter_fn, type, scope=self.session_id), type)(
+                    conversation,
+                    model_name,
+                    model_api_info,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=tokens,
+                    state=state,
+                )
+                return collect_stream(stream_iter, watchers)
+
+        return run
+
+    def _async_run_turn(self, type, stream_iter_fn, temperature, top_p, max_new_tokens, state, watchers=()):
+        """Async `_run_turn`."""
+        async def run(model_name, model_api_info, conversation):
+            tokens, model_api_info = self._apply_generation_profile(
+                type, model_name, model_api_info, max_new_tokens
+            )
+            with call_type(type), bill_if_abandoned(self, model_name, model_api_info, conversation):
+                stream_iter = cached(coalesced(stream_iter_fn, type, scope=self.session_id), type)(
+                    conversation,
+                    model_name,
+                    model_api_info,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=tokens,
+                    state=state,
+                )
+                return await async_collect_stream(stream_iter, watchers)
+
+        return run
+
+    def _record_turn(self, type, model_name, served_by, served_api_info, conversation, output):
+        """Outcome, usage and serving model of a `type` turn meant for `model_name`."""
+        profile_outcomes.record(self.game_name, type, served_by, self.last_completion)
+        self.pending_usage.append(
+            call_usage(served_by, served_api_info, conversation, output, self.last_completion)
         )
-        output = ""
-        for data in stream_iter:
-            assert data["error_code"] == 0
-            # Update the output with the latest text from the API
-            output = data["text"].strip()
+        self.pending_turns.append(turn_record(type, model_name, served_by))
 
+    def stream_watchers(self, type) -> list:
+        """Checks on the partial reply of a `type` turn that can stop the stream early.
+
+        A watcher returns True once the text so far already decides the turn; the
+        page then judges the reply as it was cut. No watchers by default.
+        """
+        return []
+
+    def _finalize_response(self, type, prefix, output, conversation) -> str:
+        """Post-process the raw model output and write it back into the conversation."""
         # checking akinator guess
         pattern = r"this is a guess"
         guess_flag = len(re.findall(pattern, output.lower())) != 0
@@ -214,20 +287,63 @@ class BaseGame(ABC):
         
         self.round += 1
         return output
-    
-    def generation_assistant_response(
+
+    def generation_response(
         self,
         type: str,
         stream_iter_fn: Callable,
         conversation: Conversation,
         temperature: float = 0.0,
         top_p: float = 1.0,
-        max_new_tokens: int = 1024,
+        max_new_tokens: Optional[int] = None,
         state=None,
         use_recommended_config: bool = True,
-        model_name: str = "gpt-4o-2024-11-20",
-        # model_api_info: dict,
     ) -> str:
+        print("starting response generation...")
+        prefix, temperature, top_p = self._prepare_generation(
+            type, temperature, top_p, use_recommended_config
+        )
+        output, self.last_completion, served_by, served_api_info = collect_with_fallback(
+            self._run_turn(type, stream_iter_fn, temperature, top_p, max_new_tokens, state, self.stream_watchers(type)),
+            self.model_name,
+            self.model_api_info,
+            conversation,
+        )
+        self._record_turn(type, self.model_name, served_by, served_api_info, conversation, output)
+        output = output.strip()
+
+        return self._finalize_response(type, prefix, output, conversation)
+
+    async def async_generation_response(
+        self,
+        type: str,
+        stream_iter_fn: Callable,
+        conversation: Conversation,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        max_new_tokens: Optional[int] = None,
+        state=None,
+        use_recommended_config: bool = True,
+    ) -> str:
+        """Same as `generation_response`, for async stream iterators."""
+        print("starting response generation...")
+        prefix, temperature, top_p = self._prepare_generation(
+            type, temperature, top_p, use_recommended_config
+        )
+        async with call_scheduler.slot("turn"):
+            output, self.last_completion, served_by, served_api_info = await async_collect_with_fallback(
+                self._async_run_turn(type, stream_iter_fn, temperature, top_p, max_new_tokens, state, self.stream_watchers(type)),
+                self.model_name,
+                self.model_api_info,
+                conversation,
+            )
+        self._record_turn(type, self.model_name, served_by, served_api_info, conversation, output)
+        output = output.strip()
+
+        return self._finalize_response(type, prefix, output, conversation)
+
+    def _prepare_assistant_generation(self, type, temperature, top_p, use_recommended_config):
+        """Resolve sampling params and endpoint info for the assistant/hint model."""
         if use_recommended_config:
                 print("extracting recommended assistant model config...")
                 recommended_config = self.assistant_model_api_info.get("recommended_config", None)
@@ -237,7 +353,6 @@ class BaseGame(ABC):
                 top_p = recommended_config.get("top_p", 1.0)
         
         # Generating new question
-        model_name = model_name
         _, _, api_endpoint_info = get_model_list(
                 'src/config/api_endpoint.json', multimodal=False
             )
@@ -248,21 +363,66 @@ class BaseGame(ABC):
         else:
             raise NotImplementedError(f"type: {type} not implemented.")
 
-        stream_iter = stream_iter_fn(
-            conversation,
+        return model_name, model_api_endpoint_info, temperature, top_p
+
+    def generation_assistant_response(
+        self,
+        type: str,
+        stream_iter_fn: Callable,
+        conversation: Conversation,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        max_new_tokens: Optional[int] = None,
+        state=None,
+        use_recommended_config: bool = True,
+        model_name: str = "gpt-4o-2024-11-20",
+        # model_api_info: dict,
+    ) -> str:
+        model_name, model_api_endpoint_info, temperature, top_p = self._prepare_assistant_generation(
+            type, temperature, top_p, use_recommended_config
+        )
+        output, self.last_completion, served_by, served_api_info = collect_with_fallback(
+            self._run_turn(type, stream_iter_fn, temperature, top_p, max_new_tokens, state),
             model_name,
             model_api_endpoint_info,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            state=state,
+            conversation,
         )
-        output = ""
-        # print(stream_iter)
-        for data in stream_iter:
-            assert data["error_code"] == 0
-            # Update the output with the latest text from the API
-            output = data["text"].strip()
+        self._record_turn(type, model_name, served_by, served_api_info, conversation, output)
+        output = output.strip()
+
+        print("assistant responses:")
+        print(output)
+
+        conversation.update_last_message(output)
+        
+        return output
+
+    async def async_generation_assistant_response(
+        self,
+        type: str,
+        stream_iter_fn: Callable,
+        conversation: Conversation,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        max_new_tokens: Optional[int] = None,
+        state=None,
+        use_recommended_config: bool = True,
+        model_name: str = "gpt-4o-2024-11-20",
+    ) -> str:
+        """Same as `generation_assistant_response`, for async stream iterators."""
+        model_name, model_api_endpoint_info, temperature, top_p = self._prepare_assistant_generation(
+            type, temperature, top_p, use_recommended_config
+        )
+        # assistant suggestions and hints yield to gameplay turns
+        async with call_scheduler.slot("hint" if type == "hint" else "assistant"):
+            output, self.last_completion, served_by, served_api_info = await async_collect_with_fallback(
+                self._async_run_turn(type, stream_iter_fn, temperature, top_p, max_new_tokens, state),
+                model_name,
+                model_api_endpoint_info,
+                conversation,
+            )
+        self._record_turn(type, model_name, served_by, served_api_info, conversation, output)
+        output = output.strip()
 
         print("assistant responses:")
         print(output)
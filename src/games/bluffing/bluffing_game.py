@@ -7,6 +7,8 @@ from src.games.base_game import BaseGame
 from src.fschat.conversation_game import Conversation
 
 class BluffingGame(BaseGame):
+    game_name = "Bluffing"
+
     def __init__(
         self,
         difficulty: str,
@@ -89,6 +91,12 @@ class BluffingGame(BaseGame):
     def is_llm_giving_answer(self, ai_message):
         return self.check_valid_guess(ai_message)
 
+    def stream_watchers(self, type):
+        # the first true/false after the verdict phrase is what check_user_win reads
+        if type == 'question':
+            return [self.check_valid_guess]
+        return []
+
     def check_user_win(self, ai_message, user_statement_truth):
         """
         Determine if the user wins based on the AI's guess and the actual truth of the user's statement.
@@ -1,14 +1,16 @@
-from fastapi import APIRouter, HTTPException, Query, Depends  # Added 'Depends'
+from fastapi import APIRouter, HTTPException, Query, Depends, Request  # Added 'Depends'
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Optional
 import uuid
 import json
 
 from src.games.bluffing.bluffing_game import BluffingGame
 # from src.games.game_sessions import games  # Commented out; no longer using in-memory game sessions
-from src.fschat.api_provider_game import get_api_provider_stream_iter
+from src.fschat.api_provider_async import async_complete, get_api_provider_async_delta_iter
+from src.fschat.disconnect import cancel_on_disconnect
 
 # Added imports for database usage
-from src.database import get_db, GameSession, GameState  # Importing database session and models
+from src.database import get_db, find_session, add_session_usage, add_turn_models, GameSession, GameState  # Importing database session and models
 from sqlalchemy.orm import Session  # Importing Session for type hinting
 from src.fschat.conversation_game import Conversation  # Importing Conversation class
 from src.users.user_utilities import update_user_db, ensure_user_exists, extract_difficulty
@@ -19,7 +21,8 @@ import json
 router = APIRouter()
 
 @router.post("/start")
-def bluffing_start(
+async def bluffing_start(
+    request: Request,
     ingame_id: str = Query(default="null-id", description="Specify the in game: gameState.aiEscapeRoomID"),
     level: Optional[int] = Query(default=1, ge=1, le=3, description="Specify the level of the game (1 to 3)"),
     user_id: Optional[int] = Query(default=0, description="Specify the user ID (default is 0)"),
@@ -44,32 +47,37 @@ def bluffing_start(
 
     game.update_AI_conversation(game.conversation, None)
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
-
-    ensure_user_exists(user_id=user_id, username=username, db=db)
-
-    # Create a new GameSession in the database
-    new_session = GameSession(
-        session_id=session_id,
-        user_id=user_id,
-        username=username,
-        game_name="Bluffing",
-        state=GameState.PLAYING,
-        target_phrase=json.dumps(game.system_question),  # Store the system question
-        model=game.model_name,
-        history=game.conversation.messages,
-        round=game.round,
-        game_over=game.game_over,
-        game_status=game.game_status,
-        level=level,
-        system_prompt=game.system_prompt
-    )  # Added code to create a new GameSession
-    db.add(new_session)  # Add the session to the database
-    db.commit()  # Commit the transaction
+    ))
+
+    def save_session():
+        ensure_user_exists(user_id=user_id, username=username, db=db)
+
+        # Create a new GameSession in the database
+        new_session = GameSession(
+            session_id=session_id,
+            user_id=user_id,
+            username=username,
+            game_name="Bluffing",
+            state=GameState.PLAYING,
+            target_phrase=json.dumps(game.system_question),  # Store the system question
+            model=game.model_name,
+            history=game.conversation.messages,
+            round=game.round,
+            game_over=game.game_over,
+            game_status=game.game_status,
+            level=level,
+            system_prompt=game.system_prompt
+        )  # Added code to create a new GameSession
+        add_session_usage(db, new_session, game.pending_usage)
+        add_turn_models(new_session, game.pending_turns)
+        db.add(new_session)  # Add the session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     return {
         "message": "Bluffing game started.",
@@ -81,9 +89,9 @@ def bluffing_start(
     }
 
 @router.post("/assistant")
-def bluffing_assistant(session_id:str,
+async def bluffing_assistant(request: Request, session_id:str,
                        db:Session = Depends(get_db)):
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Bluffing").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Bluffing")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
     
@@ -106,6 +114,7 @@ def bluffing_assistant(session_id:str,
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
     # Also, retrieve any other necessary attributes
     game.system_question = json.loads(game_session.target_phrase)
     game.user_statement_truth = 'False'  # FIXME: retrieve from game session if stored
@@ -119,14 +128,22 @@ def bluffing_assistant(session_id:str,
         system_message=assistant_system_prompt
     )
 
-    ai_message = game.generation_assistant_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_assistant_response(
         "assistant",
-        get_api_provider_stream_iter,
+        async_complete,
         new_conversation,
-    )
+    ))
 
     possible_answers = game.extract_answer(ai_message)
 
+    def save_session():
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
+
     return {
         "session_id": session_id,
         "first_response": possible_answers[0],
@@ -135,11 +152,11 @@ def bluffing_assistant(session_id:str,
 
 @router.post("/ask_question")
 # LLM asks question
-def bluffing_ask_question(session_id: str, 
+async def bluffing_ask_question(request: Request, session_id: str, 
                           user_response: Dict[str, str], 
                           db: Session = Depends(get_db)):  # Added 'db' parameter
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Bluffing").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Bluffing")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -162,6 +179,7 @@ def bluffing_ask_question(session_id: str,
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
     # Also, retrieve any other necessary attributes
     game.system_question = json.loads(game_session.target_phrase)
     game.user_statement_truth = 'False'  # FIXME: retrieve from game session if stored
@@ -188,11 +206,11 @@ def bluffing_ask_question(session_id: str,
 
     game.update_AI_conversation(game.conversation, None)
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # Update conversation with AI message
     # game.update_AI_conversation(game.conversation, ai_message)
@@ -213,19 +231,24 @@ def bluffing_ask_question(session_id: str,
         game.set_game_status('PLAYER_WIN')
         end_reason = "MAX_ROUND_REACHED"
     
-    if game.game_status == 'PLAYER_WIN':
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
-    elif game.game_status == 'PLAYER_LOSE':
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
+    def save_session():
+        if game.game_status == 'PLAYER_WIN':
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+        elif game.game_status == 'PLAYER_LOSE':
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
 
 
-    # Update the game session in the database
-    game_session.history = game.conversation.messages
-    game_session.round = game.round
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+        # Update the game session in the database
+        game_session.history = game.conversation.messages
+        game_session.round = game.round
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     return {
         "ai_message": ai_message,
@@ -237,9 +260,9 @@ def bluffing_ask_question(session_id: str,
 
 @router.post("/regenerate")
 # LLM asks question
-def bluffing_regenerate(session_id: str, db: Session = Depends(get_db)):
+async def bluffing_regenerate(request: Request, session_id: str, db: Session = Depends(get_db)):
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Bluffing").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Bluffing")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -262,6 +285,7 @@ def bluffing_regenerate(session_id: str, db: Session = Depends(get_db)):
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
     # Also, retrieve any other necessary attributes
     game.system_question = json.loads(game_session.target_phrase)
     game.user_statement_truth = 'False'  # FIXME: retrieve from game session if stored
@@ -278,38 +302,46 @@ def bluffing_regenerate(session_id: str, db: Session = Depends(get_db)):
 
     next_llm_query_type = "question"
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # Update conversation with AI message
     # game.update_AI_conversation(game.conversation, ai_message)
 
     # Check if AI made a guess
+    stars = 0
     if game.is_llm_giving_answer(ai_message):
         if game.check_user_win(ai_message, game.user_statement_truth):
             game.set_game_status('PLAYER_WIN')
-            user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+            stars = 1
         else:
             game.set_game_status('PLAYER_LOSE')
-            user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
+            stars = -1
 
     # Check for max rounds
     if game.round >= game.max_rounds and not game.is_game_over():
         # LLM fails to make a guess despite of best efforts
         game.set_game_status('PLAYER_WIN')
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+        stars = 1
 
+    def save_session():
+        if stars:
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=stars, db=db)
 
-    # Update the game session in the database
-    game_session.history = game.conversation.messages
-    game_session.round = game.round
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+        # Update the game session in the database
+        game_session.history = game.conversation.messages
+        game_session.round = game.round
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     return {
         "ai_message": ai_message,
@@ -318,8 +350,8 @@ def bluffing_regenerate(session_id: str, db: Session = Depends(get_db)):
     }
 
 @router.post("/hint")
-def bluffing_hint(session_id: str, db: Session = Depends(get_db)):
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Bluffing").first()
+async def bluffing_hint(request: Request, session_id: str, db: Session = Depends(get_db)):
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Bluffing")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
     
@@ -342,6 +374,7 @@ def bluffing_hint(session_id: str, db: Session = Depends(get_db)):
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
 
     print(f"hint game round: {game.round}")
     if game.round == 1:
@@ -361,11 +394,19 @@ def bluffing_hint(session_id: str, db: Session = Depends(get_db)):
             messages=new_message,
         )
 
-        hint_message = game.generation_assistant_response(
+        hint_message = await cancel_on_disconnect(request, game.async_generation_assistant_response(
             "hint",
-            get_api_provider_stream_iter,
+            async_complete,
             new_conversation,
-        )
+        ))
+
+    def save_session():
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
     
     return {
         "session_id": session_id,
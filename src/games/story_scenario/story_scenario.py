@@ -18,6 +18,8 @@ def load_prompts(prompt_file_path=STORY_SCENARIO_PROMPTS_PATH):
         return prompt_for_scenario, prompt_for_outcome
 
 class StoryScenarioGame(BaseGame):
+    game_name = "StoryScenario"
+
     def __init__(
         self,
         current_room: Optional[str] = "random room",
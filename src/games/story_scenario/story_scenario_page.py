@@ -1,11 +1,13 @@
-from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Optional
 import uuid
 
 from src.games.story_scenario.story_scenario import StoryScenarioGame, load_prompts
-from src.fschat.api_provider_game import get_api_provider_stream_iter
+from src.fschat.api_provider_async import get_api_provider_async_delta_iter
+from src.fschat.disconnect import cancel_on_disconnect
 
-from src.database import get_db, GameSession, GameState, UserStars # Importing database session and models
+from src.database import get_db, find_session, add_session_usage, add_turn_models, GameSession, GameState, UserStars # Importing database session and models
 from sqlalchemy.orm import Session  # Importing Session for type hinting
 from src.fschat.conversation_game import Conversation  # Importing Conversation class
 from src.users.user_utilities import update_user_db, ensure_user_exists
@@ -32,7 +34,8 @@ from pydantic import BaseModel
 router = APIRouter()
 
 @router.post("/start")
-def storyscenario_start(
+async def storyscenario_start(
+    request: Request,
     current_room: Optional[str] = Query(default="random room", description="Specify the current room"),
     user_id: Optional[int] = Query(default=0, description="Specify the user ID (default is 0)"),
     username: Optional[str] = Query(default="anonymous", description="Specify the username"),  # Added 'username' parameter
@@ -51,35 +54,40 @@ def storyscenario_start(
 
     next_llm_query_type = "answer"
     game.update_AI_conversation(game.conversation, None)
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
-
-    ensure_user_exists(user_id=user_id, username=username, db=db)
-
-    print("========== game history ==========")
-    print(game.conversation.messages)
-    
-    new_session = GameSession(
-        session_id=session_id,
-        user_id=user_id,
-        username=username,
-        game_name="StoryScenario",
-        state=GameState.PLAYING,
-        target_phrase=None,
-        model=game.model_name,
-        history=game.conversation.messages, # remove empty system prompt
-        round=game.round,
-        game_over=game.game_over,
-        game_status=game.game_status,
-        game_stat_change=game.stat_change_dict,
-        level=1,
-        system_prompt=game.system_prompt  # Storing system_prompt
-    )  # Added code to create a new GameSession
-    db.add(new_session)  # Add the session to the database
-    db.commit()  # Commit the transaction
+    ))
+
+    def save_session():
+        ensure_user_exists(user_id=user_id, username=username, db=db)
+
+        print("========== game history ==========")
+        print(game.conversation.messages)
+
+        new_session = GameSession(
+            session_id=session_id,
+            user_id=user_id,
+            username=username,
+            game_name="StoryScenario",
+            state=GameState.PLAYING,
+            target_phrase=None,
+            model=game.model_name,
+            history=game.conversation.messages, # remove empty system prompt
+            round=game.round,
+            game_over=game.game_over,
+            game_status=game.game_status,
+            game_stat_change=game.stat_change_dict,
+            level=1,
+            system_prompt=game.system_prompt  # Storing system_prompt
+        )  # Added code to create a new GameSession
+        add_session_usage(db, new_session, game.pending_usage)
+        add_turn_models(new_session, game.pending_turns)
+        db.add(new_session)  # Add the session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     print("ai message:")
     print(ai_message)
@@ -99,13 +107,14 @@ def storyscenario_start(
     }
 
 @router.post("/conclude")
-def storyscenario_conclude(
+async def storyscenario_conclude(
+    request: Request,
     data: ScenarioRequest,
     db: Session = Depends(get_db)
 ):  
     session_id = data.session_id
     choice_index = data.choice_index
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="StoryScenario").first()  # Fetch game session
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="StoryScenario")  # Fetch game session
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -127,6 +136,7 @@ def storyscenario_conclude(
         model_name=game_session.model,
         stat_change_dict=game_session.game_stat_change
     )
+    game.session_id = session_id
 
     print("========== reinitialized game history ==========")
     print(game.conversation.messages)
@@ -142,24 +152,29 @@ def storyscenario_conclude(
 
     next_llm_query_type = "answer"
     game.update_AI_conversation(game.conversation, None)
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     game.game_over = True
     game.game_status = "TERMINATED"
 
-    # update game session state
-    game_session.history = game.conversation.messages
-    game_session.round = game.round
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    game_session.target_phrase = user_choice
+    def save_session():
+        # update game session state
+        game_session.history = game.conversation.messages
+        game_session.round = game.round
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        game_session.target_phrase = user_choice
+
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
 
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+    await run_in_threadpool(save_session)
 
     return {
         "message": "StoryScenario game concluded.",
@@ -7,6 +7,8 @@ from typing import Optional, Any  # Added for type hints
 from fschat.conversation_game import Conversation
 
 class TabooGame(BaseGame):
+    game_name = "Taboo"
+
     def __init__(
         self,
         difficulty: str,
@@ -104,6 +106,19 @@ class TabooGame(BaseGame):
 
     def check_word_uttered(self, ai_message):
         return self.game_secret.lower() in ai_message.lower()
+
+    def guess_completed(self, ai_message):
+        """
+        Check if a partial reply already holds a whole guessed word.
+        """
+        return bool(re.search(r"my guess of the word is:\s*[^\s.]+[\s.]", ai_message.lower()))
+
+    def stream_watchers(self, type):
+        # only a finished guess decides the turn: the word can come up before a
+        # guess phrase that follows it, and the guess is scored first
+        if type == 'answer':
+            return [self.guess_completed]
+        return []
     
     def choose_assistant_prompt(self):
         prompt_file = os.path.join(os.path.dirname(__file__), 'taboo_optimized_assistant_prompts.json')
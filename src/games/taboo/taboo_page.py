@@ -1,13 +1,15 @@
-from fastapi import APIRouter, HTTPException, Query, Depends  # Added 'Depends'
+from fastapi import APIRouter, HTTPException, Query, Depends, Request  # Added 'Depends'
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Optional
 import uuid
 
 from src.games.taboo.taboo_game import TabooGame
 # from src.games.game_sessions import games  # Commented out; no longer using in-memory game sessions
-from src.fschat.api_provider_game import get_api_provider_stream_iter
+from src.fschat.api_provider_async import async_complete, get_api_provider_async_delta_iter
+from src.fschat.disconnect import cancel_on_disconnect
 
 # Added imports for database usage
-from src.database import get_db, GameSession, GameState
+from src.database import get_db, find_session, add_session_usage, add_turn_models, GameSession, GameState
 from sqlalchemy.orm import Session
 from src.fschat.conversation_game import Conversation
 from src.users.user_utilities import update_user_db, ensure_user_exists, extract_difficulty
@@ -60,9 +62,9 @@ def taboo_start(
     }
 
 @router.post("/assistant")
-def taboo_assistant(session_id:str,
+async def taboo_assistant(request: Request, session_id:str,
                        db:Session = Depends(get_db)):
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Taboo").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Taboo")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
     
@@ -86,6 +88,7 @@ def taboo_assistant(session_id:str,
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
     # Also, set game_secret
     game.game_secret = game_session.target_phrase
 
@@ -98,14 +101,22 @@ def taboo_assistant(session_id:str,
         system_message=assistant_system_prompt
     )
 
-    ai_message = game.generation_assistant_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_assistant_response(
         "assistant",
-        get_api_provider_stream_iter,
+        async_complete,
         new_conversation,
-    )
+    ))
 
     possible_answers = game.extract_answer(ai_message)
 
+    def save_session():
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
+
     return {
         "session_id": session_id,
         "first_response": possible_answers[0],
@@ -114,11 +125,11 @@ def taboo_assistant(session_id:str,
 
 @router.post("/ask_question")
 # LLM answers
-def taboo_ask_question(session_id: str, 
+async def taboo_ask_question(request: Request, session_id: str, 
                        user_response: Dict[str, str],
                        db: Session = Depends(get_db)):  # Added 'db' parameter
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Taboo").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Taboo")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -141,6 +152,7 @@ def taboo_ask_question(session_id: str,
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
     # Also, set game_secret
     game.game_secret = game_session.target_phrase
 
@@ -163,11 +175,11 @@ def taboo_ask_question(session_id: str,
 
     game.update_AI_conversation(game.conversation, None)
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # First check if the model has attempted a prediction --> game terminates
     end_reason = None
@@ -190,18 +202,23 @@ def taboo_ask_question(session_id: str,
         game.set_game_status('PLAYER_LOSE')
         end_reason = "MAX_ROUND_REACHED"
 
-    if game.game_status == 'PLAYER_WIN':
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
-    elif game.game_status == 'PLAYER_LOSE':
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
-
-    # Update the game session in the database
-    game_session.history = game.conversation.messages
-    game_session.round = game.round
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+    def save_session():
+        if game.game_status == 'PLAYER_WIN':
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+        elif game.game_status == 'PLAYER_LOSE':
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
+
+        # Update the game session in the database
+        game_session.history = game.conversation.messages
+        game_session.round = game.round
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     return {
         "ai_message": ai_message,
@@ -213,9 +230,9 @@ def taboo_ask_question(session_id: str,
 
 @router.post("/regenerate")
 # LLM answers
-def taboo_regenerate(session_id: str, db: Session = Depends(get_db)):  # Added 'db' parameter
+async def taboo_regenerate(request: Request, session_id: str, db: Session = Depends(get_db)):  # Added 'db' parameter
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Taboo").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Taboo")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -238,6 +255,7 @@ def taboo_regenerate(session_id: str, db: Session = Depends(get_db)):  # Added '
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
     # Also, set game_secret
     game.game_secret = game_session.target_phrase
 
@@ -253,30 +271,39 @@ def taboo_regenerate(session_id: str, db: Session = Depends(get_db)):  # Added '
 
     next_llm_query_type = "answer"
 
-    ai_message = game.generation_response(
+    ai_message = await cancel_on_disconnect(request, game.async_generation_response(
         next_llm_query_type,
-        get_api_provider_stream_iter,
+        get_api_provider_async_delta_iter,
         game.conversation,
-    )
+    ))
 
     # Taboo-specific game logic
+    stars = 0
     if game.check_word_uttered(ai_message):
         game.game_over = True
         game.game_status = 'PLAYER_WIN'
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=1, db=db)
+        stars = 1
 
     elif game.round >= game.max_rounds:
         game.game_over = True
         game.game_status = 'PLAYER_LOSE'
-        user_status = update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=-1, db=db)
-
-    # Update the game session in the database
-    game_session.history = game.conversation.messages
-    game_session.round = game.round
-    game_session.game_over = game.game_over
-    game_session.game_status = game.game_status
-    db.add(game_session)  # Add the updated session to the database
-    db.commit()  # Commit the transaction
+        stars = -1
+
+    def save_session():
+        if stars:
+            update_user_db(user_id=game_session.user_id, username=game_session.username, addToStars=stars, db=db)
+
+        # Update the game session in the database
+        game_session.history = game.conversation.messages
+        game_session.round = game.round
+        game_session.game_over = game.game_over
+        game_session.game_status = game.game_status
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)  # Add the updated session to the database
+        db.commit()  # Commit the transaction
+
+    await run_in_threadpool(save_session)
 
     return {
         "ai_message": ai_message,
@@ -285,9 +312,9 @@ def taboo_regenerate(session_id: str, db: Session = Depends(get_db)):  # Added '
     }
 
 @router.post("/hint")
-def taboo_hint(session_id: str, db: Session = Depends(get_db)):
+async def taboo_hint(request: Request, session_id: str, db: Session = Depends(get_db)):
     # Retrieve the game session from the database
-    game_session = db.query(GameSession).filter_by(session_id=session_id, game_name="Taboo").first()
+    game_session = await run_in_threadpool(find_session, db, GameSession, session_id=session_id, game_name="Taboo")
     if not game_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
     
@@ -311,6 +338,7 @@ def taboo_hint(session_id: str, db: Session = Depends(get_db)):
         game_status=game_session.game_status,
         model_name=game_session.model
     )
+    game.session_id = session_id
 
     print(f"hint game round: {game.round}")
     if game.round == 0:
@@ -345,11 +373,20 @@ def taboo_hint(session_id: str, db: Session = Depends(get_db)):
             messages=new_message,
         )
 
-        hint_message = game.generation_assistant_response(
+        hint_message = await cancel_on_disconnect(request, game.async_generation_assistant_response(
             "hint",
-            get_api_provider_stream_iter,
+            async_complete,
             new_conversation,
-        )
+        ))
+
+    def save_session():
+        add_session_usage(db, game_session, game.pending_usage)
+        add_turn_models(game_session, game.pending_turns)
+        db.add(game_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
+
     return {
         "session_id": session_id,
         "hint_message": hint_message
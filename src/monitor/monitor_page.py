@@ -0,0 +1,155 @@
+# src/monitor/monitor_page.py
+
+import datetime
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+
+from src.database import get_db, ModelUsageDaily
+from src.fschat.call_scheduler import call_scheduler
+from src.fschat.cassette import cassette_store
+from src.fschat.client_pool import client_pool, gemini_model_cache
+from src.fschat.disconnect import disconnect_stats
+from src.fschat.fallback import fallback_stats
+from src.fschat.generation_profiles import profile_outcomes
+from src.fschat.hedging import hedging_stats
+from src.fschat.key_balancer import key_balancer
+from src.fschat.model_health import model_health
+from src.fschat.provider_metrics import provider_metrics
+from src.fschat.rate_limiter import rate_limiter
+from src.fschat.region_router import region_router
+from src.fschat.response_cache import response_cache
+from src.fschat.singleflight import singleflight_stats
+
+router = APIRouter()
+
+
+@router.get("/scheduler")
+def scheduler_stats():
+    """
+    LLM call slots per priority class: running, waiting, and how many were queued or shed.
+    """
+    return call_scheduler.stats()
+
+
+@router.get("/client_pool")
+def client_pool_stats():
+    """
+    Pooled provider clients, how often their keep-alive connections get reused,
+    and the cache of configured Gemini models.
+    """
+    return {**client_pool.stats(), "gemini_models": gemini_model_cache.stats()}
+
+
+@router.get("/hedging")
+def hedging_stats_endpoint():
+    """
+    Hedged requests per model and the time-to-first-token window behind the hedge delay.
+    """
+    return hedging_stats()
+
+
+@router.get("/key_balancer")
+def key_balancer_stats():
+    """
+    Requests in flight and served per api key/base of the balanced endpoints, and which are quarantined.
+    """
+    return key_balancer.stats()
+
+
+@router.get("/model_health")
+def model_health_stats():
+    """
+    Circuit breaker state per model: open breakers are skipped when a new game picks its model.
+    """
+    return model_health.stats()
+
+
+@router.get("/regions")
+def region_stats():
+    """
+    Probed round trip and time to first token per region of the multi-region endpoints, and where each routes.
+    """
+    return region_router.stats()
+
+
+@router.get("/response_cache")
+def response_cache_stats():
+    """
+    Response cache hits and misses per call type, with the provider tokens the hits saved.
+    """
+    return response_cache.stats()
+
+
+@router.get("/rate_limits")
+def rate_limit_stats():
+    """
+    Shared rate-limit buckets (all workers) and how long this worker queued calls behind them.
+    """
+    return rate_limiter.stats()
+
+
+@router.get("/singleflight")
+def singleflight_stats_endpoint():
+    """
+    Provider calls per call type that went upstream vs. joined an identical call already in flight.
+    """
+    return singleflight_stats()
+
+
+@router.get("/cassettes")
+def cassette_stats():
+    """
+    Recorded provider responses per cassette, and what this worker recorded and replayed.
+    """
+    return cassette_store.stats()
+
+
+@router.get("/disconnects")
+def disconnect_stats_endpoint():
+    """
+    Turns per route cancelled because the client disconnected, with the time and output tokens that saved.
+    """
+    return disconnect_stats.stats()
+
+
+@router.get("/fallbacks")
+def fallback_stats_endpoint():
+    """
+    Turns per model and which model of its fallback chain served them.
+    """
+    return fallback_stats.stats()
+
+
+@router.get("/generation_profiles")
+def generation_profile_stats():
+    """
+    Finish reasons per game, call type and model under their generation profile, with the truncation rate.
+    """
+    return profile_outcomes.stats()
+
+
+@router.get("/provider_latency")
+def provider_latency_stats():
+    """
+    Per model: request outcomes and p50/p95 of time to first token, chunk gaps, duration and tokens/sec.
+    """
+    return provider_metrics.summary()
+
+
+@router.get("/usage")
+def usage_stats(
+    days: int = Query(default=7, ge=1, le=90, description="Number of days to return, including today"),
+    db: Session = Depends(get_db),
+):
+    """
+    Provider tokens and cost per model and day, as recorded on the game, NPC and action sessions.
+    """
+    since = datetime.date.today() - datetime.timedelta(days=days - 1)
+    rows = (
+        db.query(ModelUsageDaily)
+        .filter(ModelUsageDaily.day >= since)
+        .order_by(ModelUsageDaily.day.desc(), ModelUsageDaily.model)
+        .all()
+    )
+    return [row.to_dict() for row in rows]
@@ -6,11 +6,21 @@ import re
 import os
 import hashlib
 
+from src.fschat.api_provider_async import async_collect_stream
+from src.fschat.api_provider_game import collect_stream
+from src.fschat.call_scheduler import call_scheduler
 from src.fschat.conversation_game import Conversation
+from src.fschat.disconnect import bill_if_abandoned
+from src.fschat.fallback import async_collect_with_fallback, collect_with_fallback, turn_record
 from src.fschat.model_adapter import get_conversation_template
+from src.fschat.provider_metrics import call_type
+from src.fschat.usage_accounting import call_usage
 from utils import get_model_list
 
 class BaseNPC:
+    # table of the session row the usage is billed to
+    session_table = "npc_sessions"
+
     def __init__(
         self,
         model_name: Optional[str] = None,
@@ -47,6 +57,15 @@ class BaseNPC:
         else:
             self.system_prompt = None
 
+        # closing record (finish reason, usage) of the last delta stream, if any
+        self.last_completion = None
+        # usage of the calls made since the page last saved it to the session row
+        self.pending_usage = []
+        # set by the routes once the conversation belongs to a stored session
+        self.session_id = None
+        # model that served each of those calls, for the session row's `turn_models`
+        self.pending_turns = []
+
     def parse_animations(self, text: str) -> Tuple[str, list]:
         """
         Parses the text to extract animations in the form <Animation>.
@@ -62,6 +81,21 @@ class BaseNPC:
 
         return cleaned_text, animations
 
+    def _resolve_sampling(self, temperature, top_p, use_recommended_config):
+        if use_recommended_config:
+            recommended_config = self.model_api_info.get("recommended_config", None)
+            if recommended_config is not None:
+                temperature = recommended_config.get("temperature", 0.7)
+                top_p = recommended_config.get("top_p", 0.9)
+        return temperature, top_p
+
+    def _finalize_response(self, output: str, conversation: Conversation) -> Tuple[str, list]:
+        # Parse animations
+        cleaned_output, animations = self.parse_animations(output)
+        # Update conversation with NPC response (use the cleaned output)
+        conversation.update_last_message(cleaned_output)
+        return cleaned_output, animations
+
     def generation_response(
         self,
         stream_iter_fn: Callable,
@@ -72,30 +106,67 @@ class BaseNPC:
         state=None,
         use_recommended_config: bool = False,
     ) -> Tuple[str, list]:
-        if use_recommended_config:
-            recommended_config = self.model_api_info.get("recommended_config", None)
-            if recommended_config is not None:
-                temperature = recommended_config.get("temperature", 0.7)
-                top_p = recommended_config.get("top_p", 0.9)
+        temperature, top_p = self._resolve_sampling(temperature, top_p, use_recommended_config)
+        # Generating NPC response
+        def run(model_name, model_api_info, conversation):
+            with call_type("npc"):
+                stream_iter = stream_iter_fn(
+                    conversation,
+                    model_name,
+                    model_api_info,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=max_new_tokens,
+                    state=state,
+                )
+                return collect_stream(stream_iter)
+
+        output, self.last_completion, served_by, served_api_info = collect_with_fallback(
+            run, self.model_name, self.model_api_info, conversation
+        )
+        self.pending_usage.append(
+            call_usage(served_by, served_api_info, conversation, output, self.last_completion)
+        )
+        self.pending_turns.append(turn_record("npc", self.model_name, served_by))
+        output = output.strip()
+        return self._finalize_response(output, conversation)
+
+    async def async_generation_response(
+        self,
+        stream_iter_fn: Callable,
+        conversation: Conversation,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        max_new_tokens: int = 150,
+        state=None,
+        use_recommended_config: bool = False,
+    ) -> Tuple[str, list]:
+        """Same as `generation_response`, for async stream iterators."""
+        temperature, top_p = self._resolve_sampling(temperature, top_p, use_recommended_config)
         # Generating NPC response
-        stream_iter = stream_iter_fn(
-            conversation,
-            self.model_name,
-            self.model_api_info,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            state=state,
+        async def run(model_name, model_api_info, conversation):
+            with call_type("npc"), bill_if_abandoned(self, model_name, model_api_info, conversation):
+                stream_iter = stream_iter_fn(
+                    conversation,
+                    model_name,
+                    model_api_info,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=max_new_tokens,
+                    state=state,
+                )
+                return await async_collect_stream(stream_iter)
+
+        async with call_scheduler.slot("npc"):
+            output, self.last_completion, served_by, served_api_info = await async_collect_with_fallback(
+                run, self.model_name, self.model_api_info, conversation
+            )
+        self.pending_usage.append(
+            call_usage(served_by, served_api_info, conversation, output, self.last_completion)
         )
-        output = ""
-        for data in stream_iter:
-            assert data["error_code"] == 0
-            output = data["text"].strip()
-        # Parse animations
-        cleaned_output, animations = self.parse_animations(output)
-        # Update conversation with NPC response (use the cleaned output)
-        conversation.update_last_message(cleaned_output)
-        return cleaned_output, animations
+        self.pending_turns.append(turn_record("npc", self.model_name, served_by))
+        output = output.strip()
+        return self._finalize_response(output, conversation)
 
     def update_user_conversation(
         self, conversation: Conversation, user_input: str
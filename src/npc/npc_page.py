@@ -1,14 +1,16 @@
 # src/npc/npc_page.py
 
-from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Optional
 import uuid
 import json
 import os
 
 from src.npc.base_npc import BaseNPC
-from src.fschat.api_provider_game import get_api_provider_stream_iter
-from src.database import get_db, NPCSession  # Import NPCSession
+from src.fschat.api_provider_async import get_api_provider_async_delta_iter
+from src.fschat.disconnect import cancel_on_disconnect
+from src.database import get_db, find_session, add_session_usage, add_turn_models, NPCSession  # Import NPCSession
 from sqlalchemy.orm import Session
 from src.fschat.conversation_game import Conversation
 
@@ -20,7 +22,8 @@ with open(NPC_PROMPTS_FILE, 'r') as f:
     NPC_PROMPTS = json.load(f)
 
 @router.post("/npc/start")
-def npc_start(
+async def npc_start(
+    request: Request,
     name: str = Query(..., description="Name of the NPC"),
     username: Optional[str] = Query(default="anonymous", description="Specify the username"),
     db: Session = Depends(get_db)  # Added database dependency
@@ -39,25 +42,30 @@ def npc_start(
     initial_message = f"Hello, {npc_data['name']}!"
     npc.update_user_conversation(npc.conversation, initial_message)
 
-    npc_response, animations = npc.generation_response(
-        get_api_provider_stream_iter,
+    npc_response, animations = await cancel_on_disconnect(request, npc.async_generation_response(
+        get_api_provider_async_delta_iter,
         npc.conversation,
-    )
+    ))
 
     print(npc_response)
     print(animations)
 
-    # Save session to the database
-    new_session = NPCSession(
-        session_id=session_id,
-        username=username,
-        npc_name=name,
-        model=npc.model_name,
-        history=npc.conversation.messages,
-        system_prompt=npc.system_prompt
-    )
-    db.add(new_session)
-    db.commit()
+    def save_session():
+        # Save session to the database
+        new_session = NPCSession(
+            session_id=session_id,
+            username=username,
+            npc_name=name,
+            model=npc.model_name,
+            history=npc.conversation.messages,
+            system_prompt=npc.system_prompt
+        )
+        add_session_usage(db, new_session, npc.pending_usage)
+        add_turn_models(new_session, npc.pending_turns)
+        db.add(new_session)
+        db.commit()
+
+    await run_in_threadpool(save_session)
 
     return {
         "message": f"Conversation with {npc_data['name']} started.",
@@ -75,7 +83,8 @@ class NPCChatRequest(BaseModel):
     user_input: str
 
 @router.post("/npc/chat")
-def npc_chat(
+async def npc_chat(
+    request: Request,
     request_data: NPCChatRequest,
     db: Session = Depends(get_db)
 ):
@@ -86,7 +95,7 @@ def npc_chat(
     user_text = request_data.user_input
 
     # Retrieve the session from the database
-    npc_session = db.query(NPCSession).filter_by(session_id=session_id).first()
+    npc_session = await run_in_threadpool(find_session, db, NPCSession, session_id=session_id)
     if not npc_session:
         raise HTTPException(status_code=400, detail="Invalid or missing session_id.")
 
@@ -101,6 +110,7 @@ def npc_chat(
         conversation=conversation,
         system_prompt=npc_session.system_prompt
     )
+    npc.session_id = session_id
 
     if not user_text:
         raise HTTPException(status_code=400, detail="No user input provided.")
@@ -109,15 +119,20 @@ def npc_chat(
     npc.update_user_conversation(npc.conversation, user_text)
 
     # Generate NPC response
-    npc_response, animations = npc.generation_response(
-        get_api_provider_stream_iter,
+    npc_response, animations = await cancel_on_disconnect(request, npc.async_generation_response(
+        get_api_provider_async_delta_iter,
         npc.conversation,
-    )
+    ))
+
+    def save_session():
+        # Update session history in the database
+        npc_session.history = npc.conversation.messages
+        add_session_usage(db, npc_session, npc.pending_usage)
+        add_turn_models(npc_session, npc.pending_turns)
+        db.add(npc_session)
+        db.commit()
 
-    # Update session history in the database
-    npc_session.history = npc.conversation.messages
-    db.add(npc_session)
-    db.commit()
+    await run_in_threadpool(save_session)
 
     return {
         "npc_response": npc_response,
@@ -1,10 +1,17 @@
 import base64
+import functools
 import json
+import os
 
 import requests
 from fastchat.model.model_registry import model_info
 
 
+# point every endpoint config lookup at one file, e.g. the offline
+# `src/config/api_endpoint_mock.json` for load tests
+API_ENDPOINT_OVERRIDE = os.environ.get("API_ENDPOINT_OVERRIDE")
+
+
 def set_global_vars(controller_url_, enable_moderation_):
     global controller_url, enable_moderation
     controller_url = controller_url_
@@ -18,6 +25,7 @@ def get_model_list(register_api_endpoint_file, multimodal):
 
     # Add models from the API providers
     if register_api_endpoint_file:
+        register_api_endpoint_file = API_ENDPOINT_OVERRIDE or register_api_endpoint_file
         api_endpoint_info = json.load(open(register_api_endpoint_file))
         for mdl, mdl_dict in api_endpoint_info.items():
             mdl_multimodal = mdl_dict.get("multimodal", False)
@@ -47,6 +55,29 @@ def get_model_list(register_api_endpoint_file, multimodal):
     return visible_models, models, api_endpoint_info
 
 
+API_ENDPOINT_FILES = (
+    "src/config/api_endpoint.json",
+    "src/config/api_endpoint_hard.json",
+    "src/config/api_endpoint_backup.json",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_api_endpoint_file(register_api_endpoint_file):
+    register_api_endpoint_file = API_ENDPOINT_OVERRIDE or register_api_endpoint_file
+    with open(register_api_endpoint_file) as f:
+        return json.load(f)
+
+
+def get_api_endpoint_info(model_name, endpoint_files=API_ENDPOINT_FILES):
+    """Endpoint entry of `model_name` from the first config file that declares it."""
+    for endpoint_file in endpoint_files:
+        api_endpoint_info = load_api_endpoint_file(endpoint_file)
+        if model_name in api_endpoint_info:
+            return api_endpoint_info[model_name]
+    return None
+
+
 # Read the CSS file
 def load_css(file_name):
     with open(file_name) as f:
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the app imports both `src.fschat...` and the vendored `fastchat` package
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src"))
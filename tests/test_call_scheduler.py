@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+from src.fschat.call_scheduler import CallScheduler, CallShed
+from src.fschat.rate_limiter import start_deadline
+
+CLASSES = {
+    "turn": {"priority": 0, "max_concurrent": None, "max_queue": None, "max_wait": None},
+    "hint": {"priority": 1, "max_concurrent": 1, "max_queue": 1, "max_wait": 0.2},
+    "npc": {"priority": 2, "max_concurrent": 2, "max_queue": 4, "max_wait": 5.0},
+}
+
+
+async def hold(scheduler, call_class, order, name, seconds=0.05):
+    async with scheduler.slot(call_class):
+        order.append(name)
+        await asyncio.sleep(seconds)
+
+
+def test_queued_calls_are_admitted_by_priority():
+    order = []
+
+    async def main():
+        scheduler = CallScheduler(1, CLASSES)
+        first = asyncio.ensure_future(hold(scheduler, "npc", order, "npc-1"))
+        await asyncio.sleep(0.01)
+        queued = [
+            asyncio.ensure_future(hold(scheduler, "npc", order, "npc-2")),
+            asyncio.ensure_future(hold(scheduler, "hint", order, "hint")),
+            asyncio.ensure_future(hold(scheduler, "turn", order, "turn")),
+        ]
+        await asyncio.gather(first, *queued)
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+    assert order == ["npc-1", "turn", "hint", "npc-2"]
+
+
+def test_class_cap_does_not_hold_up_other_classes():
+    order = []
+
+    async def main():
+        scheduler = CallScheduler(3, CLASSES)
+        running = asyncio.ensure_future(hold(scheduler, "hint", order, "hint-1", 0.1))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.ensure_future(hold(scheduler, "hint", order, "hint-2"))
+        await asyncio.sleep(0.01)
+        await hold(scheduler, "npc", order, "npc")
+        await asyncio.gather(running, waiting)
+
+    asyncio.run(main())
+    assert order == ["hint-1", "npc", "hint-2"]
+
+
+def test_full_queue_is_shed():
+    async def main():
+        scheduler = CallScheduler(1, CLASSES)
+        running = asyncio.ensure_future(hold(scheduler, "hint", [], "running", 0.1))
+        await asyncio.sleep(0.01)
+        queued = asyncio.ensure_future(hold(scheduler, "hint", [], "queued"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(CallShed) as shed:
+            await scheduler.acquire("hint")
+        assert shed.value.call_class == "hint"
+        assert shed.value.retry_after == CLASSES["hint"]["max_wait"]
+        await asyncio.gather(running, queued)
+        assert scheduler.stats()["classes"]["hint"]["shed"] == 1
+
+    asyncio.run(main())
+
+
+def test_call_waiting_past_max_wait_is_shed():
+    async def main():
+        scheduler = CallScheduler(1, CLASSES)
+        running = asyncio.ensure_future(hold(scheduler, "turn", [], "turn", 0.5))
+        await asyncio.sleep(0.01)
+        with pytest.raises(CallShed, match="no slot within"):
+            await scheduler.acquire("hint")
+        # the turn class is never shed: it waits for the slot
+        await hold(scheduler, "turn", [], "turn-2")
+        await running
+        assert scheduler.stats()["classes"]["hint"]["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    order = []
+
+    async def main():
+        scheduler = CallScheduler(1, CLASSES)
+        running = asyncio.ensure_future(hold(scheduler, "npc", order, "npc-1"))
+        await asyncio.sleep(0.01)
+        cancelled = asyncio.ensure_future(hold(scheduler, "turn", order, "cancelled"))
+        after = asyncio.ensure_future(hold(scheduler, "npc", order, "npc-2"))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.gather(running, after)
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+    assert order == ["npc-1", "npc-2"]
+
+
+def test_turn_waiting_past_its_deadline_is_shed():
+    async def main():
+        scheduler = CallScheduler(1, CLASSES)
+        running = asyncio.ensure_future(hold(scheduler, "npc", [], "npc", 0.3))
+        await asyncio.sleep(0.01)
+        with start_deadline(time.monotonic() + 0.1):
+            with pytest.raises(CallShed, match="no slot within") as shed:
+                await scheduler.acquire("turn")
+        assert shed.value.call_class == "turn"
+        await running
+        assert scheduler.stats()["classes"]["turn"]["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_no_global_cap_by_default():
+    async def main():
+        scheduler = CallScheduler(None, CLASSES)
+        for _ in range(100):
+            await scheduler.acquire("turn")
+        assert scheduler.stats()["running"] == 100
+
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from src.fschat import disconnect
+from src.fschat.disconnect import ClientDisconnected, bill_if_abandoned, cancel_on_disconnect, note_output
+
+
+class FakeConv:
+    def to_openai_api_messages(self):
+        return [{"role": "user", "content": "x" * 400}]
+
+
+class FakeRequest:
+    class url:
+        path = "/taboo/ask"
+
+    def __init__(self, disconnect_after):
+        self.disconnect_at = None
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self):
+        loop = asyncio.get_running_loop()
+        if self.disconnect_at is None:
+            self.disconnect_at = loop.time() + self.disconnect_after
+        return loop.time() >= self.disconnect_at
+
+
+class Owner:
+    session_table = "game_sessions"
+    session_id = "session-1"
+
+    def __init__(self):
+        self.pending_usage = []
+
+    async def turn(self, chunks, gap):
+        # a finished call earlier in the same request
+        self.pending_usage.append({"model": "m", "output_tokens": 3})
+        with bill_if_abandoned(self, "m", {"pricing": {"input": 1.0, "output": 2.0}}, FakeConv()):
+            for _ in range(chunks):
+                await asyncio.sleep(gap)
+                note_output("abcd" * 5)
+        return "done"
+
+
+def test_abandoned_turn_carries_the_usage_it_spent(monkeypatch):
+    monkeypatch.setattr(disconnect, "DISCONNECT_POLL_SECONDS", 0.01)
+    owner = Owner()
+
+    async def main():
+        await cancel_on_disconnect(FakeRequest(0.1), owner.turn(chunks=100, gap=0.02))
+
+    with pytest.raises(ClientDisconnected) as raised:
+        asyncio.run(main())
+    [(table, session_id, usages)] = raised.value.billing
+    assert (table, session_id) == ("game_sessions", "session-1")
+    finished, partial = usages
+    assert finished["output_tokens"] == 3
+    # the prompt is estimated, the output is what was streamed before the cancel
+    assert partial["estimated"] and partial["input_tokens"] == 100
+    assert 0 < partial["output_tokens"] < 100 * 5
+    assert partial["cost_usd"] == (100 * 1.0 + partial["output_tokens"] * 2.0) / 1e6
+
+
+def test_completed_turn_is_billed_by_the_route_not_here(monkeypatch):
+    monkeypatch.setattr(disconnect, "DISCONNECT_POLL_SECONDS", 0.01)
+    owner = Owner()
+
+    async def main():
+        return await cancel_on_disconnect(FakeRequest(10), owner.turn(chunks=2, gap=0.01))
+
+    assert asyncio.run(main()) == "done"
+    assert owner.pending_usage == [{"model": "m", "output_tokens": 3}]
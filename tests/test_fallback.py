@@ -0,0 +1,68 @@
+import pytest
+
+from src.fschat import fallback
+from src.fschat.fallback import collect_with_fallback, translate_conversation, turn_record
+from src.fschat.model_adapter import get_conversation_template
+
+
+def conversation(model_name, system="You are the game master."):
+    conv = get_conversation_template(model_name)
+    conv.set_system_message(system)
+    for role, message in ((0, "hello"), (1, "Question 1: is it alive?"), (0, "No"), (1, None)):
+        conv.append_message(conv.roles[role], message)
+    return conv
+
+
+def test_translation_uses_the_roles_of_the_fallback_template():
+    translated = translate_conversation(conversation("gpt-4o-2024-11-20"), "gemini-1.5-pro")
+    assert [role for role, _ in translated.messages] == ["user", "model", "user", "model"]
+    assert [message for _, message in translated.messages] == ["hello", "Question 1: is it alive?", "No", None]
+    assert translated.system_message == "You are the game master."
+
+
+def test_system_prompt_is_folded_for_o1_and_unfolded_again():
+    to_o1 = translate_conversation(conversation("gpt-4o-2024-11-20"), "o1-mini")
+    assert to_o1.messages[0][1] == "You are the game master.\n\nhello"
+    # translating twice does not fold it twice
+    assert translate_conversation(to_o1, "o1-mini").messages[0][1] == "You are the game master.\n\nhello"
+    back = translate_conversation(to_o1, "claude-3-5-sonnet-20240620")
+    assert back.messages[0][1] == "hello"
+
+
+def test_turn_falls_back_in_order_with_a_translated_conversation(monkeypatch):
+    endpoints = {
+        "gemini-1.5-pro": {"model_name": "gemini-1.5-pro", "api_type": "gemini"},
+        "claude-3-5-sonnet-20240620": {"model_name": "claude-3-5-sonnet-20240620", "api_type": "anthropic_message"},
+    }
+    monkeypatch.setattr(fallback, "get_api_endpoint_info", endpoints.get)
+    model_api_info = {"model_name": "gpt-4o-2024-11-20", "api_type": "openai", "fallback": list(endpoints)}
+    conv = conversation("gpt-4o-2024-11-20")
+    tried = []
+
+    def run(model_name, model_api_info, conv_for_model):
+        tried.append((model_name, conv_for_model.roles[1]))
+        if model_name != "claude-3-5-sonnet-20240620":
+            raise RuntimeError(f"{model_name} is down")
+        return "Question 2: is it a tool?", {"final": True}
+
+    output, final, served_by, served_info = collect_with_fallback(run, "gpt-4o-2024-11-20", model_api_info, conv)
+    assert tried == [
+        ("gpt-4o-2024-11-20", "assistant"),
+        ("gemini-1.5-pro", "model"),
+        ("claude-3-5-sonnet-20240620", "assistant"),
+    ]
+    assert served_by == "claude-3-5-sonnet-20240620" and served_info is endpoints[served_by]
+    assert output == "Question 2: is it a tool?"
+    assert turn_record("question", "gpt-4o-2024-11-20", served_by) == {
+        "type": "question", "model": served_by, "fallback_from": "gpt-4o-2024-11-20",
+    }
+
+
+def test_last_error_is_raised_when_every_model_fails(monkeypatch):
+    monkeypatch.setattr(fallback, "get_api_endpoint_info", lambda name: None)
+
+    def run(model_name, model_api_info, conv):
+        raise TimeoutError(model_name)
+
+    with pytest.raises(TimeoutError):
+        collect_with_fallback(run, "gpt-4o-2024-11-20", {"fallback": ["missing"]}, conversation("gpt-4o-2024-11-20"))
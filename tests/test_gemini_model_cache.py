@@ -0,0 +1,70 @@
+import asyncio
+import sys
+import types
+
+import pytest
+
+from src.fschat.client_pool import GeminiModelCache
+
+
+class FakeGenai(types.ModuleType):
+    """`google.generativeai` whose default clients report the configured key."""
+
+    def __init__(self):
+        super().__init__("google.generativeai")
+        self.api_key = None
+        self.client = types.ModuleType("google.generativeai.client")
+        self.client.get_default_generative_client = lambda: ("sync", self.api_key)
+        self.client.get_default_generative_async_client = lambda: ("async", self.api_key)
+
+        class GenerativeModel:
+            def __init__(self, **kwargs):
+                self.kwargs = kwargs
+                self._client = None
+                self._async_client = None
+
+        self.GenerativeModel = GenerativeModel
+
+    def configure(self, api_key):
+        self.api_key = api_key
+
+
+@pytest.fixture
+def genai(monkeypatch):
+    fake = FakeGenai()
+    google = types.ModuleType("google")
+    google.generativeai = fake
+    monkeypatch.setitem(sys.modules, "google", google)
+    monkeypatch.setitem(sys.modules, "google.generativeai", fake)
+    monkeypatch.setitem(sys.modules, "google.generativeai.client", fake.client)
+    return fake
+
+
+def get(cache, api_key, system="be brief"):
+    return cache.get("gemini-pro", api_key, system, {"temperature": 0.0}, None)
+
+
+def test_models_keep_the_key_they_were_built_for(genai):
+    cache = GeminiModelCache()
+    first = get(cache, "key-a")
+    second = get(cache, "key-b")
+    assert first._client == ("sync", "key-a")
+    assert second._client == ("sync", "key-b")
+    # a cache hit for the first key after the SDK was reconfigured for the second
+    assert get(cache, "key-a") is first
+    assert first._client == ("sync", "key-a")
+    assert cache.stats()["hits"] == 1
+
+
+def test_async_client_is_bound_with_the_models_key(genai):
+    cache = GeminiModelCache()
+    model = get(cache, "key-a")
+    assert model._async_client is None
+    get(cache, "key-b")
+
+    async def main():
+        return get(cache, "key-a")
+
+    assert asyncio.run(main()) is model
+    assert model._async_client == ("async", "key-a")
+    assert cache.stats()["configured"] == 3
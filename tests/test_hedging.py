@@ -0,0 +1,54 @@
+import asyncio
+
+from src.fschat.hedging import _hedge_stats, hedged_delta_iter
+from src.fschat.rate_limiter import current_on_sent
+
+
+HEDGING = {"pool": [{"model_name": "backup", "api_type": "mock"}], "min_delay": 0.1, "max_delay": 0.1}
+
+
+def provider(queued, ttft):
+    """Delta dispatcher whose request waits `queued[name]` on the rate limiter,
+    then takes `ttft[name]` to its first chunk."""
+    calls = []
+
+    async def stream_iter_fn(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state):
+        calls.append(model_name)
+        await asyncio.sleep(queued.get(model_name, 0.0))
+        on_sent = current_on_sent.get()
+        if on_sent is not None:
+            on_sent()
+        await asyncio.sleep(ttft[model_name])
+        yield {"delta": model_name, "error_code": 0}
+        yield {"delta": "", "error_code": 0, "final": True}
+
+    return stream_iter_fn, calls
+
+
+def run(model_name, stream_iter_fn):
+    model_api_dict = {"model_name": model_name, "api_type": "mock", "hedging": HEDGING}
+
+    async def main():
+        return [
+            data async for data in hedged_delta_iter(
+                stream_iter_fn, None, model_name, model_api_dict, 0.7, 1.0, 16, None
+            )
+        ]
+
+    return asyncio.run(main())
+
+
+def test_slow_first_token_fires_a_hedge():
+    stream_iter_fn, calls = provider({}, {"slow": 0.5, "backup": 0.01})
+    records = run("slow", stream_iter_fn)
+    assert calls == ["slow", "backup"]
+    assert records[0]["delta"] == "backup"
+    assert records[-1]["served_by"] == "backup" and records[-1]["hedged"]
+
+
+def test_time_queued_on_the_rate_limiter_does_not_fire_a_hedge():
+    stream_iter_fn, calls = provider({"throttled": 0.4}, {"throttled": 0.02, "backup": 0.01})
+    records = run("throttled", stream_iter_fn)
+    assert calls == ["throttled"]
+    assert records[-1]["served_by"] == "throttled" and not records[-1]["hedged"]
+    assert _hedge_stats["throttled"]["hedges_fired"] == 0
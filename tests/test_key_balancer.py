@@ -0,0 +1,105 @@
+from collections import Counter
+
+import pytest
+
+from src.fschat.key_balancer import KeyBalancer, balanced_stream_iter, key_balancer, upstream_members
+
+
+def entry(strategy="least_outstanding", **extra):
+    return {
+        "model_name": "gpt-4o-2024-11-20",
+        "api_type": "openai",
+        "api_base": "https://api.openai.com/v1",
+        "balancing": {"strategy": strategy, "quarantine_seconds": 30, "auth_quarantine_seconds": 600},
+        **extra,
+    }
+
+
+def picks(balancer, model_api_dict, count):
+    keys = []
+    for _ in range(count):
+        member, member_api_dict = balancer.acquire(model_api_dict)
+        keys.append(member_api_dict["api_key"])
+        balancer.release(member, model_api_dict)
+    return keys
+
+
+def test_weighted_round_robin_follows_the_weights_smoothly():
+    model_api_dict = entry("weighted_round_robin", upstreams=[
+        {"api_key": "sk-a", "weight": 3},
+        {"api_key": "sk-b", "weight": 1},
+    ])
+    keys = picks(KeyBalancer(), model_api_dict, 8)
+    assert Counter(keys) == {"sk-a": 6, "sk-b": 2}
+    # smooth: the light member is not starved until the end of a cycle
+    assert keys[:4].count("sk-b") == 1
+
+
+def test_least_outstanding_prefers_the_idle_member():
+    balancer = KeyBalancer()
+    model_api_dict = entry(api_keys=["sk-a", "sk-b"])
+    busy, busy_api_dict = balancer.acquire(model_api_dict)
+    _, other_api_dict = balancer.acquire(model_api_dict)
+    assert other_api_dict["api_key"] != busy_api_dict["api_key"]
+    # members carry a single key and none of the balancing fields
+    assert "api_keys" not in other_api_dict and "balancing" not in other_api_dict
+
+
+def test_rate_limited_member_is_quarantined_for_its_retry_after():
+    balancer = KeyBalancer()
+    model_api_dict = entry(api_keys=["sk-a", "sk-b"])
+    member, member_api_dict = balancer.acquire(model_api_dict)
+    limited = member_api_dict["api_key"]
+    balancer.release(member, model_api_dict, {"text": "**API REQUEST ERROR** Reason: status code 429.", "error_code": 1})
+    assert limited not in picks(balancer, model_api_dict, 4)
+    stats = balancer.stats()["gpt-4o-2024-11-20"][member]
+    assert stats["rate_limited"] == 1 and 29 < stats["quarantined_for"] <= 30
+
+
+def test_auth_failure_quarantines_longer_and_everything_quarantined_still_serves():
+    balancer = KeyBalancer()
+    model_api_dict = entry(api_keys=["sk-a", "sk-b"])
+    for status in ("401", "429"):
+        member, _ = balancer.acquire(model_api_dict)
+        balancer.release(member, model_api_dict, {"text": f"status code {status}", "error_code": 1})
+    stats = balancer.stats()["gpt-4o-2024-11-20"]
+    assert sorted(round(s["quarantined_for"], -1) for s in stats.values()) == [30, 600]
+    # the member that comes back first takes the traffic
+    _, member_api_dict = balancer.acquire(model_api_dict)
+    picked = KeyBalancer.member_id(model_api_dict, member_api_dict["api_key"], member_api_dict["api_base"])
+    assert stats[picked]["rate_limited"] == 1
+
+
+def test_retry_after_longer_than_the_quarantine_wins():
+    class RateLimited(Exception):
+        status_code = 429
+
+        class response:
+            status_code = 429
+            headers = {"retry-after": "120"}
+
+    balancer = KeyBalancer()
+    model_api_dict = entry(api_keys=["sk-a", "sk-b"])
+    member, _ = balancer.acquire(model_api_dict)
+    balancer.release(member, model_api_dict, RateLimited())
+    assert 119 < balancer.stats()["gpt-4o-2024-11-20"][member]["quarantined_for"] <= 120
+
+
+def test_stream_releases_its_member_with_the_error_record():
+    model_api_dict = dict(entry(api_keys=["sk-a", "sk-b"]), model_name="stream-entry")
+
+    def stream_iter_fn(member_api_dict):
+        yield {"text": "status code 429", "error_code": 1}
+
+    list(balanced_stream_iter(model_api_dict, stream_iter_fn))
+    stats = key_balancer.stats()["stream-entry"]
+    assert sum(s["outstanding"] for s in stats.values()) == 0
+    assert sum(s["rate_limited"] for s in stats.values()) == 1
+
+
+def test_paired_keys_and_bases_must_match():
+    with pytest.raises(ValueError):
+        upstream_members(entry(api_keys=["sk-a", "sk-b"], api_bases=["https://one.example.com/v1"]))
+    assert upstream_members(entry(api_bases=["https://one", "https://two"], api_key="sk")) == [
+        ("sk", "https://one", 1), ("sk", "https://two", 1),
+    ]
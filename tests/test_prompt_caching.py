@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from src.fschat.api_provider_game import (
+    anthropic_usage_record,
+    openai_usage_record,
+    split_anthropic_system_prompt,
+)
+from src.fschat.usage_accounting import call_usage
+
+
+EPHEMERAL = {"type": "ephemeral"}
+MESSAGES = [
+    {"role": "system", "content": "You are the game master."},
+    {"role": "user", "content": "hello"},
+    {"role": "assistant", "content": "Question 1: is it alive?"},
+    {"role": "user", "content": "No"},
+]
+
+
+def test_system_prompt_and_last_message_get_cache_breakpoints():
+    system, messages = split_anthropic_system_prompt(MESSAGES, prompt_caching=True)
+    assert system == [{"type": "text", "text": "You are the game master.", "cache_control": EPHEMERAL}]
+    assert messages[-1]["content"] == [{"type": "text", "text": "No", "cache_control": EPHEMERAL}]
+    # earlier turns stay as they were, so the cached prefix matches the previous turn's
+    assert messages[:-1] == MESSAGES[1:-1]
+    assert MESSAGES[-1]["content"] == "No"
+
+
+def test_first_turn_and_disabled_caching_have_no_message_breakpoint():
+    _, messages = split_anthropic_system_prompt(MESSAGES[:2], prompt_caching=True)
+    assert messages == MESSAGES[1:2]
+    system, messages = split_anthropic_system_prompt(MESSAGES, prompt_caching=False)
+    assert system == "You are the game master." and messages == MESSAGES[1:]
+
+
+def test_anthropic_cache_reads_and_writes_count_as_input():
+    usage = SimpleNamespace(input_tokens=20, output_tokens=7, cache_read_input_tokens=900, cache_creation_input_tokens=80)
+    record = anthropic_usage_record(usage)
+    assert record == {
+        "input_tokens": 1000, "output_tokens": 7, "cached_input_tokens": 900, "cache_creation_input_tokens": 80,
+    }
+    entry = call_usage("claude", {"pricing": {"input": 3.0, "cached_input": 0.3, "output": 15.0}}, None, "", {"usage": record})
+    assert entry["cost_usd"] == (100 * 3.0 + 900 * 0.3 + 7 * 15.0) / 1e6
+
+
+def test_openai_and_deepseek_cached_tokens():
+    assert openai_usage_record(
+        {"prompt_tokens": 1200, "completion_tokens": 5, "prompt_tokens_details": {"cached_tokens": 1024}}
+    )["cached_input_tokens"] == 1024
+    assert openai_usage_record(
+        {"prompt_tokens": 1200, "completion_tokens": 5, "prompt_cache_hit_tokens": 640}
+    )["cached_input_tokens"] == 640
+    assert openai_usage_record(None) is None
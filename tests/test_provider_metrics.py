@@ -0,0 +1,38 @@
+import asyncio
+
+from src.fschat import singleflight
+from src.fschat.provider_metrics import current_call_type
+from src.games.base_game import BaseGame
+
+
+class FakeConv:
+    def to_openai_api_messages(self):
+        return [{"role": "user", "content": "is it an animal?"}]
+
+
+MODEL_API_DICT = {"model_name": "m", "api_type": "openai"}
+
+
+def test_coalesced_turn_calls_keep_their_call_type(monkeypatch):
+    monkeypatch.setattr(singleflight, "SINGLEFLIGHT", True)
+    seen = []
+
+    async def stream(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        # the label the provider metrics of this call are recorded under
+        seen.append(current_call_type.get())
+        yield {"delta": "yes", "error_code": 0}
+        yield {"delta": "", "error_code": 0, "final": True}
+
+    def upstream_calls():
+        return singleflight.singleflight_stats()["by_call_type"].get("question", {}).get("upstream", 0)
+
+    before = upstream_calls()
+    game = BaseGame.__new__(BaseGame)
+    game.session_id = "session-1"
+    run = game._async_run_turn("question", stream, 0.7, 1.0, 64, None)
+    output, _ = asyncio.run(run("m", MODEL_API_DICT, FakeConv()))
+
+    assert output == "yes"
+    assert seen == ["question"]
+    # the call did go through singleflight, in a task of its own
+    assert upstream_calls() == before + 1
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+from src.fschat import rate_limiter as rate_limiter_module
+from src.fschat.rate_limiter import RateLimitBucket, RateLimiter, bucket_for, start_deadline
+
+
+class FakeConv:
+    def __init__(self, chars):
+        self.chars = chars
+
+    def to_openai_api_messages(self):
+        return [{"role": "user", "content": "x" * self.chars}]
+
+
+@pytest.fixture
+def limiter(tmp_path, monkeypatch):
+    limiter = RateLimiter(str(tmp_path / "buckets.sqlite"))
+    monkeypatch.setattr(rate_limiter_module, "rate_limiter", limiter)
+    return limiter
+
+
+def tokens_left(limiter, bucket):
+    return limiter._conn().execute("SELECT tokens FROM buckets WHERE key = ?", (bucket.key,)).fetchone()[0]
+
+
+def test_reserve_within_budget_does_not_wait(limiter):
+    bucket = RateLimitBucket("openai/m/k", 60, 1000)
+    assert limiter.reserve(bucket, 100) == 0.0
+    assert tokens_left(limiter, bucket) == 900
+
+
+def test_reserve_over_budget_waits_for_the_refill(limiter):
+    bucket = RateLimitBucket("openai/m/k", None, 600)
+    limiter.reserve(bucket, 600)
+    # 60 tokens short at 600 tokens/minute
+    assert limiter.reserve(bucket, 60) == pytest.approx(6.0, abs=0.1)
+
+
+def test_unlimited_bucket_skips_the_write_lock(limiter):
+    bucket = RateLimitBucket("openai/m/none", None, None)
+    statements = []
+    limiter._conn().set_trace_callback(statements.append)
+    assert limiter.reserve(bucket, 100) == 0.0
+    assert not any(s.startswith("BEGIN") for s in statements)
+
+
+def test_unlimited_bucket_still_honours_a_429(limiter):
+    bucket = RateLimitBucket("openai/m/none", None, None)
+    limiter.learn(bucket.key, 429, {"retry-after": "3"})
+    assert limiter.reserve(bucket, 100) == pytest.approx(3.0, abs=0.1)
+
+
+def test_learned_limits_apply_without_configured_ones(limiter):
+    bucket = RateLimitBucket("openai/m/none", None, None)
+    limiter.learn(bucket.key, 200, {"x-ratelimit-limit-tokens": "600", "x-ratelimit-remaining-tokens": "0"})
+    assert limiter.reserve(bucket, 60) == pytest.approx(6.0, abs=0.1)
+
+
+def test_settle_gives_back_the_unused_estimate(limiter):
+    bucket = RateLimitBucket("openai/m/k", None, 1000)
+    limiter.reserve(bucket, 500)
+    limiter.settle(bucket, 500, 120)
+    assert tokens_left(limiter, bucket) == pytest.approx(880, abs=1)
+
+
+def test_wait_is_capped_by_the_start_deadline(limiter):
+    bucket = RateLimitBucket("openai/m/k", 1, None)
+    limiter.reserve(bucket, 0)
+    with start_deadline(time.monotonic() + 0.5):
+        assert limiter._wait_for(bucket, 0) == pytest.approx(0.5, abs=0.05)
+    with start_deadline(time.monotonic() - 1):
+        assert limiter._wait_for(bucket, 0) == 0.0
+
+
+ENTRY = {"api_type": "openai", "model_name": "m", "api_key": "k", "rate_limit": {"tpm": 10000}}
+
+
+def test_cancelled_stream_settles_what_it_did_not_use(limiter):
+    bucket = bucket_for(ENTRY)
+
+    async def upstream():
+        yield {"delta": "abcd" * 10, "error_code": 0}
+        await asyncio.sleep(10)
+        yield {"delta": "never", "error_code": 0}
+
+    async def main():
+        stream_iter = rate_limiter_module.async_rate_limited_stream_iter(ENTRY, FakeConv(400), 1000, upstream())
+
+        async def consume():
+            async for _ in stream_iter:
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        assert tokens_left(limiter, bucket) == pytest.approx(10000 - 1100, abs=1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    # 100 prompt tokens and 10 streamed ones were used
+    assert tokens_left(limiter, bucket) == pytest.approx(10000 - 110, abs=1)
+
+
+def test_finished_stream_settles_the_reported_usage(limiter):
+    bucket = bucket_for(ENTRY)
+
+    def upstream():
+        yield {"delta": "hello", "error_code": 0}
+        yield {"delta": "", "error_code": 0, "final": True, "usage": {"input_tokens": 90, "output_tokens": 10}}
+
+    records = list(rate_limiter_module.rate_limited_stream_iter(ENTRY, FakeConv(400), 1000, upstream()))
+    assert records[-1]["final"]
+    assert tokens_left(limiter, bucket) == pytest.approx(10000 - 100, abs=1)
+
+
+def test_failed_call_gives_back_its_reservation(limiter):
+    bucket = bucket_for(ENTRY)
+
+    def fail():
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        rate_limiter_module.rate_limited_call(ENTRY, FakeConv(400), 1000, fail)
+    assert tokens_left(limiter, bucket) == pytest.approx(10000 - 100, abs=1)
@@ -0,0 +1,96 @@
+import asyncio
+
+from src.fschat.api_provider_game import CompletionResult
+from src.fschat.response_cache import ResponseCache, cached, response_cache
+
+
+class FakeConv:
+    def __init__(self, text="hint please"):
+        self.text = text
+
+    def to_openai_api_messages(self):
+        return [{"role": "user", "content": self.text}]
+
+
+MODEL_API_DICT = {"model_name": "m", "api_type": "openai"}
+
+
+def result(text):
+    return CompletionResult(text=text, finish_reason="stop", usage={"input_tokens": 5, "output_tokens": 2})
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("src.fschat.response_cache.time.monotonic", lambda: now[0])
+    cache = ResponseCache(max_entries=4, ttl=10)
+    cache.put("k", "hint", result("a"))
+    hit = cache.get("k", "hint")
+    assert hit.text == "a" and hit.cached and hit.attempts == 0
+    now[0] += 11
+    assert cache.get("k", "hint") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.put("a", "hint", result("a"))
+    cache.put("b", "hint", result("b"))
+    # reading `a` makes `b` the least recently used
+    assert cache.get("a", "hint") is not None
+    cache.put("c", "hint", result("c"))
+    assert cache.get("b", "hint") is None
+    assert cache.get("a", "hint").text == "a"
+    assert cache.get("c", "hint").text == "c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_hint_stream_is_stored_and_served_from_the_cache():
+    response_cache.clear()
+    calls = []
+
+    def stream_iter_fn(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        calls.append(model_name)
+        yield {"delta": "use ", "error_code": 0}
+        yield {"delta": "the key", "error_code": 0}
+        yield {"delta": "", "error_code": 0, "final": True, "finish_reason": "stop", "usage": None}
+
+    fn = cached(stream_iter_fn, "hint")
+    records = list(fn(FakeConv(), "m", MODEL_API_DICT, 0.7, 1.0, 64))
+    assert records[-1]["final"]
+    hit = fn(FakeConv("  hint please  "), "m", MODEL_API_DICT, 0.7, 1.0, 64)
+    assert isinstance(hit, CompletionResult) and hit.text == "use the key"
+    assert calls == ["m"]
+    # other sampling params are another request
+    assert not isinstance(fn(FakeConv(), "m", MODEL_API_DICT, 0.2, 1.0, 64), CompletionResult)
+
+
+def test_upstream_stream_is_closed_when_the_consumer_stops_early():
+    response_cache.clear()
+    closed = []
+    upstreams = []
+
+    def upstream():
+        try:
+            for i in range(10):
+                yield {"delta": f"w{i}", "error_code": 0}
+        finally:
+            closed.append(True)
+
+    def stream_iter_fn(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        # held here too, so only an explicit close() ends it
+        upstreams.append(upstream())
+        return upstreams[-1]
+
+    stream_iter = cached(stream_iter_fn, "hint")(FakeConv("early"), "m", MODEL_API_DICT, 0.7, 1.0, 64)
+    next(stream_iter)
+    stream_iter.close()
+    assert closed == [True]
+
+
+def test_turn_calls_are_not_cached():
+    async def complete(conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        return result("sampled")
+
+    assert cached(complete, "answer") is complete
+    assert asyncio.run(cached(complete, "hint")(FakeConv("async"), "m", MODEL_API_DICT, 0.7, 1.0, 64)).text == "sampled"
+    assert cached(complete, "hint")(FakeConv("async"), "m", MODEL_API_DICT, 0.7, 1.0, 64).cached
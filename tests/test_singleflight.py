@@ -0,0 +1,167 @@
+import asyncio
+
+from src.fschat.api_provider_game import CompletionResult
+from src.fschat.singleflight import _async_flights, coalesced
+from src.fschat.usage_accounting import call_usage
+
+
+class FakeConv:
+    def __init__(self, text="same question"):
+        self.text = text
+
+    def to_openai_api_messages(self):
+        return [{"role": "user", "content": self.text}]
+
+
+MODEL_API_DICT = {"model_name": "m", "api_type": "openai"}
+
+
+class Upstream:
+    """Counts the provider calls and whether they were cut off."""
+
+    def __init__(self, chunks=3, gap=0.02):
+        self.chunks = chunks
+        self.gap = gap
+        self.calls = 0
+        self.cancelled = 0
+
+    async def stream(self, conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        self.calls += 1
+        try:
+            for i in range(self.chunks):
+                await asyncio.sleep(self.gap)
+                yield {"delta": f"w{i} ", "error_code": 0}
+            yield {"delta": "", "error_code": 0, "final": True}
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
+    async def complete(self, conv, model_name, model_api_dict, temperature, top_p, max_new_tokens, state=None):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.gap * self.chunks)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return CompletionResult(text="answer", usage={"input_tokens": 3, "output_tokens": 1})
+
+
+def call(fn, scope="session-1", conv=None):
+    return coalesced(fn, "hint", scope=scope)(conv or FakeConv(), "m", MODEL_API_DICT, 0.7, 1.0, 64)
+
+
+async def collect(stream_iter):
+    return [data async for data in stream_iter]
+
+
+def test_identical_streams_share_one_upstream_call():
+    upstream = Upstream()
+
+    async def main():
+        return await asyncio.gather(collect(call(upstream.stream)), collect(call(upstream.stream)))
+
+    leader, follower = asyncio.run(main())
+    assert upstream.calls == 1
+    assert [r["delta"] for r in leader] == [r["delta"] for r in follower]
+    assert leader[-1].get("final")
+    # the upstream call is billed once, to the caller that made it
+    assert not leader[-1].get("coalesced")
+    assert follower[-1]["coalesced"]
+    assert call_usage("m", None, FakeConv(), "w0 w1 w2 ", leader[-1]) is not None
+    assert call_usage("m", None, FakeConv(), "w0 w1 w2 ", follower[-1]) is None
+
+
+def test_shared_result_is_billed_once():
+    upstream = Upstream()
+
+    async def main():
+        return await asyncio.gather(call(upstream.complete), call(upstream.complete))
+
+    leader, follower = asyncio.run(main())
+    assert upstream.calls == 1
+    assert not leader.coalesced and follower.coalesced
+    assert call_usage("m", None, FakeConv(), leader.text, leader.to_record())["input_tokens"] == 3
+    assert call_usage("m", None, FakeConv(), follower.text, follower.to_record()) is None
+
+
+def test_other_sessions_and_unscoped_calls_are_not_coalesced():
+    upstream = Upstream()
+
+    async def main():
+        await asyncio.gather(
+            collect(call(upstream.stream, scope="session-1")),
+            collect(call(upstream.stream, scope="session-2")),
+            collect(call(upstream.stream, scope=None)),
+            collect(call(upstream.stream, scope=None)),
+        )
+
+    asyncio.run(main())
+    assert upstream.calls == 4
+
+
+def test_follower_keeps_the_stream_when_the_leader_is_cancelled():
+    upstream = Upstream(chunks=5)
+
+    async def main():
+        leader = asyncio.ensure_future(collect(call(upstream.stream)))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(collect(call(upstream.stream)))
+        await asyncio.sleep(upstream.gap * 2)
+        leader.cancel()
+        return await follower
+
+    records = asyncio.run(main())
+    assert upstream.calls == 1
+    assert upstream.cancelled == 0
+    assert [r["delta"] for r in records[:-1]] == [f"w{i} " for i in range(5)]
+    assert records[-1].get("final")
+
+
+def test_upstream_stream_is_cancelled_when_every_caller_leaves():
+    upstream = Upstream(chunks=50)
+
+    async def main():
+        callers = [asyncio.ensure_future(collect(call(upstream.stream))) for _ in range(2)]
+        await asyncio.sleep(upstream.gap * 2)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert not _async_flights
+        # a later identical call starts a new upstream call instead of joining the cancelled one
+        await collect(call(Upstream(chunks=1).stream))
+
+    asyncio.run(main())
+    assert upstream.cancelled == 1
+
+
+def test_follower_gets_the_result_when_the_leader_is_cancelled():
+    upstream = Upstream()
+
+    async def main():
+        leader = asyncio.ensure_future(call(upstream.complete))
+        follower = asyncio.ensure_future(call(upstream.complete))
+        await asyncio.sleep(upstream.gap)
+        leader.cancel()
+        return await follower
+
+    result = asyncio.run(main())
+    assert upstream.calls == 1
+    assert upstream.cancelled == 0
+    assert result.text == "answer"
+
+
+def test_upstream_call_is_cancelled_when_every_caller_leaves():
+    upstream = Upstream(chunks=50)
+
+    async def main():
+        callers = [asyncio.ensure_future(call(upstream.complete)) for _ in range(2)]
+        await asyncio.sleep(upstream.gap)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert not _async_flights
+
+    asyncio.run(main())
+    assert upstream.cancelled == 1